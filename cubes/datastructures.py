@@ -7,8 +7,9 @@
 """
 
 
-from collections import MutableMapping
+from collections import MutableMapping, OrderedDict
 import sys
+import threading
 
 
 __all__ = [
@@ -17,6 +18,7 @@ __all__ = [
     "AttributeDict",
     "DictAttribute",
     "FlatAccessDict",
+    "LRUCache",
 ]
 
 
@@ -177,3 +179,62 @@ class FlatAccessDict(dict):
         else:
             return owner.pop(path[-1], default)
 
+
+class LRUCache(object):
+    """Thread-safe dictionary-like cache holding at most `size` items. When
+    the cache is full, the least recently used item is discarded. If `size`
+    is ``None`` then the cache is not limited, if it is ``0`` then nothing
+    is stored."""
+
+    def __init__(self, size=None):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns item `key` and marks it as recently used. Returns
+        `default` if there is no such item."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+
+            self._items[key] = value
+            return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        if self.size == 0:
+            return
+
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+
+            if self.size is not None:
+                while len(self._items) > self.size:
+                    self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        with self._lock:
+            return list(self._items.keys())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
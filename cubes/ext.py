@@ -29,6 +29,7 @@ EXTENSION_TYPES = {
     "authorizer": "Authorizer",
     "authenticator": "Authenticator",
     "request_log_handler": "Request log handler",
+    "result_cache": "Aggregation result cache",
 }
 
 # Information about built-in extensions. Supposedly faster loading (?).
@@ -61,7 +62,11 @@ _BUILTIN_EXTENSIONS = {
         "csv": "cubes.server.logging:CSVFileRequestLogHandler",
         'xlsx': 'cubes.server.logging:XLSXFileRequestLogHandler',
         "json": "cubes.server.logging:JSONRequestLogHandler",
-        "sql": "cubes.sql.logging:SQLRequestLogger",
+        "sql": "cubes.sql.logging:SQLRequestLogHandler",
+    },
+    "result_caches": {
+        "memory": "cubes.query.cache:MemoryResultCache",
+        "filesystem": "cubes.query.cache:FilesystemResultCache",
     },
     "stores": {
         "sql":"cubes.sql.store:SQLStore",
@@ -271,4 +276,5 @@ browser = ExtensionFinder("browsers")
 formatter = ExtensionFinder("formatters")
 model_provider = ExtensionFinder("providers")
 request_log_handler = ExtensionFinder("request_log_handlers")
+result_cache = ExtensionFinder("result_caches")
 store = ExtensionFinder("stores")
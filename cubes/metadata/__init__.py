@@ -9,3 +9,4 @@ from .dimension import *
 from .cube import *
 from .providers import *
 from .localization import *
+from .compiled import *
@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+"""Compiled models – model metadata together with fully linked and validated
+cubes and dimensions stored in a binary file that can be loaded without
+parsing, merging and linking the model again."""
+
+from __future__ import absolute_import
+
+import os
+import pickle
+import tempfile
+
+from ..errors import ModelError, CubesError
+from ..namespace import Namespace
+from .. import __version__
+from .providers import StaticModelProvider, find_dimension
+
+
+__all__ = (
+    "CompiledModelProvider",
+    "compile_model",
+    "write_compiled_model",
+    "read_compiled_model",
+    "is_compiled_model",
+)
+
+
+COMPILED_MODEL_MAGIC = b"CUBESMODEL\n"
+COMPILED_MODEL_VERSION = 1
+
+
+class CompiledModelProvider(StaticModelProvider):
+    """Model provider of a compiled model. The provider serves the original
+    model `metadata` (cube list, metadata of objects that were not compiled),
+    `cubes` and `dimensions` are dictionaries of pickled linked cubes and
+    public dimensions. Every request returns a fresh copy of the object, as
+    the callers are allowed to modify the returned objects.
+
+    .. versionadded:: 1.2
+    """
+
+    def __init__(self, metadata=None, cubes=None, dimensions=None):
+        super(CompiledModelProvider, self).__init__(metadata)
+
+        self.compiled_cubes = cubes or {}
+        self.compiled_dimensions = dimensions or {}
+
+    def cube(self, name, locale=None, namespace=None):
+        try:
+            data = self.compiled_cubes[name]
+        except KeyError:
+            return super(CompiledModelProvider, self).cube(name, locale,
+                                                           namespace)
+        return pickle.loads(data)
+
+    def dimension(self, name, templates=[], locale=None):
+        try:
+            data = self.compiled_dimensions[name]
+        except KeyError:
+            return super(CompiledModelProvider, self).dimension(name,
+                                                                templates,
+                                                                locale)
+        return pickle.loads(data)
+
+
+def compile_model(metadata):
+    """Creates and links all cubes and public dimensions of the model
+    `metadata` and validates the cubes. Returns a
+    :class:`CompiledModelProvider`. Raises `ModelError` when a cube is not
+    valid or refers to objects outside of the model, such as dimensions of
+    another model."""
+
+    provider_name = metadata.get("provider", "default")
+    if provider_name != "default":
+        raise ModelError("Only models of the default provider can be "
+                         "compiled, model provider is '{}'"
+                         .format(provider_name))
+
+    provider = StaticModelProvider(metadata)
+    namespace = Namespace()
+    namespace.add_provider(provider)
+
+    dimensions = {}
+    for name in provider.dimensions_metadata:
+        dimension = find_dimension(name, provider=provider,
+                                   namespace=namespace)
+        dimensions[name] = pickle.dumps(dimension, pickle.HIGHEST_PROTOCOL)
+
+    cubes = {}
+    for name in provider.cubes_metadata:
+        try:
+            cube = provider.cube(name, namespace=namespace)
+        except CubesError as e:
+            # Dimensions of other models are not available at compile time
+            raise ModelError("Can not compile cube '{}': {}"
+                             .format(name, e))
+
+        errors = [message for (severity, message) in cube.validate()
+                  if severity == "error"]
+        if errors:
+            raise ModelError("Cube '{}' is not valid: {}"
+                             .format(name, "; ".join(errors)))
+
+        cubes[name] = pickle.dumps(cube, pickle.HIGHEST_PROTOCOL)
+
+    return CompiledModelProvider(metadata, cubes=cubes,
+                                 dimensions=dimensions)
+
+
+def write_compiled_model(path, metadata):
+    """Compiles the model `metadata` with :func:`compile_model` and writes
+    it to a file `path`. The file is tagged by the compiled model format
+    version and Cubes version."""
+
+    provider = compile_model(metadata)
+
+    compiled = {
+        "version": COMPILED_MODEL_VERSION,
+        "cubes_version": __version__,
+        "metadata": metadata,
+        "cubes": provider.compiled_cubes,
+        "dimensions": provider.compiled_dimensions
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+
+    # Write to a temporary file first, so a running workspace never reads a
+    # partially written model
+    (handle, temp_path) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, "wb") as f:
+        f.write(COMPILED_MODEL_MAGIC)
+        pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, path)
+
+
+def is_compiled_model(path):
+    """Returns `True` if `path` is a file with a compiled model."""
+
+    if not os.path.isfile(path):
+        return False
+
+    with open(path, "rb") as f:
+        return f.read(len(COMPILED_MODEL_MAGIC)) == COMPILED_MODEL_MAGIC
+
+
+def read_compiled_model(path):
+    """Reads a compiled model from `path` written by
+    :func:`write_compiled_model`. Returns a :class:`CompiledModelProvider`.
+    Raises `ModelError` when the file is not a compiled model or was
+    compiled by another version of Cubes."""
+
+    with open(path, "rb") as f:
+        if f.read(len(COMPILED_MODEL_MAGIC)) != COMPILED_MODEL_MAGIC:
+            raise ModelError("File '{}' is not a compiled model".format(path))
+
+        try:
+            compiled = pickle.load(f)
+        except Exception as e:
+            raise ModelError("Can not read compiled model '{}': {}"
+                             .format(path, e))
+
+    version = (compiled.get("version"), compiled.get("cubes_version"))
+
+    if version != (COMPILED_MODEL_VERSION, __version__):
+        raise ModelError("Compiled model '{}' was created by another version "
+                         "of Cubes ({}), compile the model again"
+                         .format(path, compiled.get("cubes_version")))
+
+    return CompiledModelProvider(compiled["metadata"],
+                                 cubes=compiled["cubes"],
+                                 dimensions=compiled["dimensions"])
@@ -673,10 +673,10 @@ class Cube(ModelObject):
         measures = set()
 
         for measure in self.measures:
-            if not isinstance(measure, Attribute):
+            if not isinstance(measure, Measure):
                 results.append(('error',
-                                "Measure '%s' in cube '%s' is not instance"
-                                "of Attribute" % (measure, self.name)))
+                                "Measure '%s' in cube '%s' is not instance "
+                                "of Measure" % (measure, self.name)))
             else:
                 measures.add(str(measure))
 
@@ -1,4 +1,5 @@
 from .browser import *
+from .cache import *
 from .cells import *
 from .computation import *
 from .statutils import *
@@ -2,16 +2,21 @@
 
 from __future__ import absolute_import
 
-from collections import namedtuple
+import time
+
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from ..calendar import CalendarMemberConverter
 from ..logging import get_logger
 from ..common import IgnoringDictionary
 from ..errors import ArgumentError, NoSuchAttributeError, HierarchyError
+from ..errors import CubesError
 from ..metadata import string_to_dimension_level
 
 from .statutils import calculators_for_aggregates, available_calculators
 from .cells import Cell, PointCut, RangeCut, SetCut, cuts_from_string
+from .cache import aggregate_cache_key, rollup_cache_key
 from ..metadata import Dimension
 
 from .. import compat
@@ -28,12 +33,17 @@ __all__ = [
     "levels_from_drilldown",
 
     "TableRow",
+    "ResultRow",
     "SPLIT_DIMENSION_NAME",
 ]
 
 
 SPLIT_DIMENSION_NAME = '__within_split__'
+REPORT_QUERY_TYPES = ("aggregate", "facts", "fact", "values", "members",
+                      "details", "cell")
 NULL_PATH_VALUE = '__null__'
+# Seconds between checks of running concurrent report queries
+REPORT_POLL_INTERVAL = 0.1
 
 
 class AggregationBrowser(object):
@@ -49,6 +59,19 @@ class AggregationBrowser(object):
 
     builtin_functions = []
 
+    # Number of threads used to execute report queries concurrently and
+    # time limit in seconds of every concurrently executed report query. See
+    # `report()`.
+    report_workers = 1
+    report_timeout = None
+
+    # Errors of concurrently executed report queries that are reported in
+    # the report result instead of failing the whole report
+    report_query_errors = (CubesError, )
+
+    # Cache of aggregation results, see `cubes.query.cache.ResultCache`
+    result_cache = None
+
     def __init__(self, cube, store=None, locale=None, **options):
         """Creates and initializes the aggregation browser. Subclasses should
         override this method. """
@@ -76,6 +99,13 @@ class AggregationBrowser(object):
         """
         return {}
 
+    def watermark(self):
+        """Returns a value that changes whenever data of the browsed cube
+        change, such as the maximal fact key, or `None` if not available.
+        Used to invalidate cached aggregation results. Default implementation
+        returns `None`, backends might override this method."""
+        return None
+
     def aggregate(self, cell=None, aggregates=None, drilldown=None, split=None,
                   order=None, page=None, page_size=None, **options):
 
@@ -124,6 +154,50 @@ class AggregationBrowser(object):
         if "measures" in options:
             raise ArgumentError("measures in aggregate are depreciated")
 
+        (cell, aggregates, drilldon, split, order) = \
+                self._prepare_aggregate_query(cell, aggregates, drilldown,
+                                              split, order)
+
+        # Streamed results are not cached
+        if self.result_cache is not None and not options.get("stream"):
+            result = self._cached_aggregate(cell, aggregates, drilldon,
+                                            split, order, page, page_size,
+                                            options)
+        else:
+            result = self.provide_aggregate(cell,
+                                            aggregates=aggregates,
+                                            drilldown=drilldon,
+                                            split=split,
+                                            order=order,
+                                            page=page,
+                                            page_size=page_size,
+                                            **options)
+
+        #
+        # Find post-aggregation calculations and decorate the result
+        #
+        calculated_aggs = [agg for agg in aggregates
+                           if agg.function and \
+                                not self.is_builtin_function(agg.function)]
+
+        result.calculators = calculators_for_aggregates(self.cube,
+                                                        calculated_aggs,
+                                                        drilldown,
+                                                        split)
+
+        # Do calculated measures on summary if no drilldown or split
+        if result.summary:
+            for calc in result.calculators:
+                calc(result.summary)
+
+        return result
+
+    def _prepare_aggregate_query(self, cell, aggregates, drilldown, split,
+                                 order):
+        """Returns a tuple (`cell`, `aggregates`, `drilldown`, `split`,
+        `order`) with the aggregation query arguments converted to objects
+        – cells, aggregates and `Drilldown`."""
+
         aggregates = self.prepare_aggregates(aggregates)
         order = self.prepare_order(order, is_aggregate=True)
 
@@ -143,36 +217,167 @@ class AggregationBrowser(object):
                                     role_member_converters=converters)
             split = Cell(self.cube, cuts)
 
-        drilldon = Drilldown(drilldown, cell)
+        drilldown = Drilldown(drilldown, cell)
 
-        result = self.provide_aggregate(cell,
-                                        aggregates=aggregates,
-                                        drilldown=drilldon,
-                                        split=split,
-                                        order=order,
-                                        page=page,
-                                        page_size=page_size,
-                                        **options)
+        return (cell, aggregates, drilldown, split, order)
 
-        #
-        # Find post-aggregation calculations and decorate the result
-        #
-        calculated_aggs = [agg for agg in aggregates
-                           if agg.function and \
-                                not self.is_builtin_function(agg.function)]
+    def aggregate_version(self, cell=None, aggregates=None, drilldown=None,
+                          split=None, order=None, page=None, page_size=None,
+                          **options):
+        """Returns a string that identifies the result of the aggregation
+        with the same arguments as :meth:`aggregate` at the current state of
+        the cube data, without executing the aggregation. Returns `None` if
+        the state of the data is not known – the browser provides no
+        watermark. Used as an entity tag by the server.
 
-        result.calculators = calculators_for_aggregates(self.cube,
-                                                        calculated_aggs,
-                                                        drilldown,
-                                                        split)
+        .. versionadded:: 1.2
+        """
 
-        # Do calculated measures on summary if no drilldown or split
-        if result.summary:
-            for calc in result.calculators:
-                calc(result.summary)
+        if self.result_cache is not None:
+            watermark = self.result_cache.watermark(self.cube.name,
+                                                    self.watermark)
+        else:
+            watermark = self.watermark()
+
+        if watermark is None:
+            return None
+
+        (cell, aggregates, drilldown, split, order) = \
+                self._prepare_aggregate_query(cell, aggregates, drilldown,
+                                              split, order)
+
+        key = aggregate_cache_key(self.cube, cell, aggregates, drilldown,
+                                  split, order, page, page_size,
+                                  locale=getattr(self, "locale", None),
+                                  options=options)
+
+        return "{}-{}".format(key, watermark)
+
+    def _cached_aggregate(self, cell, aggregates, drilldown, split, order,
+                          page, page_size, options):
+        """Returns aggregation result from the result cache or computes and
+        caches it. Concurrent misses of the same result are computed only
+        once. Stale result is returned while being refreshed in the
+        background."""
+
+        cache = self.result_cache
+        context = self._cache_context(cell, aggregates, drilldown, split,
+                                      order, page, page_size, options)
+
+        computed = []
+
+        def compute():
+            result = self.provide_aggregate(cell,
+                                            aggregates=aggregates,
+                                            drilldown=drilldown,
+                                            split=split,
+                                            order=order,
+                                            page=page,
+                                            page_size=page_size,
+                                            **options)
+            # Fetch all the cells for the cache
+            result.cells = list(result.cells)
+            self._cache_store(context, result, aggregates, drilldown)
+            computed.append(result)
+
+            return result.payload()
+
+        (payload, stale) = self._cache_lookup(context, aggregates, drilldown)
+
+        if payload is None:
+            payload = cache.single_flight(context["key"], self.cube.name,
+                                          compute)
+            if computed:
+                return computed[0]
+        elif stale:
+            cache.refresh(context["key"], self.cube.name, compute)
+
+        result = AggregationResult(cell=cell, aggregates=aggregates,
+                                   drilldown=drilldown,
+                                   has_split=split is not None)
+        result.restore(payload)
 
         return result
 
+    def _cache_context(self, cell, aggregates, drilldown, split, order,
+                       page, page_size, options):
+        """Returns a dictionary with result cache keys and the current
+        watermark of an aggregation query. Key `rollup_key` is set only for
+        complete results – not split, ordered or paginated – which can be
+        rolled-up from or to other complete results of the same cell."""
+
+        cache = self.result_cache
+        locale = getattr(self, "locale", None)
+
+        key = aggregate_cache_key(self.cube, cell, aggregates, drilldown,
+                                  split, order, page, page_size,
+                                  locale=locale, options=options)
+
+        if split is None and not order and page is None \
+                and page_size is None and options.get("continuation") is None:
+            rollup_key = rollup_cache_key(self.cube, cell, locale=locale,
+                                          options=options)
+        else:
+            rollup_key = None
+
+        return {
+            "key": key,
+            "rollup_key": rollup_key,
+            "watermark": cache.watermark(self.cube.name, self.watermark)
+        }
+
+    def _cache_lookup(self, context, aggregates, drilldown):
+        """Returns a tuple (`payload`, `stale`) with cached result payload
+        or a payload rolled-up from a cached finer result. Payload is `None`
+        if there is no such result, `stale` is `True` if the cached result
+        expired and should be refreshed."""
+
+        cache = self.result_cache
+        cube = self.cube.name
+        watermark = context["watermark"]
+
+        (payload, stale) = cache.lookup(context["key"], cube, watermark)
+
+        if payload is None and context["rollup_key"] is not None:
+            payload = cache.rollup(context["rollup_key"], drilldown,
+                                   aggregates, cube, watermark)
+            if payload is not None:
+                logger = get_logger()
+                logger.debug("result of cube '%s' rolled-up from a cached "
+                             "result" % cube)
+                cache.set(context["key"], payload, cube, watermark)
+
+        return (payload, stale)
+
+    def _cache_store(self, context, result, aggregates, drilldown):
+        """Stores fetched `result` in the result cache."""
+
+        cache = self.result_cache
+        cube = self.cube.name
+        watermark = context["watermark"]
+
+        cache.set(context["key"], result.payload(), cube, watermark)
+
+        if context["rollup_key"] is not None:
+            functions = {}
+            for aggregate in aggregates:
+                function = self.aggregate_rollup_function(aggregate)
+                if function:
+                    functions[str(aggregate)] = function
+
+            if functions:
+                cache.add_rollup_source(context["rollup_key"],
+                                        context["key"], drilldown, functions,
+                                        cube, watermark)
+
+    def aggregate_rollup_function(self, aggregate):
+        """Returns name of the function (``sum``, ``min`` or ``max``) that
+        combines values of `aggregate` aggregated at a finer level into a
+        coarser aggregate, or `None` if the aggregate is not additive. Used
+        to answer aggregations from cached results. Default implementation
+        returns `None` – no aggregate can be rolled-up."""
+        return None
+
     def provide_aggregate(self, cell=None, measures=None, aggregates=None,
                           drilldown=None, split=None, order=None, page=None,
                           page_size=None, **options):
@@ -384,7 +589,7 @@ class AggregationBrowser(object):
         raise NotImplementedError("{} does not provide test functionality." \
                                   .format(str(type(self))))
 
-    def report(self, cell, queries):
+    def report(self, cell, queries, workers=None, timeout=None):
         """Bundle multiple requests from `queries` into a single one.
 
         Keys of `queries` are custom names of queries which caller can later
@@ -448,10 +653,27 @@ class AggregationBrowser(object):
             * a dictionary where keys are dimension names and values are
               levels to be rolled up-to
 
-        *Future*
+        *Concurrency*
+
+        By default the queries are executed one after another and an error
+        of any query is raised.
+
+        If `workers` is greater than 1, the queries are executed concurrently
+        on a pool of at most `workers` threads and the whole report takes
+        about as long as the slowest query. The results are fetched
+        completely within the worker threads. A query that fails with one of
+        the expected errors – `report_query_errors`, such as cubes or
+        database errors – or does not finish within `timeout` seconds from
+        its start does not fail the report: its result is a dictionary with
+        ``error`` (``query_error`` or ``timeout``), ``message`` and ``type``
+        keys. Other errors are raised. The worker thread of the timed out
+        query can not be interrupted: it keeps its database connection until
+        the database finishes the query and its result is discarded. Use a
+        database statement timeout to stop such queries in the database.
+        Default values are taken from the browser attributes
+        `report_workers` and `report_timeout`. Backends that can not be used
+        from multiple threads should keep `report_workers` at 1.
 
-        In the future there might be optimisations added to this method,
-        therefore it will become faster than subsequent separate requests.
         Also when used with Slicer OLAP service server number of HTTP call
         overhead is reduced.
         """
@@ -463,62 +685,186 @@ class AggregationBrowser(object):
         # `AggregationBrowser.cell_details() for more information). Default key
         # name is ``_cell``.
 
-        report_result = {}
+        if workers is None:
+            workers = self.report_workers
+        if timeout is None:
+            timeout = self.report_timeout
 
         for result_name, query in queries.items():
             query_type = query.get("query")
             if not query_type:
                 raise ArgumentError("No report query for '%s'" % result_name)
+            if query_type not in REPORT_QUERY_TYPES:
+                raise ArgumentError("Unknown report query '%s' for '%s'" %
+                                    (query_type, result_name))
 
-            # FIXME: add: cell = query.get("cell")
+        if not workers or workers <= 1 or len(queries) <= 1:
+            report_result = {}
+            for result_name, query in queries.items():
+                report_result[result_name] = self._report_query(cell, query)
+        else:
+            report_result = self._concurrent_report(cell, queries, workers,
+                                                    timeout)
+
+        return report_result
 
-            args = dict(query)
-            del args["query"]
+    def _report_query(self, cell, query):
+        """Executes single report `query` for `cell` and returns the query
+        result."""
 
-            # Note: we do not just convert name into function from symbol for possible future
-            # more fine-tuning of queries as strings
+        query_type = query["query"]
 
-            # Handle rollup
-            rollup = query.get("rollup")
-            if rollup:
-                query_cell = cell.rollup(rollup)
-            else:
-                query_cell = cell
+        # FIXME: add: cell = query.get("cell")
 
-            if query_type == "aggregate":
-                result = self.aggregate(query_cell, **args)
+        args = dict(query)
+        del args["query"]
 
-            elif query_type == "facts":
-                result = self.facts(query_cell, **args)
+        # Note: we do not just convert name into function from symbol for possible future
+        # more fine-tuning of queries as strings
 
-            elif query_type == "fact":
-                # Be more tolerant: by default we want "key", but "id" might be common
-                key = args.get("key")
-                if not key:
-                    key = args.get("id")
-                result = self.fact(key)
+        # Handle rollup
+        rollup = query.get("rollup")
+        if rollup:
+            query_cell = cell.rollup(rollup)
+        else:
+            query_cell = cell
 
-            elif query_type in ("values", "members"):
-                # TODO: `values` are deprecated
-                result = self.members(query_cell, **args)
+        if query_type == "aggregate":
+            result = self.aggregate(query_cell, **args)
 
-            elif query_type == "details":
-                # FIXME: depreciate this raw form
-                result = self.cell_details(query_cell, **args)
+        elif query_type == "facts":
+            result = self.facts(query_cell, **args)
 
-            elif query_type == "cell":
-                details = self.cell_details(query_cell, **args)
-                cell_dict = query_cell.to_dict()
+        elif query_type == "fact":
+            # Be more tolerant: by default we want "key", but "id" might be common
+            key = args.get("key")
+            if not key:
+                key = args.get("id")
+            result = self.fact(key)
 
-                for cut, detail in zip(cell_dict["cuts"], details):
-                    cut["details"] = detail
+        elif query_type in ("values", "members"):
+            # TODO: `values` are deprecated
+            result = self.members(query_cell, **args)
 
-                result = cell_dict
-            else:
-                raise ArgumentError("Unknown report query '%s' for '%s'" %
-                                    (query_type, result_name))
+        elif query_type == "details":
+            # FIXME: depreciate this raw form
+            result = self.cell_details(query_cell, **args)
 
-            report_result[result_name] = result
+        elif query_type == "cell":
+            details = self.cell_details(query_cell, **args)
+            cell_dict = query_cell.to_dict()
+
+            for cut, detail in zip(cell_dict["cuts"], details):
+                cut["details"] = detail
+
+            result = cell_dict
+
+        return result
+
+    def _fetch_report_query(self, cell, query):
+        """Executes report `query` and fetches the whole result, so the
+        database work is done and the connection is released within the
+        calling worker thread."""
+
+        result = self._report_query(cell, query)
+
+        if isinstance(result, AggregationResult):
+            result = result.cached()
+        elif not isinstance(result, (dict, list)) \
+                and not isinstance(result, compat.string_type) \
+                and hasattr(result, "__iter__"):
+            result = list(result)
+
+        return result
+
+    def _report_query_error(self, result_name, exception):
+        """Returns result of report query `result_name` that failed with
+        `exception`."""
+
+        logger = get_logger()
+        logger.error("report query '%s' failed: %s"
+                     % (result_name, exception))
+
+        return {
+            "error": "query_error",
+            "message": str(exception),
+            "type": exception.__class__.__name__
+        }
+
+    def _concurrent_report(self, cell, queries, workers, timeout):
+        """Executes `queries` concurrently on a pool of at most `workers`
+        threads. Queries that fail with `report_query_errors` or do not
+        finish within `timeout` seconds from their start do not fail the
+        whole report – their result is a dictionary with keys ``error`` and
+        ``message`` instead. Queries
+        waiting for a worker thread are not limited by the timeout."""
+
+        pool = ThreadPool(min(workers, len(queries)))
+        started = {}
+        pending = OrderedDict()
+
+        def fetch(result_name, query):
+            started[result_name] = time.time()
+            return self._fetch_report_query(cell, query)
+
+        for result_name, query in queries.items():
+            pending[result_name] = pool.apply_async(fetch,
+                                                    (result_name, query))
+
+        pool.close()
+
+        report_result = {}
+        timed_out = False
+
+        while pending:
+            now = time.time()
+
+            for result_name, async_result in list(pending.items()):
+                if async_result.ready():
+                    try:
+                        result = async_result.get()
+                    except self.report_query_errors as e:
+                        result = self._report_query_error(result_name, e)
+
+                elif timeout is not None and result_name in started \
+                        and now - started[result_name] >= timeout:
+                    # The worker thread keeps running until the database
+                    # finishes the query, the result is discarded
+                    timed_out = True
+                    logger = get_logger()
+                    logger.warning("report query '%s' did not finish in %s "
+                                   "seconds, its result will be discarded"
+                                   % (result_name, timeout))
+                    result = {
+                        "error": "timeout",
+                        "message": "Query did not finish in %s seconds"
+                                   % timeout,
+                        "type": "TimeoutError"
+                    }
+                else:
+                    continue
+
+                report_result[result_name] = result
+                del pending[result_name]
+
+            if not pending:
+                break
+
+            # Wait for the first pending query, but not longer than until the
+            # nearest timeout of the running queries
+            wait = REPORT_POLL_INTERVAL
+            if timeout is not None:
+                deadlines = [started[name] + timeout - now
+                             for name in pending if name in started]
+                if deadlines:
+                    wait = max(min(min(deadlines), wait), 0)
+
+            next(iter(pending.values())).wait(wait)
+
+        # Do not wait for the queries that did not finish in time. The worker
+        # threads end as soon as their queries are done.
+        if not timed_out:
+            pool.join()
 
         return report_result
 
@@ -653,6 +999,99 @@ class Facts(object):
 TableRow = namedtuple("TableRow", ["key", "label", "path", "is_base", "record"])
 
 
+class ResultRow(object):
+    """Lightweight result record – a sequence of values with a label index
+    shared by all the rows of a result. The row behaves as a read-mostly
+    dictionary: values are accessed by labels with ``row[label]`` or
+    ``row.get(label)``. Use :meth:`to_dict` to get a plain dictionary.
+
+    `values` is a sequence of row values (such as a database cursor row),
+    `index` is a dictionary that maps labels to positions in the `values`.
+
+    Setting a value of an unknown label (for example by post-aggregation
+    calculators) adds the label to the shared index, other rows return
+    ``None`` for the new label until it is set.
+
+    .. versionadded:: 1.2
+    """
+
+    __slots__ = ("_values", "_index")
+
+    def __init__(self, values, index):
+        self._values = values
+        self._index = index
+
+    @classmethod
+    def index_for_labels(cls, labels):
+        """Returns a label index for list of `labels`"""
+        return dict((label, i) for i, label in enumerate(labels))
+
+    def __getitem__(self, label):
+        i = self._index[label]
+        try:
+            return self._values[i]
+        except IndexError:
+            return None
+
+    def get(self, label, default=None):
+        i = self._index.get(label)
+        if i is None or i >= len(self._values):
+            return default
+        return self._values[i]
+
+    def __setitem__(self, label, value):
+        i = self._index.get(label)
+
+        if i is None:
+            # Rows might have unlabelled auxiliary columns (such as the cell
+            # count) after the labelled ones, new values go past the end
+            i = max([len(self._values)]
+                    + [j + 1 for j in self._index.values()])
+            self._index[label] = i
+
+        if not isinstance(self._values, list):
+            self._values = list(self._values)
+
+        if i >= len(self._values):
+            self._values.extend([None] * (i - len(self._values) + 1))
+
+        self._values[i] = value
+
+    def __contains__(self, label):
+        return label in self._index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return sorted(self._index, key=self._index.get)
+
+    def values(self):
+        return [self.get(label) for label in self.keys()]
+
+    def items(self):
+        return [(label, self.get(label)) for label in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, ResultRow):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "ResultRow({!r})".format(self.to_dict())
+
+
 class CalculatedResultIterator(object):
     """
     Iterator that decorates data items
@@ -683,11 +1122,15 @@ class AggregationResult(object):
     * `cells` - list of cells that were drilled-down
     * `total_cell_count` - number of total cells in drill-down (after limit,
       before pagination)
+    * `total_cell_count_approximate` – ``True`` if the `total_cell_count`
+      is an estimate
     * `aggregates` – aggregates that were selected in aggregation. List of
     `MeasureAggregate` objects.
     * `remainder` - summary of remaining cells (not yet implemented)
     * `levels` – aggregation levels for dimensions that were used to drill-
       down
+    * `continuation` – token for the next page of drill-down cells when
+      keyset pagination is used, ``None`` otherwise or on the last page
 
     .. note::
 
@@ -730,9 +1173,11 @@ class AggregationResult(object):
         self.summary = {}
         self._cells = []
         self.total_cell_count = None
+        self.total_cell_count_approximate = False
         self.remainder = {}
         self.labels = []
         self.calculators = []
+        self.continuation = None
 
     @property
     def cells(self):
@@ -745,6 +1190,34 @@ class AggregationResult(object):
             val = CalculatedResultIterator(self.calculators, iter(val))
         self._cells = val
 
+    def payload(self):
+        """Returns a dictionary with the fetched data of the result: summary,
+        cells, cell count, remainder, labels and continuation token. The
+        payload does not refer to any model objects and can be pickled.
+        Cells should be a list, not an iterator."""
+
+        return {
+            "summary": self.summary,
+            "cells": self.cells,
+            "total_cell_count": self.total_cell_count,
+            "total_cell_count_approximate": self.total_cell_count_approximate,
+            "remainder": self.remainder,
+            "labels": self.labels,
+            "continuation": self.continuation
+        }
+
+    def restore(self, payload):
+        """Sets the result data from `payload` created by `payload()`."""
+
+        self.summary = payload["summary"]
+        self.total_cell_count = payload["total_cell_count"]
+        self.total_cell_count_approximate = \
+                payload["total_cell_count_approximate"]
+        self.remainder = payload["remainder"]
+        self.labels = payload["labels"]
+        self.continuation = payload["continuation"]
+        self.cells = payload["cells"]
+
     def to_dict(self):
         """Return dictionary representation of the aggregation result. Can be
         used for JSON serialisation."""
@@ -755,6 +1228,9 @@ class AggregationResult(object):
         d["remainder"] = self.remainder
         d["cells"] = self.cells
         d["total_cell_count"] = self.total_cell_count
+        if self.total_cell_count_approximate:
+            d["total_cell_count_approximate"] = True
+        d["continuation"] = self.continuation
 
         d["aggregates"] = [str(m) for m in self.aggregates]
 
@@ -852,9 +1328,16 @@ class AggregationResult(object):
         result = AggregationResult()
         result.cell = self.cell
         result.aggregates = self.aggregates
+        result.drilldown = self.drilldown
+        result.attributes = self.attributes
+        result.has_split = self.has_split
+        result.labels = self.labels
         result.levels = self.levels
         result.summary = self.summary
         result.total_cell_count = self.total_cell_count
+        result.total_cell_count_approximate = \
+                self.total_cell_count_approximate
+        result.continuation = self.continuation
         result.remainder = self.remainder
 
         # Cache cells from an iterator
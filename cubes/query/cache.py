@@ -0,0 +1,754 @@
+# -*- coding: utf-8 -*-
+"""Cache of aggregation results."""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import os.path
+import pickle
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from ..errors import ArgumentError
+from ..logging import get_logger
+from .computation import rollup_records, sort_records
+from .. import compat
+
+
+__all__ = [
+    "ResultCache",
+    "MemoryResultCache",
+    "FilesystemResultCache",
+    "aggregate_cache_key",
+    "rollup_cache_key",
+]
+
+
+# Aggregation options that change the result and have to be part of the key
+KEY_OPTIONS = ("row_format", "continuation")
+
+DEFAULT_MEMORY_CACHE_SIZE = 1000
+# Maximal size of the pickled results in the memory cache in bytes
+DEFAULT_MEMORY_CACHE_MAX_SIZE = 100 * 1024 * 1024
+
+# Minimal number of seconds between two watermark probes of a cube
+DEFAULT_WATERMARK_INTERVAL = 60
+
+# Maximal number of cached results of one cell considered for roll-up
+ROLLUP_SOURCE_LIMIT = 16
+
+
+def _canonical_path(path):
+    """Returns cut `path` with all values as strings – the same path can be
+    specified with integers or with strings parsed from an URL."""
+
+    if path is None:
+        return None
+
+    return [compat.to_unicode(value) for value in path]
+
+
+def _canonical_cell(cell):
+    """Returns a list of dictionaries describing cuts of `cell` ordered
+    independently of the order of the cuts."""
+
+    if cell is None:
+        return None
+
+    cuts = []
+    for cut in cell.cuts:
+        cut = dict(cut.to_dict())
+        for key in ("path", "from", "to"):
+            if key in cut:
+                cut[key] = _canonical_path(cut[key])
+        if "paths" in cut:
+            cut["paths"] = [_canonical_path(path) for path in cut["paths"]]
+        cuts.append(cut)
+
+    return sorted(cuts, key=lambda cut: json.dumps(cut, sort_keys=True))
+
+
+def _canonical_drilldown(drilldown):
+    """Returns a list of tuples (`dimension`, `hierarchy`, `levels`) with
+    names of the `drilldown` items or `None` for no drilldown."""
+
+    if not drilldown:
+        return None
+
+    return [(str(item.dimension),
+             str(item.hierarchy),
+             [str(level) for level in item.levels])
+            for item in drilldown]
+
+
+def aggregate_cache_key(cube, cell, aggregates, drilldown=None, split=None,
+                        order=None, page=None, page_size=None, locale=None,
+                        options=None):
+    """Returns a cache key of an aggregation query – hexadecimal hash of the
+    canonical description of the query. `cell` and `split` are `Cell`
+    objects, `drilldown` is a `Drilldown` object, `aggregates` and `order`
+    are prepared by the browser. `options` are aggregation options, only
+    those affecting the result are included in the key."""
+
+    options = options or {}
+
+    description = {
+        "cube": str(cube),
+        "locale": locale,
+        "cell": _canonical_cell(cell),
+        "aggregates": [str(aggregate) for aggregate in aggregates],
+        "drilldown": _canonical_drilldown(drilldown),
+        "split": _canonical_cell(split),
+        "order": [(str(attribute), direction)
+                  for (attribute, direction) in order or []],
+        "page": page,
+        "page_size": page_size,
+        "options": dict((key, options.get(key)) for key in KEY_OPTIONS)
+    }
+
+    string = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
+def rollup_cache_key(cube, cell, locale=None, options=None):
+    """Returns a cache key of the list of cached results of `cell` that can
+    be used to roll-up coarser aggregations, see
+    :meth:`ResultCache.add_rollup_source`."""
+
+    key = aggregate_cache_key(cube, cell, [], locale=locale, options=options)
+    return "rollup-" + key
+
+
+def _can_rollup(source, drilldown, aggregates):
+    """Returns `True` if aggregation by `drilldown` of `aggregates` can be
+    computed from the `source` – a roll-up source description."""
+
+    functions = source["functions"]
+
+    for aggregate in aggregates:
+        if not functions.get(str(aggregate)):
+            return False
+
+    source_items = dict((dimension, (hierarchy, levels))
+                        for (dimension, hierarchy, levels)
+                        in source["drilldown"] or [])
+
+    for (dimension, hierarchy, levels) in _canonical_drilldown(drilldown) or []:
+        if dimension not in source_items:
+            return False
+
+        (source_hierarchy, source_levels) = source_items[dimension]
+
+        if source_hierarchy != hierarchy \
+                or source_levels[:len(levels)] != levels:
+            return False
+
+    return True
+
+
+def _rollup_payload(payload, source, drilldown, aggregates):
+    """Returns result payload of aggregation by `drilldown` of `aggregates`
+    rolled-up from the cached `payload` of the `source`."""
+
+    refs = [str(aggregate) for aggregate in aggregates]
+    functions = dict((ref, source["functions"][ref]) for ref in refs)
+
+    summary = payload["summary"]
+
+    if summary and all(ref in summary for ref in refs):
+        summary = dict((ref, summary[ref]) for ref in refs)
+    elif not drilldown:
+        summary = rollup_records(payload["cells"], [], functions)[0]
+    else:
+        summary = {}
+
+    rolled = {
+        "summary": summary,
+        "cells": [],
+        "total_cell_count": None,
+        "total_cell_count_approximate": False,
+        "remainder": {},
+        "labels": [],
+        "continuation": None
+    }
+
+    if drilldown:
+        keys = [attr.ref for attr in drilldown.all_attributes]
+        cells = rollup_records(payload["cells"], keys, functions)
+
+        # Roll-up keeps the order of the source cells, the order of the
+        # aggregation by the coarser drilldown is required
+        order = [(attr.ref, direction) for (attr, direction)
+                 in drilldown.natural_order if attr.ref in keys]
+        cells = sort_records(cells, order)
+
+        rolled["cells"] = cells
+        rolled["total_cell_count"] = len(cells)
+        rolled["labels"] = keys + refs
+
+    return rolled
+
+
+class _Flight(object):
+    """Computation of a value shared by concurrent callers, see
+    :meth:`ResultCache.single_flight`."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache(object):
+    """Cache of aggregation results. Values are stored pickled, therefore
+    every cache hit returns a fresh copy of the cached value.
+
+    Subclasses should implement `load()`, `store()`, `remove()` and
+    `clear()`.
+
+    Options:
+
+    * `ttl` – time to live of cached values in seconds. Values do not
+      expire if not specified.
+    * `cube_ttl` – time to live per cube, overrides `ttl`. A dictionary or a
+      string ``cube:seconds, cube:seconds, ...``. TTL ``0`` disables caching
+      of the cube results.
+    * `watermark_interval` – minimal number of seconds between two probes
+      of a cube watermark, default is 60. See `watermark()`.
+    * `stale_grace` – number of seconds an expired value is still served
+      while it is being refreshed in the background. See `lookup()`.
+
+    .. versionadded:: 1.2
+    """
+
+    __extension_type__ = "result_cache"
+    __extension_suffix__ = "ResultCache"
+
+    def __init__(self, ttl=None, cube_ttl=None, watermark_interval=None,
+                 stale_grace=None, **options):
+        super(ResultCache, self).__init__()
+
+        self.logger = get_logger()
+
+        self.ttl = float(ttl) if ttl is not None else None
+
+        if isinstance(cube_ttl, compat.string_type):
+            pairs = [item.split(":") for item in cube_ttl.split(",")
+                     if item.strip()]
+            try:
+                cube_ttl = dict((name.strip(), float(value))
+                                for (name, value) in pairs)
+            except ValueError:
+                raise ArgumentError("Invalid cube TTL specification '{}'. "
+                                    "Should be: cube:seconds, ..."
+                                    .format(cube_ttl))
+
+        self.cube_ttl = dict(cube_ttl or {})
+
+        if watermark_interval is None:
+            watermark_interval = DEFAULT_WATERMARK_INTERVAL
+        self.watermark_interval = float(watermark_interval)
+
+        self.stale_grace = float(stale_grace or 0)
+
+        # Last known watermarks: cube -> (watermark, time of the probe)
+        self._watermarks = {}
+        self._watermark_lock = threading.Lock()
+
+        # Computations in progress: (cube, key) -> _Flight
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def cube_ttl_for(self, cube):
+        """Returns time to live of results of cube `cube` (name)."""
+        return self.cube_ttl.get(cube, self.ttl)
+
+    def get(self, key, cube=None, watermark=None):
+        """Returns value for `key` of `cube` (name) or `None` if the value is
+        not cached, is expired or was cached at a different `watermark`."""
+
+        (value, stale) = self.lookup(key, cube, watermark)
+
+        return None if stale else value
+
+    def lookup(self, key, cube=None, watermark=None):
+        """Returns a tuple (`value`, `stale`) for `key` of `cube` (name).
+        `stale` is `True` if the value is expired, but still within the
+        `stale_grace` period – it can be served while being refreshed. Value
+        is `None` if it is not cached, expired beyond the grace period or was
+        cached at a different `watermark`."""
+
+        data = self.load(key, cube)
+
+        if data is None:
+            return (None, False)
+
+        (expires, value_watermark, value) = pickle.loads(data)
+
+        stale = False
+
+        if expires is not None and expires < time.time():
+            if expires + self.stale_grace < time.time():
+                self.remove(key, cube)
+                return (None, False)
+            stale = True
+
+        # Value cached at different state of the data. Another process
+        # might know more recent watermark, therefore the value is not
+        # removed, just ignored.
+        if value_watermark != watermark:
+            return (None, False)
+
+        return (value, stale)
+
+    def set(self, key, value, cube=None, watermark=None):
+        """Caches `value` under `key` for `cube` (name). `watermark` is the
+        current watermark of the cube, if used."""
+
+        ttl = self.cube_ttl_for(cube)
+
+        if ttl is not None and ttl <= 0:
+            return
+
+        expires = time.time() + ttl if ttl is not None else None
+        data = pickle.dumps((expires, watermark, value),
+                            pickle.HIGHEST_PROTOCOL)
+
+        self.store(key, data, cube)
+
+    def watermark(self, cube, probe):
+        """Returns the watermark of `cube` (name) – a value that changes
+        whenever the cube data change, such as maximal fact key or a version
+        maintained by the ETL. `probe` is a function returning the current
+        watermark, it is called at most once per `watermark_interval`
+        seconds. When the watermark moves, all the results of the cube are
+        removed from the cache.
+
+        Cached values are tagged by the watermark, therefore values cached
+        by other processes sharing the cache before the data change are not
+        used either."""
+
+        now = time.time()
+
+        with self._watermark_lock:
+            (last, checked) = self._watermarks.get(cube, (None, None))
+
+            if checked is not None:
+                if now - checked < self.watermark_interval:
+                    return last
+
+                # Other threads use the last known watermark while probing
+                self._watermarks[cube] = (last, now)
+
+        current = probe()
+
+        with self._watermark_lock:
+            self._watermarks[cube] = (current, now)
+
+        if checked is not None and current != last:
+            self.logger.info("watermark of cube '%s' moved, removing cached "
+                             "results" % (cube, ))
+            self.invalidate(cube)
+
+        return current
+
+    def single_flight(self, key, cube, function):
+        """Returns result of `function` computing the value for `key` of
+        `cube`. Concurrent callers with the same key within this process
+        wait for the first caller instead of calling the function
+        themselves and receive a copy of its result. Exception raised by the
+        function is raised in all the callers."""
+
+        flight_key = (cube, key)
+
+        with self._flights_lock:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[flight_key] = flight
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return pickle.loads(flight.value)
+
+        try:
+            value = function()
+            flight.value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[flight_key]
+            flight.event.set()
+
+        return value
+
+    def refresh(self, key, cube, function):
+        """Calls `function` in a background thread to refresh a stale value
+        for `key` of `cube`, unless the value is already being computed.
+        Returns the thread or `None`. The function is expected to store the
+        value in the cache, errors are only logged – the stale value keeps
+        being served until the grace period is over."""
+
+        with self._flights_lock:
+            if (cube, key) in self._flights:
+                return None
+
+        def refresh_value():
+            try:
+                self.single_flight(key, cube, function)
+            except Exception as e:
+                self.logger.error("refresh of cached result of cube '%s' "
+                                  "failed: %s" % (cube, e))
+
+        thread = threading.Thread(target=refresh_value)
+        thread.daemon = True
+        thread.start()
+
+        return thread
+
+    def add_rollup_source(self, rollup_key, key, drilldown, functions,
+                          cube=None, watermark=None):
+        """Registers cached complete (not paginated) result with `key` as a
+        source for roll-up of coarser aggregations of the same cell.
+        `rollup_key` is the key from :func:`rollup_cache_key`, `drilldown`
+        is the result drilldown and `functions` is a dictionary of roll-up
+        function names (``sum``, ``min``, ``max``) by aggregate reference.
+        Aggregates that can not be rolled-up should have no function."""
+
+        source = {
+            "key": key,
+            "drilldown": _canonical_drilldown(drilldown),
+            "functions": dict(functions)
+        }
+
+        sources = self.get(rollup_key, cube, watermark) or []
+        sources = [item for item in sources if item["key"] != key]
+        sources.insert(0, source)
+
+        self.set(rollup_key, sources[:ROLLUP_SOURCE_LIMIT], cube, watermark)
+
+    def rollup(self, rollup_key, drilldown, aggregates, cube=None,
+               watermark=None):
+        """Returns a result payload for aggregation by `drilldown` of
+        `aggregates` computed from a cached finer result registered under
+        `rollup_key` or `None` if there is no such result. Only aggregates
+        with roll-up functions (additive aggregates) are computed."""
+
+        sources = self.get(rollup_key, cube, watermark)
+
+        for source in sources or []:
+            if not _can_rollup(source, drilldown, aggregates):
+                continue
+
+            payload = self.get(source["key"], cube, watermark)
+
+            if payload is None:
+                continue
+
+            return _rollup_payload(payload, source, drilldown, aggregates)
+
+        return None
+
+    def invalidate(self, cube=None):
+        """Removes all cached results of `cube` or all results if `cube` is
+        not specified."""
+        self.clear(cube)
+
+    def load(self, key, cube=None):
+        """Returns pickled data for `key` or `None`. Subclasses should
+        implement this method."""
+        raise NotImplementedError
+
+    def store(self, key, data, cube=None):
+        """Stores pickled `data` under `key`. Subclasses should implement
+        this method."""
+        raise NotImplementedError
+
+    def remove(self, key, cube=None):
+        """Removes value for `key`. Subclasses should implement this
+        method."""
+        raise NotImplementedError
+
+    def clear(self, cube=None):
+        """Removes all values of `cube` or all values. Subclasses should
+        implement this method."""
+        raise NotImplementedError
+
+
+class MemoryResultCache(ResultCache):
+    """Result cache in the process memory. The least recently used results
+    are evicted when there are more than `size` results, default is 1000,
+    or when the total size of the pickled results exceeds `max_size` bytes,
+    default is 100 MiB. Results larger than `max_size` are not cached."""
+
+    __options__ = [
+        {
+            "name": "size",
+            "description": "Maximal number of cached results",
+            "type": "int"
+        },
+        {
+            "name": "max_size",
+            "description": "Maximal size of the cached results in bytes",
+            "type": "int"
+        },
+        {
+            "name": "ttl",
+            "description": "Time to live of cached results in seconds",
+            "type": "float"
+        },
+        {
+            "name": "cube_ttl",
+            "description": "Time to live per cube: cube:seconds, ...",
+            "type": "string"
+        },
+        {
+            "name": "watermark_interval",
+            "description": "Seconds between probes of cube watermarks",
+            "type": "float"
+        },
+        {
+            "name": "stale_grace",
+            "description": "Seconds an expired result is served while "
+                           "being refreshed",
+            "type": "float"
+        }
+    ]
+
+    def __init__(self, size=None, max_size=None, **options):
+        super(MemoryResultCache, self).__init__(**options)
+
+        if size is None:
+            size = DEFAULT_MEMORY_CACHE_SIZE
+        if max_size is None:
+            max_size = DEFAULT_MEMORY_CACHE_MAX_SIZE
+
+        self.size = int(size)
+        self.max_size = int(max_size)
+
+        # Pickled data by (cube, key) from the least recently used
+        self.values = OrderedDict()
+        self.total_size = 0
+        self._lock = threading.Lock()
+
+    def load(self, key, cube=None):
+        with self._lock:
+            data = self.values.pop((cube, key), None)
+            if data is not None:
+                self.values[(cube, key)] = data
+
+        return data
+
+    def store(self, key, data, cube=None):
+        with self._lock:
+            self._pop((cube, key))
+
+            if len(data) > self.max_size or self.size <= 0:
+                return
+
+            self.values[(cube, key)] = data
+            self.total_size += len(data)
+
+            while len(self.values) > self.size \
+                    or self.total_size > self.max_size:
+                (_, evicted) = self.values.popitem(last=False)
+                self.total_size -= len(evicted)
+
+    def _pop(self, item):
+        data = self.values.pop(item, None)
+        if data is not None:
+            self.total_size -= len(data)
+
+    def remove(self, key, cube=None):
+        with self._lock:
+            self._pop((cube, key))
+
+    def clear(self, cube=None):
+        with self._lock:
+            if cube is None:
+                self.values.clear()
+                self.total_size = 0
+            else:
+                for item in list(self.values.keys()):
+                    if item[0] == cube:
+                        self._pop(item)
+
+
+class FilesystemResultCache(ResultCache):
+    """Result cache in files of directory `path`. Results of each cube are
+    stored in a separate subdirectory. The least recently used results are
+    removed when the total size of the files exceeds `max_size` bytes, if
+    specified. The cache can be shared by multiple processes."""
+
+    __options__ = [
+        {
+            "name": "path",
+            "description": "Cache directory",
+            "type": "string"
+        },
+        {
+            "name": "max_size",
+            "description": "Maximal size of the cache in bytes",
+            "type": "int"
+        },
+        {
+            "name": "ttl",
+            "description": "Time to live of cached results in seconds",
+            "type": "float"
+        },
+        {
+            "name": "cube_ttl",
+            "description": "Time to live per cube: cube:seconds, ...",
+            "type": "string"
+        },
+        {
+            "name": "watermark_interval",
+            "description": "Seconds between probes of cube watermarks",
+            "type": "float"
+        },
+        {
+            "name": "stale_grace",
+            "description": "Seconds an expired result is served while "
+                           "being refreshed",
+            "type": "float"
+        }
+    ]
+
+    suffix = ".pickle"
+
+    def __init__(self, path=None, max_size=None, **options):
+        super(FilesystemResultCache, self).__init__(**options)
+
+        if not path:
+            raise ArgumentError("Filesystem result cache requires a path")
+
+        self.path = path
+        self.max_size = int(max_size) if max_size else None
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self._lock = threading.Lock()
+        self._size = None
+
+    def _cube_directory(self, cube):
+        if cube is None:
+            name = "_"
+        else:
+            name = hashlib.sha1(compat.to_unicode(cube)
+                                .encode("utf-8")).hexdigest()
+
+        return os.path.join(self.path, name)
+
+    def _file_path(self, key, cube):
+        return os.path.join(self._cube_directory(cube), key + self.suffix)
+
+    def _files(self, cube=None):
+        """Returns a list of tuples (`path`, `modified`, `size`) of cached
+        files of `cube` or of all files."""
+
+        if cube is None:
+            directories = [os.path.join(self.path, name)
+                           for name in os.listdir(self.path)]
+        else:
+            directories = [self._cube_directory(cube)]
+
+        files = []
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+
+            for name in os.listdir(directory):
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_mtime, stat.st_size))
+
+        return files
+
+    def load(self, key, cube=None):
+        path = self._file_path(key, cube)
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Mark as recently used
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+
+        return data
+
+    def store(self, key, data, cube=None):
+        directory = self._cube_directory(cube)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another thread or process
+                pass
+
+        # Write to a temporary file first, so readers never see a partially
+        # written file
+        (handle, temp_path) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        os.rename(temp_path, self._file_path(key, cube))
+
+        if self.max_size:
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(size for (_, _, size) in self._files())
+                else:
+                    self._size += len(data)
+
+                if self._size > self.max_size:
+                    self._evict()
+
+    def _evict(self):
+        """Removes the least recently used files until the cache fits into
+        the `max_size`."""
+
+        files = sorted(self._files(), key=lambda item: item[1])
+        total = sum(size for (_, _, size) in files)
+
+        for (path, _, size) in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+        self._size = total
+
+    def remove(self, key, cube=None):
+        try:
+            os.remove(self._file_path(key, cube))
+        except OSError:
+            pass
+
+    def clear(self, cube=None):
+        for (path, _, _) in self._files(cube):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        with self._lock:
+            self._size = None
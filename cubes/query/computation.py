@@ -3,13 +3,20 @@
 from __future__ import absolute_import
 
 import itertools
+import math
+
+from collections import OrderedDict
 
 from ..errors import ArgumentError
 
 __all__ = [
     "combined_cuboids",
     "combined_levels",
-    "hierarchical_cuboids"
+    "hierarchical_cuboids",
+    "rollup_records",
+    "sort_records",
+    "estimate_distinct_count",
+    "select_cuboids",
 ]
 
 def combined_cuboids(dimensions, required=None):
@@ -69,3 +76,160 @@ def hierarchical_cuboids(dimensions, required=None, default_only=False):
 
     return result
 
+
+def _rollup_value(function, values):
+    """Combines pre-aggregated `values` with roll-up `function`."""
+
+    values = [value for value in values if value is not None]
+
+    if function == "sum":
+        return sum(values)
+    elif not values:
+        return None
+    elif function == "min":
+        return min(values)
+    elif function == "max":
+        return max(values)
+    else:
+        raise ArgumentError("Unknown roll-up function '%s'" % function)
+
+
+def rollup_records(records, keys, functions):
+    """Rolls-up `records` of a finer aggregation – dictionaries (or
+    dictionary-like objects) with attribute and aggregate references as
+    keys – to the attributes `keys`. `functions` is a dictionary where keys
+    are aggregate references and values are names of the roll-up functions:
+    ``sum``, ``min`` or ``max``. Returns a list of dictionaries with the
+    `keys` and the aggregates in order of the first occurence of the key
+    values.
+
+    As an aggregation without grouping, roll-up to no `keys` always results
+    in one record, even if there are no `records`."""
+
+    groups = OrderedDict()
+
+    for record in records:
+        key = tuple(record[name] for name in keys)
+        groups.setdefault(key, []).append(record)
+
+    if not keys and not groups:
+        groups[()] = []
+
+    result = []
+
+    for key, group in groups.items():
+        rolled = dict(zip(keys, key))
+        for (ref, function) in functions.items():
+            values = [record[ref] for record in group]
+            rolled[ref] = _rollup_value(function, values)
+        result.append(rolled)
+
+    return result
+
+
+def sort_records(records, order):
+    """Returns a list of `records` – dictionaries (or dictionary-like
+    objects) – sorted by `order`, a list of tuples (`key`, `direction`)
+    where `direction` is ``asc`` or ``desc``. ``None`` values are sorted
+    before other values in ascending order and after them in descending
+    order. Records with equal values keep their order."""
+
+    result = list(records)
+
+    # Stable sort by the least significant key first
+    for (key, direction) in reversed(order):
+        result.sort(key=lambda record: (record[key] is not None,
+                                        record[key]),
+                    reverse=(direction == "desc"))
+
+    return result
+
+
+def estimate_distinct_count(counts, population):
+    """Estimates number of distinct values in a population of `population`
+    items from a uniform random sample. `counts` is a list of numbers of
+    occurences of every distinct value in the sample. Uses the
+    Guaranteed-Error Estimator (Charikar et al., 2000): values seen once in
+    the sample are scaled by the square root of the sampling ratio, values
+    seen more times are counted once. If the sample contains the whole
+    population, the count is exact."""
+
+    sample_size = sum(counts)
+
+    if not sample_size:
+        return 0
+    elif sample_size >= population:
+        return len(counts)
+
+    singles = sum(1 for count in counts if count == 1)
+    estimate = math.sqrt(float(population) / sample_size) * singles \
+                + (len(counts) - singles)
+
+    return int(min(round(estimate), population))
+
+
+def select_cuboids(sizes, queries, base_cost, answers, budget=None,
+                   limit=None):
+    """Selects cuboids to be materialized using the greedy view selection
+    algorithm (Harinarayan, Rajaraman and Ullman, 1996) with a linear cost
+    model – cost of a query is the number of rows of the smallest selected
+    cuboid that can answer it.
+
+    * `sizes` – dictionary where keys are candidate cuboids and values are
+      their (estimated) number of rows
+    * `queries` – dictionary where keys are queries and values are their
+      frequencies
+    * `base_cost` – cost of a query that can not be answered by any
+      selected cuboid, usually the number of facts
+    * `answers` – function (`cuboid`, `query`) that returns `True` if the
+      `cuboid` can answer the `query`
+    * `budget` – maximal total number of rows of the selected cuboids
+    * `limit` – maximal number of selected cuboids
+
+    In each step the cuboid with the largest benefit – the decrease of the
+    total cost of all queries – per row is selected, until there is no
+    cuboid with a benefit that fits into the budget. Returns a list of
+    tuples (`cuboid`, `benefit`) in the order of selection."""
+
+    costs = dict((query, base_cost) for query in queries)
+    answered = dict((cuboid, [query for query in queries
+                              if answers(cuboid, query)])
+                    for cuboid in sizes)
+
+    remaining = budget
+    selected = []
+
+    while limit is None or len(selected) < limit:
+        best = None
+        chosen = set(cuboid for (cuboid, _) in selected)
+
+        for cuboid, size in sizes.items():
+            if cuboid in chosen \
+                    or (remaining is not None and size > remaining):
+                continue
+
+            benefit = sum(queries[query] * (costs[query] - size)
+                          for query in answered[cuboid]
+                          if costs[query] > size)
+
+            if benefit <= 0:
+                continue
+
+            ratio = float(benefit) / max(size, 1)
+            if best is None or ratio > best[0]:
+                best = (ratio, benefit, cuboid)
+
+        if best is None:
+            break
+
+        (_, benefit, cuboid) = best
+        size = sizes[cuboid]
+
+        selected.append((cuboid, benefit))
+        if remaining is not None:
+            remaining -= size
+
+        for query in answered[cuboid]:
+            costs[query] = min(costs[query], size)
+
+    return selected
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import sys
 import traceback
@@ -11,7 +12,9 @@ from ..workspace import Workspace, SLICER_INFO_KEYS
 from ..query import Cell, cut_from_dict
 from ..query import SPLIT_DIMENSION_NAME
 from ..errors import *
-from ..formatters import JSONLinesGenerator, csv_generator
+from ..formatters import JSONLinesGenerator, SlicerJSONEncoder
+from ..formatters import csv_generator
+from ..datastructures import LRUCache
 from .. import ext
 from ..logging import get_logger
 from .logging import configured_request_log_handlers, RequestLogger
@@ -46,6 +49,13 @@ API_VERSION = 2
 # Cross-origin resource sharing – 20 days cache
 CORS_MAX_AGE = 1728000
 
+# Response header with the token of the next page (keyset pagination)
+CONTINUATION_HEADER = "X-Cubes-Continuation"
+
+# Endpoints with conditional responses (ETag) and configurable
+# Cache-Control max-age
+CACHEABLE_ENDPOINTS = ("info", "cubes", "model", "aggregate")
+
 slicer = Blueprint("slicer", __name__, template_folder="templates")
 
 # Before
@@ -77,6 +87,38 @@ def _store_option(config, option, default, type_=None, allowed=None,
     setattr(current_app.slicer, option, value)
 
 
+def _parse_max_age(value):
+    """Returns a dictionary of Cache-Control max-age per endpoint from the
+    option `value` – a list of ``endpoint:seconds`` items. An item without
+    endpoint name is the default for all the cacheable endpoints."""
+
+    result = {}
+
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+
+        if ":" in item:
+            (endpoint, seconds) = item.split(":", 1)
+            endpoint = endpoint.strip()
+        else:
+            (endpoint, seconds) = (None, item)
+
+        if endpoint is not None and endpoint not in CACHEABLE_ENDPOINTS:
+            raise ConfigurationError("Unknown cacheable endpoint '%s', "
+                                     "should be one of: %s"
+                                     % (endpoint,
+                                        ", ".join(CACHEABLE_ENDPOINTS)))
+        try:
+            result[endpoint] = int(seconds)
+        except ValueError:
+            raise ConfigurationError("Invalid max-age '%s' of endpoint '%s'"
+                                     % (seconds, endpoint or "*"))
+
+    return result
+
+
 @slicer.record_once
 def initialize_slicer(state):
     """Create the workspace and configure the application context from the
@@ -108,6 +150,14 @@ def initialize_slicer(state):
         _store_option(config, "hide_private_cuts", False, "bool")
         _store_option(config, "allow_cors_origin", None, "str")
         _store_option(config, "visualizer", None, "str")
+        _store_option(config, "metadata_cache_size", 1000, "int")
+        current_app.slicer.metadata_cache = \
+                LRUCache(current_app.slicer.metadata_cache_size)
+        current_app.slicer.metadata_cache_version = None
+
+        _store_option(config, "cache_max_age", None, "str")
+        current_app.slicer.cache_max_age = \
+                _parse_max_age(current_app.slicer.cache_max_age)
 
         _store_option(config, "authentication", "none")
 
@@ -141,6 +191,44 @@ def initialize_slicer(state):
         else:
             current_app.slicer.request_logger = RequestLogger(handlers)
 
+        # Warm-up: prepare cubes and run representative queries before the
+        # first request
+        _store_option(config, "warmup", None, "str")
+        _store_option(config, "warmup_locales", None, "str")
+        _store_option(config, "warmup_queries", None, "str")
+        _store_option(config, "warmup_threads", None, "int")
+
+        cubes = _parse_warmup(current_app.slicer.warmup)
+        if cubes is not False:
+            locales = current_app.slicer.warmup_locales
+            if locales is not None:
+                # Requests without a locale are always warmed-up
+                locales = [None] + [locale.strip()
+                                    for locale in locales.split(",")
+                                    if locale.strip()]
+
+            workspace.warm_up(cubes=cubes,
+                              locales=locales,
+                              queries=current_app.slicer.warmup_queries,
+                              workers=current_app.slicer.warmup_threads)
+
+
+def _parse_warmup(value):
+    """Returns list of cube names to be warmed-up from the `warmup` option
+    `value`, `None` for all cubes or `False` if the warm-up is disabled."""
+
+    if not value:
+        return False
+
+    enabled = str_to_bool(value)
+    if enabled is not None:
+        return None if enabled else False
+    elif value.strip() == "all":
+        return None
+
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
 # Before and After
 # ================
 
@@ -222,6 +310,93 @@ def server_error(e):
 
     return jsonify(error), 500
 
+# Metadata Cache
+# ==============
+
+def cached_jsonify(key, function):
+    """Returns a JSON response with an object returned by `function`. The
+    object is created and serialized only once per `key` and reused by the
+    following requests until the workspace model version changes – for
+    example when :meth:`Workspace.flush_lookup_cache` is called. Used for the
+    model metadata responses. `key` should contain everything the object
+    depends on, such as the identity and the locale."""
+
+    cache = current_app.slicer.metadata_cache
+    version = workspace.model_version
+
+    if current_app.slicer.metadata_cache_version != version:
+        cache.clear()
+        current_app.slicer.metadata_cache_version = version
+
+    key = json.dumps([key, g.prettyprint], default=str)
+    data = cache.get(key)
+
+    if data is None:
+        indent = 4 if g.prettyprint else None
+        data = SlicerJSONEncoder(indent=indent).encode(function())
+        cache[key] = data
+
+    return Response(data, mimetype='application/json')
+
+
+# Conditional Requests
+# ====================
+
+def request_etag(version):
+    """Returns a strong entity tag of the response to the current request
+    for resource `version` or `None` if the version is not known. The tag
+    depends also on the request path, arguments and the identity."""
+
+    if version is None:
+        return None
+
+    description = [
+        version,
+        request.path,
+        sorted(request.args.items(multi=True)),
+        g.auth_identity,
+        __version__
+    ]
+
+    string = json.dumps(description, default=str)
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
+def not_modified_response(endpoint, etag):
+    """Returns ``304 Not Modified`` response if the client already has the
+    response with `etag`, otherwise returns `None`."""
+
+    if etag and etag in request.if_none_match:
+        return cache_headers(Response(status=304), endpoint, etag)
+
+    return None
+
+
+def cache_headers(response, endpoint, etag=None):
+    """Sets ``ETag`` and ``Cache-Control`` headers of `response` of
+    `endpoint`. If `etag` is not specified, it is computed from the body of
+    a JSON response. Returns the response, which might be converted to
+    ``304 Not Modified``."""
+
+    if etag:
+        response.set_etag(etag)
+    elif response.status_code == 200 \
+            and response.mimetype == "application/json":
+        response.add_etag()
+
+    max_ages = current_app.slicer.cache_max_age
+    max_age = max_ages.get(endpoint, max_ages.get(None))
+
+    if max_age is not None:
+        response.cache_control.max_age = max_age
+        if current_app.slicer.authenticator:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+
+    return response.make_conditional(request)
+
+
 # Endpoints
 # =========
 
@@ -276,34 +451,56 @@ def get_info():
 
 @slicer.route("/info")
 def show_info():
-    return jsonify(get_info())
+    etag = request_etag(workspace.model_version)
+    response = not_modified_response("info", etag)
+    if response:
+        return response
+
+    return cache_headers(jsonify(get_info()), "info", etag)
 
 
 @slicer.route("/cubes")
 def list_cubes():
-    cube_list = workspace.list_cubes(g.auth_identity)
-    # TODO: cache per-identity
-    return jsonify(cube_list)
+    etag = request_etag(workspace.model_version)
+    response = not_modified_response("cubes", etag)
+    if response:
+        return response
+
+    def cube_list():
+        return workspace.list_cubes(g.auth_identity)
+
+    response = cached_jsonify(["cubes", g.auth_identity], cube_list)
+    return cache_headers(response, "cubes", etag)
 
 
 @slicer.route("/cube/<cube_name>/model")
 @requires_cube
 def cube_model(cube_name):
+    etag = request_etag(workspace.model_version)
+    response = not_modified_response("model", etag)
+    if response:
+        return response
+
     if workspace.authorizer:
         hier_limits = workspace.authorizer.hierarchy_limits(g.auth_identity,
                                                             cube_name)
     else:
         hier_limits = None
 
-    response = g.cube.to_dict(expand_dimensions=True,
-                              with_mappings=False,
-                              full_attribute_names=True,
-                              create_label=True,
-                              hierarchy_limits=hier_limits)
+    def cube_dict():
+        result = g.cube.to_dict(expand_dimensions=True,
+                                with_mappings=False,
+                                full_attribute_names=True,
+                                create_label=True,
+                                hierarchy_limits=hier_limits)
+
+        result["features"] = workspace.cube_features(g.cube)
+        return result
 
-    response["features"] = workspace.cube_features(g.cube)
+    key = ["model", cube_name, g.auth_identity, g.locale, hier_limits]
+    response = cached_jsonify(key, cube_dict)
 
-    return jsonify(response)
+    return cache_headers(response, "model", etag)
 
 
 @slicer.route("/cube/<cube_name>/aggregate")
@@ -342,20 +539,47 @@ def aggregate(cube_name):
 
     prepare_cell("split", "split")
 
-    result = g.browser.aggregate(g.cell,
-                                 aggregates=aggregates,
-                                 drilldown=drilldown,
-                                 split=g.split,
-                                 page=g.page,
-                                 page_size=g.page_size,
-                                 order=g.order)
+    # CSV rows are written directly as they are fetched, no need for a
+    # dictionary per cell
+    if output_format == "csv":
+        row_format = "row"
+        stream = True
+    else:
+        row_format = None
+        stream = None
+
+    query = {
+        "aggregates": aggregates,
+        "drilldown": drilldown,
+        "split": g.split,
+        "page": g.page,
+        "page_size": g.page_size,
+        "order": g.order,
+        "row_format": row_format,
+        "continuation": request.args.get("continuation")
+    }
+
+    # Data version is known only if the browser provides a data watermark.
+    # Without a result cache the watermark is probed by a query, which pays
+    # off only for conditional requests – others get an ETag of the body.
+    if g.browser.result_cache is not None or request.if_none_match:
+        etag = request_etag(g.browser.aggregate_version(g.cell, **query))
+    else:
+        etag = None
+    response = not_modified_response("aggregate", etag)
+    if response:
+        return response
+
+    result = g.browser.aggregate(g.cell, stream=stream, **query)
 
     # Hide cuts that were generated internally (default: don't)
     if current_app.slicer.hide_private_cuts:
         result.cell = result.cell.public_cell()
 
     if output_format == "json":
-        return jsonify(result)
+        response = jsonify(result)
+        set_continuation_header(response, result.continuation)
+        return cache_headers(response, "aggregate", etag)
     elif output_format != "csv":
         raise RequestError("unknown response format '%s'" % output_format)
 
@@ -380,9 +604,12 @@ def aggregate(cube_name):
                              header=header)
 
     headers = {"Content-Disposition": 'attachment; filename="aggregate.csv"'}
-    return Response(generator,
-                    mimetype='text/csv',
-                    headers=headers)
+    response = Response(generator,
+                        mimetype='text/csv',
+                        headers=headers)
+    set_continuation_header(response, result.continuation)
+
+    return cache_headers(response, "aggregate", etag)
 
 
 @slicer.route("/cube/<cube_name>/facts")
@@ -405,12 +632,20 @@ def cube_facts(cube_name):
     # Construct the field list
     fields = [attr.ref for attr in attributes]
 
+    # Stream the facts if they are written out as they are fetched
+    if request.args.get("format") in ("csv", "json_lines"):
+        stream = True
+    else:
+        stream = None
+
     # Get the result
     facts = g.browser.facts(g.cell,
                              fields=fields,
                              order=g.order,
                              page=g.page,
-                             page_size=g.page_size)
+                             page_size=g.page_size,
+                             stream=stream,
+                             continuation=request.args.get("continuation"))
 
     # Add cube key to the fields (it is returned in the result)
     fields.insert(0, g.cube.key or "__fact_key__")
@@ -419,7 +654,17 @@ def cube_facts(cube_name):
     labels = [attr.label or attr.name for attr in attributes]
     labels.insert(0, g.cube.key or "__fact_key__")
 
-    return formatted_response(facts, fields, labels)
+    response = formatted_response(facts, fields, labels)
+    set_continuation_header(response, getattr(facts, "continuation", None))
+
+    return response
+
+
+def set_continuation_header(response, continuation):
+    """Sets the keyset pagination token of the next page to the `response`
+    header, if there is any."""
+    if continuation:
+        response.headers[CONTINUATION_HEADER] = continuation
 
 @slicer.route("/cube/<cube_name>/fact/<fact_id>")
 @requires_browser
@@ -621,4 +866,5 @@ def add_cors_headers(response):
         response.headers['Access-Control-Allow-Credentials'] = 'true'
         response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
         response.headers['Access-Control-Max-Age'] = CORS_MAX_AGE
+        response.headers['Access-Control-Expose-Headers'] = CONTINUATION_HEADER
     return response
@@ -76,7 +76,7 @@ class SlicerBrowser(AggregationBrowser):
         return result
 
     def facts(self, cell=None, fields=None, order=None, page=None,
-              page_size=None):
+              page_size=None, **options):
 
         cell = cell or Cell(self.cube)
         if fields:
@@ -83,7 +83,7 @@ def requires_browser(f):
             cube = None
 
         g.cube = cube
-        g.browser = workspace.browser(g.cube)
+        g.browser = workspace.browser(g.cube, identity=g.auth_identity)
 
         prepare_cell(restrict=True)
 
@@ -25,7 +25,8 @@ __all__ = [
     "DefaultRequestLogHandler",
     "CSVFileRequestLogHandler",
     'XLSXFileRequestLogHandler',
-    "QUERY_LOG_ITEMS"
+    "QUERY_LOG_ITEMS",
+    "read_json_request_log",
 ]
 
 
@@ -266,3 +267,14 @@ class JSONRequestLogHandler(RequestLogHandler):
             json.dump(record, f)
             f.write("\n")
 
+
+def read_json_request_log(path):
+    """Yields records of a request log written by `JSONRequestLogHandler`
+    to a file at `path` – dictionaries with keys `cube`, `method`, `cell`,
+    `split`, `drilldown` and others, see `REQUEST_LOG_ITEMS`."""
+
+    with io.open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
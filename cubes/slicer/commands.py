@@ -13,6 +13,7 @@ from __future__ import print_function
 import json
 import os
 import sys
+import time
 import click
 
 from .. import compat
@@ -21,14 +22,16 @@ from ..datastructures import AttributeDict
 from ..errors import InconsistencyError, ArgumentError, InternalError, UserError
 from ..formatters import csv_generator, SlicerJSONEncoder, JSONLinesGenerator, xlsx_generator
 from ..metadata import read_model_metadata, write_model_metadata_bundle, validate_model
+from ..metadata import write_compiled_model
 from ..workspace import Workspace
 from ..errors import CubesError
 from ..server import run_server
+from ..server.logging import read_json_request_log
 from ..config_parser import read_slicer_config
 
 from .. import ext
 
-from ..query import cuts_from_string, Cell
+from ..query import cuts_from_string, path_from_string, Cell
 from ..metadata import string_to_dimension_level
 
 
@@ -309,6 +312,21 @@ def convert(ctx, model_format, force, model_path, target):
     elif model_format == "bundle":
         write_model_metadata_bundle(target, metadata, replace=force)
 
+
+@model.command("compile")
+@click.argument('model_path', metavar='MODEL')
+@click.argument('target')
+@click.pass_context
+def compile_model(ctx, model_path, target):
+    """Compile model into a file that is loaded without linking and
+    validation."""
+
+    metadata = read_model_metadata(model_path)
+    write_compiled_model(target, metadata)
+
+    click.echo("Model compiled to %s" % target)
+
+
 def read_config(cfg):
     """Read the configuration file."""
     return read_slicer_config(cfg)
@@ -324,7 +342,7 @@ def read_config(cfg):
               help="Name of slicer.ini configuration file")
 def sql(ctx, store, config):
     """SQL store commands"""
-    ctx.obj.workspace = cubes.Workspace(config)
+    ctx.obj.workspace = Workspace(config)
     ctx.obj.store = ctx.obj.workspace.get_store(store)
 
 ################################################################################
@@ -336,22 +354,61 @@ def sql(ctx, store, config):
 @click.option('--materialize', '-m', is_flag=True, default=False,
               help='create materialized view (table)')
 @click.option('--index/--no-index', default=True,
-              help='create index for key attributes')
+              help='create composite index for every hierarchy')
+@click.option('--covering/--no-covering', default=False,
+              help='include measures in the indexes')
 @click.option('--schema', '-s',
               help='target view schema (overrides default fact schema')
+@click.option('--partition-by',
+              help='partitioning level of refresh of existing view')
+@click.option('--watermark', '-w',
+              help='fact column of refresh of existing view')
+@click.option('--since',
+              help='watermark value of the previous refresh')
+@click.option('--partition', '-p', 'partitions', multiple=True,
+              help='path of a partition to rebuild in existing view')
 @click.argument('cube', required=False)
 @click.argument('target', required=False)
 @click.pass_context
-def denormalize(ctx, force, materialize, index, schema, cube, target):
-    """Create denormalized view(s) from cube(s)."""
+def denormalize(ctx, force, materialize, index, covering, schema,
+                partition_by, watermark, since, partitions, cube, target):
+    """Create denormalized view(s) from cube(s).
 
-    if not materialize and index:
-        raise ArgumentError("Non-materialized views can't be indexed")
+    With --watermark and --since or with --partition the partitions of an
+    existing materialized view with changed facts are rebuilt.
+    """
 
     # Shortcuts
     workspace = ctx.obj.workspace
     store = ctx.obj.store
 
+    if watermark or partitions:
+        if not cube:
+            raise ArgumentError("Cube has to be specified for denormalized "
+                                "view refresh")
+
+        cube = workspace.cube(cube)
+        store = workspace.get_store(cube.store_name or "default")
+
+        if partitions:
+            partitions = [path_from_string(path) for path in partitions]
+        else:
+            partitions = None
+
+        since = store.refresh_denormalized_view(cube, target,
+                                                partition_by=partition_by,
+                                                watermark=watermark,
+                                                since=since,
+                                                partitions=partitions,
+                                                schema=schema)
+
+        if watermark:
+            print("refreshed up to watermark: %s" % since)
+        return
+
+    if not materialize and index:
+        raise ArgumentError("Non-materialized views can't be indexed")
+
     if cube:
         target = target or store.naming.denormalized_table_name(cube)
         cubes = [(cube, target)]
@@ -373,7 +430,8 @@ def denormalize(ctx, force, materialize, index, schema, cube, target):
                                        replace=force,
                                        create_index=index,
                                        keys_only=False,
-                                       schema=schema)
+                                       schema=schema,
+                                       covering_index=covering)
 
 
 # TODO: Nice to have it back
@@ -393,6 +451,44 @@ def denormalize(ctx, force, materialize, index, schema, cube, target):
 #     print(ddl)
 
 
+################################################################################
+# Command: sql reflect
+
+@sql.command("reflect")
+@click.option('--all', 'all_tables', is_flag=True, default=False,
+              help='reflect all tables of the store schema, not only tables '
+                   'of the cubes')
+@click.option('--path', '-p',
+              help='snapshot file (overrides the metadata_snapshot option)')
+@click.pass_context
+def sql_reflect(ctx, all_tables, path):
+    """Reflect tables of the store cubes again and write them to the store
+    metadata snapshot file."""
+
+    workspace = ctx.obj.workspace
+    store = ctx.obj.store
+
+    # Discard tables loaded from an existing snapshot
+    store.metadata.clear()
+
+    if all_tables:
+        store.metadata.reflect(views=True)
+
+    for cube_name in workspace.cube_names():
+        cube = workspace.cube(cube_name)
+        if workspace.get_store(cube.store_name or "default") is not store:
+            continue
+
+        print("reflecting tables of cube '%s'" % cube_name)
+        # Browser reflects all the tables of the cube star schema
+        workspace.browser(cube)
+
+    store.save_metadata_snapshot(path)
+
+    print("%d tables written to the metadata snapshot"
+          % len(store.metadata.tables))
+
+
 ################################################################################
 # Command: sql aggregate
 
@@ -400,22 +496,88 @@ def denormalize(ctx, force, materialize, index, schema, cube, target):
 @click.option('--force', is_flag=True, default=False,
               help='replace existing views')
 @click.option('--index/--no-index', default=True,
-              help='create index for key attributes')
+              help='create composite index for every hierarchy')
+@click.option('--covering/--no-covering', default=False,
+              help='include aggregates in the indexes')
 @click.option('--schema', '-s',
               help='target view schema (overrides default fact schema')
 @click.option('--dimension', '-d', "dimensions", multiple=True,
               help='dimension to be used for aggregation')
+@click.option('--watermark', '-w',
+              help='fact column of incremental refresh of existing table')
+@click.option('--since',
+              help='watermark value of the previous refresh')
+@click.option('--partition', '-p',
+              help='cut with changed facts to refresh in existing table')
+@click.option('--cuboid', '-c', "cuboids", multiple=True,
+              help='comma separated dimension levels of one of multiple '
+                   'tables')
+@click.option('--threads', '-t', type=int, default=None,
+              help='number of threads creating multiple tables')
 @click.argument('cube', required=False)
 @click.argument('target', required=False)
 @click.pass_context
-def sql_aggregate(ctx, force, index, schema, cube, target, dimensions):
+def sql_aggregate(ctx, force, index, covering, schema, cube, target,
+                  dimensions, watermark, since, partition, cuboids, threads):
     """Create pre-aggregated table from cube(s). If no cube is specified, then
     all cubes are aggregated. Target table can be specified only for one cube,
     for multiple cubes naming convention is used.
+
+    With --watermark and --since or with --partition the existing table is
+    refreshed with the changed facts only.
+
+    With --cuboid the tables of all the cuboids are created in one pass, the
+    coarser tables are aggregated from the finer ones.
     """
     workspace = ctx.obj.workspace
     store = ctx.obj.store
 
+    if watermark or partition:
+        if not cube:
+            raise ArgumentError("Cube has to be specified for aggregate "
+                                "table refresh")
+
+        cube = workspace.cube(cube)
+        store = workspace.get_store(cube.store_name or "default")
+
+        if partition:
+            partition = cuts_from_string(cube, partition)
+
+        since = store.refresh_cube_aggregate(cube, target,
+                                             schema=schema,
+                                             dimensions=dimensions,
+                                             watermark=watermark,
+                                             since=since,
+                                             partition=partition)
+
+        if watermark:
+            print("refreshed up to watermark: %s" % since)
+        return
+
+    if cuboids:
+        if not cube or dimensions:
+            raise ArgumentError("Cube and no dimensions have to be "
+                                "specified for multiple aggregate tables")
+
+        cube = workspace.cube(cube)
+        store = workspace.get_store(cube.store_name or "default")
+
+        base_name = target or store.naming.aggregated_table_name(cube.name)
+        tables = []
+        for cuboid in cuboids:
+            cuboid = [dimref.strip() for dimref in cuboid.split(",")]
+            tables.append((_aggregate_table_name(base_name, cuboid), cuboid))
+
+        tables = store.create_cube_aggregates(cube, tables,
+                                              replace=force,
+                                              create_index=index,
+                                              schema=schema,
+                                              workers=threads,
+                                              covering_index=covering)
+
+        print(json.dumps([table.to_dict() for table in tables], indent=4))
+        return
+
     if cube:
         target = target or store.naming.aggregated_table_name(cube)
         cubes = [(cube, target)]
@@ -429,14 +591,146 @@ def sql_aggregate(ctx, force, index, schema, cube, target, dimensions):
         cube = workspace.cube(cube_name)
         store = workspace.get_store(cube.store_name or "default")
 
-        print("denormalizing cube '%s' into '%s'" % (cube_name,
-                                                     target))
+        print("aggregating cube '%s' into '%s'" % (cube_name,
+                                                   target))
+
+        table = store.create_cube_aggregate(cube, target,
+                                            replace=force,
+                                            create_index=index,
+                                            schema=schema,
+                                            dimensions=dimensions,
+                                            covering_index=covering)
+
+        # Print the table description to be used in the cube's
+        # `aggregate_tables` browser option
+        print(json.dumps(table.to_dict(), indent=4))
 
-        store.create_cube_aggregate(cube, target,
-                                    replace=force,
-                                    create_index=index,
-                                    schema=schema,
-                                    dimensions=dimensions)
+
+################################################################################
+# Command: sql advise-aggregates
+
+@sql.command("advise-aggregates")
+@click.option('--log', '-l', 'log_path', type=click.Path(exists=True),
+              help='JSON request log file')
+@click.option('--log-url',
+              help='URL of a database with SQL request log')
+@click.option('--log-table', default='cubes_query_log',
+              help='SQL request log table')
+@click.option('--budget', '-b', type=int,
+              help='maximal number of rows of all advised tables')
+@click.option('--limit', type=int,
+              help='maximal number of advised tables')
+@click.option('--sample-size', type=int,
+              help='number of facts sampled to estimate table sizes')
+@click.option('--create', is_flag=True, default=False,
+              help='create the advised tables')
+@click.option('--force', is_flag=True, default=False,
+              help='replace existing tables')
+@click.option('--index/--no-index', default=True,
+              help='create index for key attributes')
+@click.option('--schema', '-s',
+              help='target schema of the created tables')
+@click.argument('cube')
+@click.pass_context
+def sql_advise_aggregates(ctx, log_path, log_url, log_table, budget, limit,
+                          sample_size, create, force, index, schema, cube):
+    """Advise aggregate tables of a cube that would answer the aggregation
+    queries recorded in the request log at the lowest cost, optionally
+    create them."""
+
+    workspace = ctx.obj.workspace
+
+    if bool(log_path) == bool(log_url):
+        raise ArgumentError("Either JSON request log file or SQL request "
+                            "log URL should be specified")
+
+    if log_path:
+        records = read_json_request_log(log_path)
+    else:
+        from ..sql.logging import read_sql_request_log
+        records = read_sql_request_log(log_url, log_table)
+
+    cube = workspace.cube(cube)
+    store = workspace.get_store(cube.store_name or "default")
+
+    from ..sql.advisor import AggregateAdvisor
+    advisor = AggregateAdvisor(store, cube, sample_size=sample_size)
+
+    count = sum(1 for record in records if advisor.add_log_record(record))
+    print("%d aggregation queries of cube '%s' in the request log"
+          % (count, cube.name))
+
+    advice = advisor.advise(budget=budget, limit=limit)
+
+    if not advice:
+        print("no aggregate table advised")
+        return
+
+    base_name = store.naming.aggregated_table_name(cube.name)
+    tables = []
+
+    for item in advice:
+        target = _aggregate_table_name(base_name, item.dimensions)
+        tables.append((target, item.dimensions))
+
+        print("%s: %s (rows: %d, benefit: %d, queries: %d)"
+              % (target, ", ".join(item.dimensions), item.row_count,
+                 item.benefit, item.queries))
+
+    if create:
+        tables = store.create_cube_aggregates(cube, tables,
+                                              replace=force,
+                                              create_index=index,
+                                              schema=schema)
+
+        print(json.dumps([table.to_dict() for table in tables], indent=4))
+
+
+def _aggregate_table_name(base_name, dimensions):
+    """Returns name of an aggregate table of `dimensions` – `base_name` with
+    the dimension and level names appended."""
+
+    levels = [string_to_dimension_level(dimref) for dimref in dimensions]
+    suffix = "_".join("%s_%s" % (dim, level) if level else dim
+                      for (dim, _, level) in levels)
+
+    return "%s_%s" % (base_name, suffix)
+
+
+################################################################################
+# Command: sql review-indexes
+
+@sql.command("review-indexes")
+@click.option('--dimension', '-d', "dimensions", multiple=True,
+              help='dimension of an aggregate table')
+@click.option('--schema', '-s',
+              help='schema of the table')
+@click.argument('cube')
+@click.argument('table')
+@click.pass_context
+def sql_review_indexes(ctx, dimensions, schema, cube, table):
+    """Review indexes of a materialized denormalized view or of an aggregate
+    table (with --dimension): report unused, redundant and duplicate indexes
+    and missing hierarchy indexes."""
+
+    workspace = ctx.obj.workspace
+
+    cube = workspace.cube(cube)
+    store = workspace.get_store(cube.store_name or "default")
+
+    (issues, missing) = store.review_indexes(cube, table,
+                                             dimensions=dimensions or None,
+                                             schema=schema)
+
+    for issue in issues:
+        print("%s: %s (%s) - %s" % (issue.issue, issue.name,
+                                    ", ".join(issue.columns), issue.message))
+
+    for index in missing:
+        print("missing: %s (%s)" % (index.name, ", ".join(index.columns)))
+
+    if not issues and not missing:
+        print("no index issues")
 
 
 ################################################################################
@@ -587,6 +881,48 @@ def members(ctx, config, cube_name, cuts, dim_name, output_format):
         out.write(row)
 
 
+################################################################################
+# Command: warmup
+
+@cli.command()
+@click.option('--config', type=click.Path(exists=True), required=False,
+              default=DEFAULT_CONFIG)
+@click.option('--locale', '-l', 'locales', multiple=True,
+              help="Locale to prepare the cubes in (default: all locales "
+                   "with translations)")
+@click.option('--queries', '-q', type=click.Path(exists=True),
+              help="JSON file with a list of queries to run")
+@click.option('--threads', '-t', type=int, default=None,
+              help="Number of threads")
+@click.argument('cube_names', metavar='CUBE', nargs=-1)
+@click.pass_context
+def warmup(ctx, config, locales, queries, threads, cube_names):
+    """Prepare cubes and run representative queries, the same way as the
+    server with the warmup option"""
+
+    config = read_config(config)
+    workspace = Workspace(config)
+
+    if locales:
+        locales = [None] + list(locales)
+    else:
+        locales = None
+
+    start = time.time()
+    failures = workspace.warm_up(cubes=list(cube_names) or None,
+                                 locales=locales,
+                                 queries=queries,
+                                 workers=threads)
+
+    click.echo("warm-up finished in %.2f s" % (time.time() - start))
+
+    if failures:
+        click.echo("%d FAILURES:" % len(failures))
+        for (task, e) in failures:
+            click.echo("%s: %s" % (task, e))
+        sys.exit(1)
+
+
 def main(*args, **kwargs):
 
     try:
@@ -0,0 +1,249 @@
+# -*- encoding=utf -*-
+"""Aggregate table advisor – selects cuboids of a cube worth
+pre-aggregating from the queries recorded in the request log."""
+
+from __future__ import absolute_import
+
+import math
+
+from collections import Counter, OrderedDict, namedtuple
+
+try:
+    import sqlalchemy as sa
+    import sqlalchemy.sql as sql
+except ImportError:
+    from ..common import MissingPackage
+    sa = sql = MissingPackage("sqlalchemy", "SQL")
+
+from ..errors import ConfigurationError, CubesError
+from ..logging import get_logger
+from ..query import Cell, Drilldown, cuts_from_string
+from ..query import hierarchical_cuboids, estimate_distinct_count
+from ..query import select_cuboids
+from .. import compat
+
+from .aggregates import cuboid_attributes, cuboid_levels
+from .browser import SQLBrowser
+
+
+__all__ = (
+    "AggregateAdvisor",
+    "AggregateAdvice",
+)
+
+
+# Default number of sampled facts for estimation of cuboid sizes
+DEFAULT_SAMPLE_SIZE = 100000
+
+
+AggregateAdvice = namedtuple("AggregateAdvice",
+                             ["dimensions", "row_count", "benefit",
+                              "queries"])
+
+
+class AggregateAdvisor(object):
+    """Advises aggregate tables of `cube` in SQL `store` that give the
+    largest decrease of cost of the recorded aggregation queries.
+
+    The candidates are all cuboids of the lattice of the default
+    hierarchies of the dimensions used by the queries (see
+    :func:`cubes.query.hierarchical_cuboids`) and the cuboids of the queries
+    themselves. Number of rows of every candidate is estimated from a sample
+    of `sample_size` facts (see :func:`cubes.query.estimate_distinct_count`),
+    the tables are selected by the greedy view selection algorithm (see
+    :func:`cubes.query.select_cuboids`).
+
+    .. versionadded:: 1.2
+    """
+
+    def __init__(self, store, cube, sample_size=None):
+        self.store = store
+        self.cube = cube
+        self.sample_size = sample_size or DEFAULT_SAMPLE_SIZE
+
+        self.browser = SQLBrowser(cube, store)
+
+        if self.browser.safe_labels:
+            raise ConfigurationError("Aggregation does not work with "
+                                     "safe_labels turned on")
+
+        # Keys are query cuboids – tuples of levels in the form
+        # ``dimension@hierarchy:level``, values are query frequencies
+        self.queries = Counter()
+
+        self.logger = get_logger()
+
+    def add_query(self, cell=None, drilldown=None, split=None):
+        """Records an aggregation query of `cell` with `drilldown` and
+        `split`."""
+
+        cell = cell or Cell(self.cube)
+
+        if not isinstance(drilldown, Drilldown):
+            drilldown = Drilldown(drilldown, cell)
+
+        grain = OrderedDict()
+
+        def add(dimension, hierarchy, levels):
+            key = (dimension.name, hierarchy.name)
+            if levels and len(levels) > len(grain.get(key, [])):
+                grain[key] = levels
+
+        for container in (cell, split):
+            for cut in (container.cuts if container else []):
+                dimension = self.cube.dimension(cut.dimension)
+                hierarchy = dimension.hierarchy(cut.hierarchy)
+                add(dimension, hierarchy,
+                    hierarchy.levels[0:cut.level_depth()])
+
+        for item in drilldown:
+            add(item.dimension, item.hierarchy, item.levels)
+
+        query = tuple(sorted("%s@%s:%s" % (dimension, hierarchy,
+                                           levels[-1].name)
+                             for ((dimension, hierarchy), levels)
+                             in grain.items()))
+
+        self.queries[query] += 1
+
+    def add_log_record(self, record):
+        """Records a query from a request log `record` – a dictionary with
+        keys `method`, `cube`, `cell`, `split` and `drilldown` as written by
+        the request log handlers. Records of other methods than
+        ``aggregate`` or of other cubes are ignored. Returns `True` if the
+        query was recorded."""
+
+        if record.get("method") != "aggregate" \
+                or record.get("cube") != self.cube.name:
+            return False
+
+        try:
+            cell = Cell(self.cube,
+                        cuts_from_string(self.cube, record.get("cell")))
+
+            split = record.get("split")
+            if split:
+                split = Cell(self.cube, cuts_from_string(self.cube, split))
+
+            drilldown = record.get("drilldown")
+            if isinstance(drilldown, compat.string_type):
+                drilldown = drilldown.split(",")
+
+            self.add_query(cell, drilldown or None, split or None)
+
+        except CubesError as e:
+            self.logger.warning("ignoring request log record of cube '%s': %s"
+                             % (self.cube.name, e))
+            return False
+
+        return True
+
+    def candidates(self):
+        """Returns list of candidate cuboids – tuples of levels in the form
+        ``dimension@hierarchy:level``. Cuboids with the same attributes are
+        included only once."""
+
+        names = set()
+        for query in self.queries:
+            for dimref in query:
+                names.add(dimref.split("@")[0])
+
+        dimensions = [self.cube.dimension(name) for name in sorted(names)]
+
+        cuboids = [tuple("%s:%s" % item for item in cuboid)
+                   for cuboid
+                   in hierarchical_cuboids(dimensions, default_only=True)]
+        cuboids += [query for query in self.queries if query]
+
+        candidates = OrderedDict()
+
+        for cuboid in cuboids:
+            key = frozenset(cuboid_attributes(self.cube, cuboid))
+            candidates.setdefault(key, cuboid)
+
+        return list(candidates.values())
+
+    def estimate_sizes(self, cuboids):
+        """Returns a tuple (`fact_count`, `sizes`) where `sizes` is a
+        dictionary with estimated number of rows of the `cuboids`. The
+        estimates are computed from a sample of facts fetched by one query.
+        If the fact key is an integer, every n-th fact is sampled, otherwise
+        the first facts are used."""
+
+        star = self.browser.star
+
+        statement = sql.expression.select([sql.functions.count()],
+                                          from_obj=star.fact_table)
+        fact_count = self.browser.execute(statement, "fact count").scalar()
+
+        cuboid_keys = OrderedDict()
+        for cuboid in cuboids:
+            keys = []
+            for (_, _, levels) in cuboid_levels(self.cube, cuboid):
+                keys += [level.key.ref for level in levels]
+            cuboid_keys[cuboid] = keys
+
+        refs = sorted(set(ref for keys in cuboid_keys.values()
+                          for ref in keys))
+        attributes = self.cube.get_attributes(refs)
+
+        (statement, labels) = self.browser.denormalized_statement(attributes)
+
+        if fact_count > self.sample_size:
+            column = star.fact_key_column
+
+            if isinstance(column.type, sa.Integer):
+                step = int(math.ceil(float(fact_count) / self.sample_size))
+                statement = statement.where(column % step == 0)
+            else:
+                statement = statement.limit(self.sample_size)
+
+        result = self.browser.execute(statement, "aggregate advisor sample")
+        rows = [dict(zip(labels, row)) for row in result]
+
+        sizes = {}
+
+        for cuboid, keys in cuboid_keys.items():
+            counts = Counter(tuple(row[key] for key in keys) for row in rows)
+            sizes[cuboid] = max(estimate_distinct_count(counts.values(),
+                                                        fact_count), 1)
+
+        return (fact_count, sizes)
+
+    def advise(self, budget=None, limit=None):
+        """Returns a list of advised aggregate tables as `AggregateAdvice`
+        tuples (`dimensions`, `row_count`, `benefit`, `queries`) in the order
+        of importance. `dimensions` can be passed to
+        :meth:`SQLStore.create_cube_aggregate`, `row_count` is the estimated
+        table size, `benefit` is the decrease of the total number of rows
+        read by the recorded queries and `queries` is the number of the
+        recorded queries the table can answer.
+
+        `budget` is the maximal total number of rows of the advised tables,
+        `limit` is the maximal number of the advised tables."""
+
+        if not self.queries:
+            return []
+
+        candidates = self.candidates()
+        (fact_count, sizes) = self.estimate_sizes(candidates)
+
+        attributes = {}
+        for cuboid in candidates + list(self.queries):
+            attributes[cuboid] = cuboid_attributes(self.cube, cuboid)
+
+        def answers(cuboid, query):
+            return attributes[query] <= attributes[cuboid]
+
+        selected = select_cuboids(sizes, dict(self.queries), fact_count,
+                                  answers, budget=budget, limit=limit)
+
+        advice = []
+
+        for (cuboid, benefit) in selected:
+            count = sum(frequency for (query, frequency)
+                        in self.queries.items() if answers(cuboid, query))
+            advice.append(AggregateAdvice(list(cuboid), sizes[cuboid],
+                                          benefit, count))
+
+        return advice
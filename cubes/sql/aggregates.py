@@ -0,0 +1,258 @@
+# -*- encoding=utf -*-
+"""Pre-aggregated tables – tables with cube data already aggregated at a
+coarser grain (cuboids) that can answer aggregation queries instead of the
+full star schema."""
+
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+try:
+    import sqlalchemy.sql as sql
+except ImportError:
+    from ..common import MissingPackage
+    sql = MissingPackage("sqlalchemy", "SQL")
+
+from ..errors import ArgumentError
+from ..metadata import string_to_dimension_level
+from ..query import rollup_records
+
+from .functions import get_aggregate_function, get_rollup_function
+from .query import Column
+
+
+__all__ = (
+    "AggregateTable",
+    "cuboid_attributes",
+    "cuboid_levels",
+    "merge_expression",
+    "rollup_expression",
+    "rollup_rows",
+)
+
+
+# Attribute stored as a plain column in an aggregate table. The query
+# context requires only the `ref` and `is_base` properties of the attributes.
+StoredAttribute = namedtuple("StoredAttribute", ["ref", "is_base"])
+
+
+class AggregateTable(object):
+    """Description of a pre-aggregated table of a cube. Attributes:
+
+    * `name` – table name
+    * `dimensions` – list of dimension levels the table is aggregated at, in
+      the form ``dimension@hierarchy:level``. Hierarchy and level are
+      optional, if level is not specified then the table contains the
+      deepest level of the hierarchy.
+    * `aggregates` – list of aggregate names stored in the table
+    * `schema` – database schema of the table
+    * `row_count` – number of rows in the table. Used to pick the smallest
+      table. If not specified, browser counts the rows on first use.
+    * `locale` – locale of the localizable attributes stored in the table
+
+    The table is expected to have one column for every attribute of every
+    level up to the aggregated level and one column for every aggregate. The
+    column names are the attribute and aggregate references, such as
+    ``date.year`` or ``amount_sum`` – the structure created by
+    :meth:`SQLStore.create_cube_aggregate`.
+
+    .. versionadded:: 1.2
+    """
+
+    def __init__(self, name, dimensions, aggregates, schema=None,
+                 row_count=None, locale=None):
+
+        if not name:
+            raise ArgumentError("Aggregate table name should not be empty")
+
+        self.name = name
+        self.dimensions = list(dimensions or [])
+        self.aggregates = list(aggregates or [])
+        self.schema = schema
+        self.row_count = row_count
+        self.locale = locale
+
+    @classmethod
+    def from_metadata(cls, metadata):
+        """Create an aggregate table description from a dictionary
+        `metadata` with keys `name`, `dimensions`, `aggregates`, `schema`,
+        `row_count` and `locale`."""
+
+        if isinstance(metadata, AggregateTable):
+            return metadata
+
+        row_count = metadata.get("row_count")
+        if row_count is not None:
+            row_count = int(row_count)
+
+        return cls(name=metadata.get("name"),
+                   dimensions=metadata.get("dimensions"),
+                   aggregates=metadata.get("aggregates"),
+                   schema=metadata.get("schema"),
+                   row_count=row_count,
+                   locale=metadata.get("locale"))
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "dimensions": self.dimensions,
+            "aggregates": self.aggregates,
+            "schema": self.schema,
+            "row_count": self.row_count,
+            "locale": self.locale
+        }
+
+    @property
+    def key(self):
+        """Table key – tuple (`schema`, `name`)"""
+        return (self.schema, self.name)
+
+    def __repr__(self):
+        return "AggregateTable({!r}, {!r}, {!r})".format(self.name,
+                                                         self.dimensions,
+                                                         self.aggregates)
+
+    def levels(self, cube):
+        """Returns a list of tuples (`dimension`, `hierarchy`, `levels`) of
+        `cube` stored in the table."""
+
+        return cuboid_levels(cube, self.dimensions)
+
+    def attributes(self, cube):
+        """Returns a set of references to `cube` attributes stored in the
+        table."""
+
+        return cuboid_attributes(cube, self.dimensions)
+
+    def mappings(self, cube):
+        """Returns star schema mappings of the table columns. Keys are
+        attribute and aggregate references, values are `Column` objects."""
+
+        refs = list(self.attributes(cube)) + self.aggregates
+
+        return {ref: Column(None, None, ref, None, None) for ref in refs}
+
+    def can_answer(self, cube, attributes, aggregates, locale=None):
+        """Returns `True` if the table can be used to aggregate `aggregates`
+        for a query involving `attributes` (cell, drilldown and split
+        attributes) in `locale`. All the attributes have to be stored in the
+        table and all the aggregates have to be stored and additive."""
+
+        for aggregate in aggregates:
+            if aggregate.name not in self.aggregates:
+                return False
+
+            if not aggregate.function \
+                    or get_rollup_function(aggregate.function) is None:
+                return False
+
+        available = self.attributes(cube)
+
+        for attribute in attributes:
+            if attribute.ref not in available:
+                return False
+
+            if attribute.is_localizable() and locale != self.locale:
+                return False
+
+        return True
+
+
+def cuboid_levels(cube, dimensions):
+    """Returns a list of tuples (`dimension`, `hierarchy`, `levels`) of a
+    cuboid of `cube` aggregated at `dimensions` – list of levels in the
+    form ``dimension@hierarchy:level``."""
+
+    result = []
+
+    for dimref in dimensions:
+        (dimname, hiername, levelname) = string_to_dimension_level(dimref)
+        dimension = cube.dimension(dimname)
+        hierarchy = dimension.hierarchy(hiername)
+
+        if levelname:
+            depth = hierarchy.level_index(levelname) + 1
+        else:
+            depth = len(hierarchy)
+
+        result.append((dimension, hierarchy, hierarchy.levels[0:depth]))
+
+    return result
+
+
+def cuboid_attributes(cube, dimensions):
+    """Returns a set of references to `cube` attributes of a cuboid
+    aggregated at `dimensions`, see :func:`cuboid_levels`."""
+
+    refs = set()
+
+    for (_, _, levels) in cuboid_levels(cube, dimensions):
+        for level in levels:
+            refs.update(attr.ref for attr in level.attributes)
+
+    return refs
+
+
+def rollup_expression(aggregate, column):
+    """Returns a labelled SQL expression that combines values of `aggregate`
+    pre-aggregated in `column` into a coarser aggregate."""
+
+    name = get_rollup_function(aggregate.function)
+
+    if name is None:
+        raise ArgumentError("Aggregate '{}' with function '{}' can not be "
+                            "rolled-up".format(aggregate.name,
+                                               aggregate.function))
+
+    function = get_aggregate_function(name)
+    expression = function.function(column)
+    expression = function.coalesce_aggregate(aggregate, expression)
+
+    return expression.label(aggregate.name)
+
+
+def merge_expression(aggregate, existing, delta):
+    """Returns SQL expression that combines two pre-aggregated values of
+    `aggregate` – `existing` and `delta` expressions – into one, such as
+    when new facts are merged into an aggregate table. If one of the values
+    is ``NULL``, the other one is the result, so the result is ``NULL``
+    only if both values are, as when the values are aggregated together."""
+
+    name = get_rollup_function(aggregate.function)
+
+    if name == "sum":
+        combined = existing + delta
+    elif name == "min":
+        combined = sql.expression.case([(delta < existing, delta)],
+                                       else_=existing)
+    elif name == "max":
+        combined = sql.expression.case([(delta > existing, delta)],
+                                       else_=existing)
+    else:
+        raise ArgumentError("Aggregate '{}' with function '{}' can not be "
+                            "merged".format(aggregate.name,
+                                            aggregate.function))
+
+    return sql.expression.case([(existing.is_(None), delta),
+                                (delta.is_(None), existing)],
+                               else_=combined)
+
+
+def rollup_rows(rows, keys, aggregates):
+    """Rolls-up `rows` of a finer aggregation – dictionaries with attribute
+    and aggregate references as keys – to the attributes `keys`. This is the
+    Python counterpart of :func:`rollup_expression`, see
+    :func:`cubes.query.rollup_records` for more information."""
+
+    functions = {}
+
+    for aggregate in aggregates:
+        name = get_rollup_function(aggregate.function)
+
+        if name is None:
+            raise ArgumentError("Aggregate '{}' with function '{}' can not be "
+                                "rolled-up".format(aggregate.name,
+                                                   aggregate.function))
+        functions[aggregate.ref] = name
+
+    return rollup_records(rows, keys, functions)
@@ -4,6 +4,7 @@
 from __future__ import absolute_import
 
 import collections
+from collections import namedtuple
 
 try:
     import sqlalchemy
@@ -13,20 +14,32 @@ except ImportError:
     from ...common import MissingPackage
     sqlalchemy = sql = MissingPackage("sqlalchemy", "SQL aggregation browser")
 
-from ..query import available_calculators
+from ..query import available_calculators, sort_records
 from ..query import AggregationBrowser, AggregationResult, Drilldown
-from ..query import Cell, PointCut
+from ..query import Cell, PointCut, ResultRow, SPLIT_DIMENSION_NAME
 from ..logging import get_logger
-from ..errors import ArgumentError, InternalError
+from ..errors import CubesError, ArgumentError, InternalError
 from ..stores import Store
+from ..datastructures import LRUCache
 from ..metadata import collect_attributes
 from .. import compat
 
+from .aggregates import AggregateTable, StoredAttribute, rollup_expression
+from .aggregates import rollup_rows
+from .functions import get_rollup_function
 from .functions import available_aggregate_functions
 from .mapper import DenormalizedMapper, StarSchemaMapper, map_base_attributes
 from .mapper import distill_naming
 from .query import StarSchema, QueryContext, to_join, FACT_KEY_LABEL
-from .utils import paginate_query, order_query
+from .query import DEFAULT_CACHE_SIZE, SPLIT_PARAMETER_PREFIX
+from .query import cell_shape, cell_parameters
+from .query import NoSuchTableError
+from .utils import paginate_query, order_query, single_pass_query
+from .utils import supports_grouping_sets, supports_window_functions
+from .utils import estimate_row_count, supports_concurrency
+from .utils import SUMMARY_FLAG_LABEL, CELL_COUNT_LABEL, GROUPING_FLAG_LABEL
+from .utils import keyset_order, keyset_query, keyset_parameters
+from .utils import encode_continuation, decode_continuation
 
 
 __all__ = [
@@ -34,6 +47,27 @@ __all__ = [
 ]
 
 
+# Keys of report queries that can be answered by a merged aggregation
+MERGEABLE_QUERY_KEYS = ("query", "aggregates", "drilldown", "rollup")
+
+# Formats of result rows: dictionaries or `ResultRow` objects
+ROW_FORMATS = ("dict", "row")
+
+# Number of rows fetched from a cursor at once
+DEFAULT_FETCH_BATCH_SIZE = 1000
+
+# Methods of getting the total cell count of a drill-down
+CELL_COUNT_MODES = ("exact", "estimate", "none")
+
+
+# Prepared statements of a drill-down: ordered and paginated `statement`,
+# `count_statement` – count of all cells, `cells_statement` – unordered
+# statement of all cells, `labels` and `keyset` for keyset pagination
+DrilldownStatements = namedtuple("DrilldownStatements",
+                                 ["statement", "count_statement",
+                                  "cells_statement", "labels", "keyset"])
+
+
 class SQLBrowser(AggregationBrowser):
     """SnowflakeBrowser is a SQL-based AggregationBrowser implementation that
     can aggregate star and snowflake schemas without need of having
@@ -60,8 +94,76 @@ class SQLBrowser(AggregationBrowser):
     * `include_cell_count` – if ``True`` then total cell count is included
       in aggregation result. Turned on by default.
       performance reasons
+    * `cell_count_mode` – how the total cell count is retrieved: ``exact``
+      – counted by an extra statement (default if `include_cell_count` is
+      ``True``), ``estimate`` – row estimate of the database query planner
+      (PostgreSQL only, exact count is used on other databases) or
+      ``none`` – cell count is not retrieved (default if
+      `include_cell_count` is ``False``). When the count is estimated, then
+      `total_cell_count_approximate` of the result is ``True``.
     * `safe_labels` – safe labelling of the attributes in databases which
       don't allow characters such as ``.`` dots in column names
+    * `use_aggregate_tables` – if ``True`` (default) then aggregations are
+      answered from the smallest matching pre-aggregated table, if there is
+      any (see below)
+    * `single_pass` – if ``True`` then drill-down cells, total cell count
+      and summary are retrieved with one statement when the database
+      supports it: using ``GROUPING SETS`` and window functions or using
+      only the ``COUNT(*) OVER ()`` window function for the cell count.
+      Default is ``False``.
+    * `query_cache_size` – number of joined stars, query contexts (column
+      expressions of attribute sets) and aggregation statements kept for
+      reuse by subsequent queries. Aggregation statements are cached by the
+      query shape – cell structure, aggregates, drilldown, order and page –
+      with the cut values bound as parameters, therefore their compiled SQL
+      is reused as well. Default is 128, ``0`` disables the cache.
+    * `row_format` – format of the cells and facts: ``dict`` (default) –
+      a dictionary for every row, or ``row`` – lightweight
+      :class:`cubes.query.ResultRow` objects sharing one label index. The
+      ``row`` format is recommended for large results, such as exports.
+      Can be specified per aggregation request as well.
+    * `stream_results` – if ``True`` then facts and drill-down cells are
+      fetched from a server-side cursor (if the database driver supports
+      it, such as psycopg2), instead of loading the whole result into the
+      client memory first. Can be specified per request with the `stream`
+      argument of :meth:`facts` or :meth:`aggregate`. Default is ``False``.
+    * `fetch_batch_size` – number of rows fetched from the database cursor
+      at once. Default is 1000.
+    * `report_workers` – number of threads executing queries of
+      :meth:`report` concurrently, each with its own connection from the
+      engine's connection pool. Default is 1 – queries are executed one
+      after another. Ignored if the browser is given a single connection
+      or an in-memory SQLite database.
+    * `report_timeout` – time limit in seconds of every concurrently
+      executed report query, measured from the query start. Queries that do
+      not finish in time are reported as errors, but they keep their thread
+      and connection until the database finishes them – use a statement
+      timeout of the database to stop them.
+    * `cache_watermark` – how to get the watermark of the cube data used to
+      invalidate cached aggregation results (see :meth:`watermark`):
+      ``fact_key`` – maximal key of the fact table, ``max:table.column``
+      – maximal value of a column, such as a version or load timestamp
+      maintained by the ETL, or ``sql:SELECT ...`` – a SQL query returning
+      one value, the query might use the ``:cube`` parameter (cube name).
+      Not used by default.
+    * `merge_report_queries` – if ``True`` then aggregation queries of a
+      :meth:`report` with the same cell are answered by one statement:
+      grouped by ``GROUPING SETS`` of the drill-downs if the database
+      supports it, otherwise grouped by all the drill-down attributes and
+      rolled-up for every query (requires additive aggregates). Only plain
+      queries with `aggregates`, `drilldown` and `rollup` are merged.
+      Default is ``False``.
+
+    Aggregate tables:
+
+    * `aggregate_tables` – list of pre-aggregated tables of the cube,
+      usually specified in the cube's `browser_options`. Each table is a
+      dictionary with keys `name`, `dimensions` (list of
+      ``dimension@hierarchy:level`` strings), `aggregates` (list of aggregate
+      names) and optional `schema`, `row_count` and `locale`. See
+      :class:`cubes.sql.aggregates.AggregateTable` for more information.
+      Tables created by :meth:`SQLStore.create_cube_aggregate` are
+      registered in the store and used as well.
 
     Limitations:
 
@@ -86,6 +188,11 @@ class SQLBrowser(AggregationBrowser):
             "name": "include_cell_count",
             "type": "bool"
         },
+        {
+            "name": "cell_count_mode",
+            "description": "Total cell count: exact, estimate or none",
+            "type": "string"
+        },
         {
             "name": "use_denormalization",
             "type": "bool"
@@ -95,6 +202,61 @@ class SQLBrowser(AggregationBrowser):
             "description": "Use internally SQL statement column labels " \
                            "without special characters",
             "type": "bool"
+        },
+        {
+            "name": "use_aggregate_tables",
+            "description": "Answer aggregations from matching "\
+                           "pre-aggregated tables",
+            "type": "bool"
+        },
+        {
+            "name": "single_pass",
+            "description": "Get drilldown, cell count and summary with "\
+                           "one statement if database supports it",
+            "type": "bool"
+        },
+        {
+            "name": "row_format",
+            "description": "Format of result rows: dict or row",
+            "type": "string"
+        },
+        {
+            "name": "stream_results",
+            "description": "Fetch facts and cells using server-side "\
+                           "cursors",
+            "type": "bool"
+        },
+        {
+            "name": "fetch_batch_size",
+            "description": "Number of rows fetched at once",
+            "type": "int"
+        },
+        {
+            "name": "query_cache_size",
+            "description": "Number of cached star joins and query contexts",
+            "type": "int"
+        },
+        {
+            "name": "report_workers",
+            "description": "Number of threads executing report queries",
+            "type": "int"
+        },
+        {
+            "name": "report_timeout",
+            "description": "Time limit of report queries in seconds",
+            "type": "float"
+        },
+        {
+            "name": "cache_watermark",
+            "description": "Data watermark for result cache invalidation: "\
+                           "fact_key, max:table.column or sql:query",
+            "type": "string"
+        },
+        {
+            "name": "merge_report_queries",
+            "description": "Answer report aggregations of the same cell "\
+                           "with one statement",
+            "type": "bool"
         }
 
     ]
@@ -125,6 +287,8 @@ class SQLBrowser(AggregationBrowser):
             metadata = kwargs.get("metadata",
                                   sqlalchemy.MetaData(bind=self.connectable))
 
+        self.metadata = metadata
+
         # Options
         # -------
 
@@ -136,6 +300,46 @@ class SQLBrowser(AggregationBrowser):
         self.include_summary = options.get("include_summary", True)
         self.include_cell_count = options.get("include_cell_count", True)
 
+        self.cell_count_mode = options.get("cell_count_mode")
+        if not self.cell_count_mode:
+            self.cell_count_mode = "exact" if self.include_cell_count \
+                                   else "none"
+        elif self.cell_count_mode not in CELL_COUNT_MODES:
+            raise ArgumentError("Unknown cell count mode '{}'. Use one of: {}"
+                                .format(self.cell_count_mode,
+                                        ", ".join(CELL_COUNT_MODES)))
+        self.include_cell_count = self.cell_count_mode != "none"
+        self.single_pass = options.get("single_pass", False)
+
+        self.row_format = options.get("row_format") or "dict"
+        self._assert_row_format(self.row_format)
+
+        self.stream_results = options.get("stream_results", False)
+        self.fetch_batch_size = int(options.get("fetch_batch_size")
+                                    or DEFAULT_FETCH_BATCH_SIZE)
+
+        self.report_workers = int(options.get("report_workers") or 1)
+        if self.report_workers > 1 \
+                and not supports_concurrency(self.connectable):
+            self.logger.debug("connection of cube {} can not be shared by "
+                              "threads, report queries are executed "
+                              "sequentially".format(cube.name))
+            self.report_workers = 1
+
+        report_timeout = options.get("report_timeout")
+        if report_timeout is not None:
+            report_timeout = float(report_timeout)
+        self.report_timeout = report_timeout
+
+        # Database errors of concurrent report queries are reported too
+        self.report_query_errors = (CubesError,
+                                    sqlalchemy.exc.SQLAlchemyError)
+
+        self.merge_report_queries = options.get("merge_report_queries",
+                                                False)
+
+        self.cache_watermark = options.get("cache_watermark")
+
         self.safe_labels = options.get("safe_labels", False)
         if self.safe_labels:
             self.logger.debug("using safe labels for cube {}"
@@ -169,6 +373,9 @@ class SQLBrowser(AggregationBrowser):
                                                     locale=locale)
 
         tables = options.get("tables")
+        cache_size = options.get("query_cache_size", DEFAULT_CACHE_SIZE)
+        if cache_size is not None:
+            cache_size = int(cache_size)
 
         # Prepare Join objects
         if cube.joins:
@@ -182,13 +389,39 @@ class SQLBrowser(AggregationBrowser):
                                fact=fact_name,
                                joins=joins,
                                schema=naming.schema,
-                               tables=tables)
+                               tables=tables,
+                               cache_size=cache_size)
+
+        # Query contexts, keys are tuples (`table key`, `frozen attribute
+        # references`, `safe labels`). Table key is ``None`` for the star.
+        self._contexts = LRUCache(cache_size)
+
+        # Aggregation statements, keys are query shapes. Compiled statements
+        # are cached by SQLAlchemy in the `_compiled` cache.
+        self._statements = LRUCache(cache_size)
+        self._compiled = LRUCache(cache_size)
 
         # Extract hierarchies
         # -------------------
         #
         self.hierarchies = self.cube.distilled_hierarchies
 
+        # Aggregate tables
+        # ----------------
+        #
+        self.use_aggregate_tables = options.get("use_aggregate_tables", True)
+        self._aggregate_tables = [AggregateTable.from_metadata(table)
+                                  for table
+                                  in options.get("aggregate_tables", [])]
+        # Star schemas of the aggregate tables, keys are table keys
+        self._aggregate_stars = {}
+        self._cache_size = cache_size
+
+    def _assert_row_format(self, row_format):
+        if row_format not in ROW_FORMATS:
+            raise ArgumentError("Unknown row format '{}'. Use one of: {}"
+                                .format(row_format, ", ".join(ROW_FORMATS)))
+
     def features(self):
         """Return SQL features. Currently they are all the same for every
         cube, however in the future they might depend on the SQL engine or
@@ -208,6 +441,16 @@ class SQLBrowser(AggregationBrowser):
 
         return funcname in available_aggregate_functions()
 
+    def aggregate_rollup_function(self, aggregate):
+        """Returns the roll-up function of a built-in additive aggregate
+        function of `aggregate`, see
+        :func:`cubes.sql.functions.get_rollup_function`."""
+
+        if aggregate.function and self.is_builtin_function(aggregate.function):
+            return get_rollup_function(aggregate.function)
+        else:
+            return None
+
     def fact(self, key_value, fields=None):
         """Get a single fact with key `key_value` from cube.
 
@@ -232,13 +475,25 @@ class SQLBrowser(AggregationBrowser):
         return record
 
     def facts(self, cell=None, fields=None, order=None, page=None,
-              page_size=None, fact_list=None):
+              page_size=None, fact_list=None, stream=None,
+              continuation=None):
         """Return all facts from `cell`, might be ordered and paginated.
 
         `fact_list` is a list of fact keys to be selected. Might be used to
         fetch multiple facts using single query instead of multiple `fact()`
         queries.
 
+        If `stream` is ``True`` then the facts are fetched using a
+        server-side cursor, if ``None`` then the `stream_results` option is
+        used.
+
+        If `continuation` is not ``None`` then keyset pagination is used
+        instead of `page`: the facts are ordered by `order` and by the fact
+        key and `page_size` facts following the `continuation` token are
+        returned. Use an empty string for the first page. The token for the
+        next page is in the `continuation` attribute of the returned object,
+        it is ``None`` for the last page.
+
         Number of SQL queries: 1.
         """
         attrs = self.cube.get_attributes(fields)
@@ -252,6 +507,24 @@ class SQLBrowser(AggregationBrowser):
             in_condition = self.star.fact_key_column.in_(fact_list)
             statement = statement.where(in_condition)
 
+        if continuation is not None:
+            keyset = keyset_order(labels, order, keys=[FACT_KEY_LABEL])
+            statement = keyset_query(statement, labels, keyset,
+                                     after=bool(continuation),
+                                     limit=self._keyset_limit(page_size))
+            if continuation:
+                values = decode_continuation(continuation, keyset)
+                statement = statement.params(keyset_parameters(values))
+
+            cursor = self.execute(statement, "facts")
+            (batch, token) = self._fetch_keyset_page(cursor, labels, keyset,
+                                                     page_size)
+            facts = ResultIterator(cursor, labels, batch,
+                                   row_format=self.row_format)
+            facts.continuation = token
+
+            return facts
+
         statement = paginate_query(statement, page, page_size)
 
         # TODO: use natural order
@@ -260,9 +533,41 @@ class SQLBrowser(AggregationBrowser):
                                 natural_order={},
                                 labels=labels)
 
-        cursor = self.execute(statement, "facts")
+        if stream is None:
+            stream = self.stream_results
+
+        cursor = self.execute(statement, "facts", stream=stream)
+
+        return ResultIterator(cursor, labels,
+                              row_format=self.row_format,
+                              batch_size=self.fetch_batch_size)
+
+    def _keyset_limit(self, page_size):
+        """Returns limit of a keyset page statement: one row more than the
+        `page_size` to find out whether there is a next page."""
+
+        if not page_size:
+            raise ArgumentError("Page size is required for pagination "
+                                "with continuation")
+        return page_size + 1
+
+    def _fetch_keyset_page(self, cursor, labels, keyset, page_size):
+        """Fetches a page of keyset paginated statement. Returns a tuple
+        (`batch`, `continuation`) where `batch` is a deque of the page rows
+        and `continuation` is a token for the next page or ``None`` if there
+        are no more rows."""
+
+        rows = cursor.fetchall()
+
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            last = rows[-1]
+            values = [last[labels.index(label)] for (label, _) in keyset]
+            token = encode_continuation(keyset, values)
+        else:
+            token = None
 
-        return ResultIterator(cursor, labels)
+        return (collections.deque(rows), token)
 
     def test(self, aggregate=False):
         """Tests whether the statement can be constructed and executed. Does
@@ -285,6 +590,137 @@ class SQLBrowser(AggregationBrowser):
         result = self.connectable.execute(statement)
         result.close()
 
+    def watermark(self):
+        """Returns the watermark of the cube data according to the
+        `cache_watermark` option or `None` if the option is not set."""
+
+        if not self.cache_watermark:
+            return None
+
+        statement = self.prepare(("watermark", self.cache_watermark),
+                                 self._watermark_statement)
+
+        result = self.execute(statement, "watermark",
+                              {"cube": self.cube.name})
+        return result.scalar()
+
+    def _watermark_statement(self):
+        """Returns the statement of the watermark probe described by the
+        `cache_watermark` option."""
+
+        spec = self.cache_watermark
+
+        if spec == "fact_key":
+            column = self.star.fact_table.columns[self.star.fact_key]
+            return sql.expression.select([sql.functions.max(column)])
+
+        elif spec.startswith("max:"):
+            reference = spec[4:].strip().split(".")
+            if len(reference) < 2:
+                raise ArgumentError("Watermark column should be specified as "
+                                    "max:table.column or "
+                                    "max:schema.table.column")
+            column = sql.expression.column(reference[-1])
+            table = sql.expression.table(reference[-2], column)
+            if len(reference) > 2:
+                table.schema = reference[-3]
+            return sql.expression.select([sql.functions.max(column)],
+                                         from_obj=table)
+
+        elif spec.startswith("sql:"):
+            return sql.expression.text(spec[4:].strip())
+
+        else:
+            raise ArgumentError("Unknown cache watermark '{}'. Use fact_key, "
+                                "max:table.column or sql:query"
+                                .format(spec))
+
+    @property
+    def aggregate_tables(self):
+        """List of aggregate tables of the browsed cube: tables from the
+        `aggregate_tables` option and tables registered in the store."""
+
+        tables = list(self._aggregate_tables)
+
+        registry = getattr(self.store, "aggregate_tables", None)
+        if registry:
+            tables += registry.get(self.cube.name, [])
+
+        return tables
+
+    def aggregate_table(self, cell, aggregates, drilldown=None, split=None):
+        """Returns the smallest aggregate table that can answer aggregation
+        of `aggregates` in `cell` with `drilldown` and `split`. Returns
+        `None` if there is no such table or if `use_aggregate_tables` is
+        turned off – the star schema should be used in that case."""
+
+        if not self.use_aggregate_tables:
+            return None
+
+        tables = self.aggregate_tables
+
+        if not tables:
+            return None
+
+        refs = collect_attributes(None, cell, drilldown, split)
+        attributes = self.cube.get_attributes(refs) if refs else []
+
+        candidates = []
+
+        for table in tables:
+            if not table.can_answer(self.cube, attributes, aggregates,
+                                    self.locale):
+                continue
+
+            try:
+                size = self._aggregate_table_size(table)
+            except NoSuchTableError:
+                self.logger.warning("aggregate table '%s' of cube '%s' does "
+                                 "not exist" % (table.name, self.cube.name))
+                continue
+
+            candidates.append((size, len(table.dimensions), table))
+
+        if not candidates:
+            return None
+
+        candidates.sort(key=lambda item: item[0:2])
+
+        return candidates[0][2]
+
+    def _aggregate_star(self, table):
+        """Returns a star schema for the aggregate table `table`. The star
+        has no joins, all attributes are columns of the table."""
+
+        try:
+            return self._aggregate_stars[table.key]
+        except KeyError:
+            pass
+
+        star = StarSchema(table.name,
+                          self.metadata,
+                          mappings=table.mappings(self.cube),
+                          fact=table.name,
+                          schema=table.schema or self.star.schema,
+                          cache_size=self._cache_size)
+
+        self._aggregate_stars[table.key] = star
+
+        return star
+
+    def _aggregate_table_size(self, table):
+        """Returns number of rows of the aggregate `table`. Counts the rows
+        if the size is not known."""
+
+        if table.row_count is None:
+            star = self._aggregate_star(table)
+            statement = sql.expression.select([sql.functions.count()],
+                                              from_obj=star.fact_table)
+            result = self.execute(statement, "aggregate table size")
+            table.row_count = result.scalar()
+
+        return table.row_count
+
     def provide_members(self, cell, dimension, depth=None, hierarchy=None,
                         levels=None, attributes=None, page=None,
                         page_size=None, order=None):
@@ -342,11 +778,82 @@ class SQLBrowser(AggregationBrowser):
 
         return member
 
-    def execute(self, statement, label=None):
+    def execute(self, statement, label=None, params=None, stream=False):
         """Execute the `statement`, optionally log it. Returns the result
-        cursor."""
+        cursor. If `params` is specified, then the statement is considered
+        to be a prepared statement template (see :meth:`prepare`), the
+        `params` are bound to the statement and the compiled statement is
+        cached. If `stream` is ``True`` then the result is fetched using a
+        server-side cursor, if the database driver supports it."""
         self._log_statement(statement, label)
-        return self.connectable.execute(statement)
+
+        options = {}
+
+        if params is not None:
+            options["compiled_cache"] = self._compiled
+
+        if stream:
+            options["stream_results"] = True
+
+        if options:
+            connectable = self.connectable.execution_options(**options)
+        else:
+            connectable = self.connectable
+
+        if params is None:
+            return connectable.execute(statement)
+        else:
+            return connectable.execute(statement, params)
+
+    def prepare(self, shape, factory, *args, **kwargs):
+        """Returns a statement template for query `shape` – a hashable
+        structure that fully determines the statement except the values of
+        bound parameters. If the template is not cached, it is created by
+        calling `factory` with `args` and `kwargs`."""
+
+        prepared = self._statements.get(shape)
+
+        if prepared is None:
+            prepared = factory(*args, **kwargs)
+            self._statements[shape] = prepared
+
+        return prepared
+
+    def query_shape(self, cell, aggregates, drilldown=None, split=None,
+                    order=None, page=None, page_size=None,
+                    aggregate_table=None):
+        """Returns a hashable shape of an aggregation query. Queries with
+        the same shape have the same statements which differ only in the
+        parameters from :func:`cell_parameters`."""
+
+        if drilldown:
+            drilldown_shape = tuple((str(item.dimension),
+                                     str(item.hierarchy),
+                                     tuple(str(level) for level in item.levels))
+                                    for item in drilldown)
+        else:
+            drilldown_shape = None
+
+        order_shape = tuple((str(attribute), direction)
+                            for (attribute, direction) in order or [])
+
+        return (cell_shape(cell),
+                tuple(str(aggregate) for aggregate in aggregates),
+                drilldown_shape,
+                cell_shape(split),
+                order_shape,
+                page,
+                page_size,
+                aggregate_table.key if aggregate_table else None)
+
+    def query_parameters(self, cell, split=None):
+        """Returns a dictionary of parameters of an aggregation statement
+        template for `cell` and `split` cell."""
+
+        params = cell_parameters(cell)
+        params.update(cell_parameters(split, SPLIT_PARAMETER_PREFIX))
+
+        return params
 
     def provide_aggregate(self, cell, aggregates, drilldown, split, order,
                           page, page_size, **options):
@@ -372,6 +879,11 @@ class SQLBrowser(AggregationBrowser):
           computed as well, otherwise it will be ``None``.
         * `include_summary`: if ``True`` (default) then summary is computed,
           otherwise it will be ``None``
+        * `continuation`: if not ``None`` then keyset pagination is used
+          instead of `page`. Cells are ordered by `order`, the natural order
+          and the drill-down attributes and `page_size` cells following the
+          continuation token are returned. Use an empty string for the first
+          page. Token for the next page is in `result.continuation`.
 
         Result is paginated by `page_size` and ordered by `order`.
 
@@ -380,6 +892,9 @@ class SQLBrowser(AggregationBrowser):
         * without drill-down: 1 – summary
         * with drill-down (default): 3 – summary, drilldown, total drill-down
           record count
+        * with drill-down and `single_pass`: 1 if the database supports
+          grouping sets and window functions, 2 – summary and drilldown with
+          the record count if the database supports only window functions
 
         Notes:
 
@@ -393,16 +908,49 @@ class SQLBrowser(AggregationBrowser):
                                    drilldown=drilldown,
                                    has_split=split is not None)
 
+        row_format = options.get("row_format") or self.row_format
+        self._assert_row_format(row_format)
+
+        stream = options.get("stream")
+        if stream is None:
+            stream = self.stream_results
+
+        # Keyset pagination – the continuation token replaces the page
+        continuation = options.get("continuation")
+        if continuation is not None:
+            page = None
+
+        aggregate_table = self.aggregate_table(cell, aggregates, drilldown,
+                                               split)
+        if aggregate_table is not None:
+            self.logger.debug("using aggregate table '%s' for cube '%s'"
+                              % (aggregate_table.name, self.cube.name))
+
+        if (drilldown or split) and continuation is None:
+            single_pass = self._single_pass_mode()
+        else:
+            single_pass = None
+
+        # Statements are prepared per query shape, cut values are bound as
+        # parameters
+        params = self.query_parameters(cell, split)
+
         # Summary
         # -------
 
-        if self.include_summary or not (drilldown or split):
-            (statement, labels) = self.aggregation_statement(cell,
-                                                             aggregates=aggregates,
-                                                             drilldown=drilldown,
-                                                             for_summary=True)
-
-            cursor = self.execute(statement, "aggregation summary")
+        if (self.include_summary or not (drilldown or split)) \
+                and single_pass != "grouping_sets":
+            shape = self.query_shape(cell, aggregates, drilldown,
+                                     aggregate_table=aggregate_table)
+            (statement, labels) = self.prepare(("summary", shape),
+                                               self.aggregation_statement,
+                                               cell,
+                                               aggregates=aggregates,
+                                               drilldown=drilldown,
+                                               for_summary=True,
+                                               aggregate_table=aggregate_table)
+
+            cursor = self.execute(statement, "aggregation summary", params)
             row = cursor.first()
 
             if row:
@@ -419,57 +967,451 @@ class SQLBrowser(AggregationBrowser):
         # Note that a split cell if present prepends the drilldown
 
         if drilldown or split:
-            if not (page_size and page is not None):
+            if not (page_size and (page is not None
+                                   or continuation is not None)):
                 self.assert_low_cardinality(cell, drilldown)
 
             result.levels = drilldown.result_levels(include_split=bool(split))
-            natural_order = drilldown.natural_order
 
             self.logger.debug("preparing drilldown statement")
 
-            (statement, labels) = self.aggregation_statement(cell,
-                                                             aggregates=aggregates,
-                                                             drilldown=drilldown,
-                                                             split=split)
-            # Get the total cell count before the pagination
-            #
-            if self.include_cell_count:
-                count_statement = statement.alias().count()
-                counts = self.execute(count_statement)
-                result.total_cell_count = counts.scalar()
-
-            # Order and paginate
-            #
-            statement = order_query(statement,
-                                    order,
-                                    natural_order,
-                                    labels=labels)
-            statement = paginate_query(statement, page, page_size)
-
-            cursor = self.execute(statement, "aggregation drilldown")
-
-            result.cells = ResultIterator(cursor, labels)
-            result.labels = labels
+            shape = self.query_shape(cell, aggregates, drilldown, split,
+                                     order, page, page_size, aggregate_table)
+            if continuation is not None:
+                keyset_mode = "first" if not continuation else "next"
+            else:
+                keyset_mode = None
+
+            prepared = self.prepare(("drilldown", single_pass, keyset_mode,
+                                     shape),
+                                    self._drilldown_statements,
+                                    cell, aggregates, drilldown, split,
+                                    order, page, page_size,
+                                    aggregate_table, single_pass,
+                                    keyset_mode)
+            (statement, count_statement, _, labels, keyset) = prepared
+
+            if keyset_mode:
+                if self.include_cell_count:
+                    self._count_cells(result, prepared, params)
+
+                if keyset_mode == "next":
+                    values = decode_continuation(continuation, keyset)
+                    params.update(keyset_parameters(values))
+
+                cursor = self.execute(statement, "aggregation drilldown",
+                                      params)
+                page_rows = self._fetch_keyset_page(cursor, labels, keyset,
+                                                    page_size)
+                (batch, result.continuation) = page_rows
+
+            elif single_pass == "grouping_sets":
+                cursor = self.execute(statement, "aggregation single pass",
+                                      params, stream=stream)
+                batch = collections.deque(cursor.fetchmany(2))
+
+                # The summary row is always the first one. The cell count
+                # includes the summary row.
+                row = batch.popleft()
+
+                agg_labels = labels[-len(aggregates):]
+                values = row[len(labels) - len(aggregates):len(labels)]
+                result.summary = dict(zip(agg_labels, values))
+
+                if self.include_cell_count:
+                    result.total_cell_count = row[CELL_COUNT_LABEL] - 1
+
+            elif single_pass == "window":
+                cursor = self.execute(statement, "aggregation drilldown",
+                                      params, stream=stream)
+                batch = collections.deque(cursor.fetchmany(1))
+
+                if batch:
+                    result.total_cell_count = batch[0][CELL_COUNT_LABEL]
+                elif not page:
+                    result.total_cell_count = 0
+                else:
+                    # Page is out of range, we have to count separately
+                    counts = self.execute(count_statement, "cell count",
+                                          params)
+                    result.total_cell_count = counts.scalar()
+
+            else:
+                # Get the total cell count before the pagination
+                #
+                if self.include_cell_count:
+                    self._count_cells(result, prepared, params)
+
+                cursor = self.execute(statement, "aggregation drilldown",
+                                      params, stream=stream)
+                batch = None
+
+            # If exclude_null_aggregates is True then don't include cells
+            # where at least one of the bult-in aggregates is NULL
+            if self.exclude_null_agregates:
+                exclude_if_null = [agg.ref for agg in aggregates
+                                   if agg.function
+                                   and self.is_builtin_function(agg.function)]
+            else:
+                exclude_if_null = None
 
-        # If exclude_null_aggregates is True then don't include cells where
-        # at least one of the bult-in aggregates is NULL
-        if result.cells is not None and self.exclude_null_agregates:
-            native_aggs = [agg.ref for agg in aggregates
-                           if agg.function and self.is_builtin_function(agg.function)]
-            result.exclude_if_null = native_aggs
+            result.cells = ResultIterator(cursor, labels, batch,
+                                          row_format=row_format,
+                                          exclude_if_null=exclude_if_null,
+                                          batch_size=self.fetch_batch_size)
+            result.labels = labels
 
         return result
 
+    def _count_cells(self, result, prepared, params):
+        """Sets the total cell count of `result` from `prepared`
+        `DrilldownStatements` according to the `cell_count_mode`."""
+
+        if self.cell_count_mode == "estimate":
+            self._log_statement(prepared.cells_statement, "cell estimate")
+            estimate = estimate_row_count(self.connectable,
+                                          prepared.cells_statement,
+                                          params)
+            if estimate is not None:
+                result.total_cell_count = estimate
+                result.total_cell_count_approximate = True
+                return
+
+        counts = self.execute(prepared.count_statement, "cell count", params)
+        result.total_cell_count = counts.scalar()
+
+    def _drilldown_statements(self, cell, aggregates, drilldown, split, order,
+                              page, page_size, aggregate_table, single_pass,
+                              keyset_mode=None):
+        """Returns `DrilldownStatements` for aggregation drill-down. The
+        `statement` is ordered and paginated, `count_statement` counts all
+        the cells. See `provide_aggregate` for more information about the
+        `single_pass` modes. If `keyset_mode` is ``first`` or ``next`` then
+        the statement selects the first page or the page following bound
+        keyset values, `keyset` is the list of ordering labels and
+        directions."""
+
+        natural_order = drilldown.natural_order
+
+        (statement, labels) = self.aggregation_statement(cell,
+                                                         aggregates=aggregates,
+                                                         drilldown=drilldown,
+                                                         split=split,
+                                                         aggregate_table=aggregate_table,
+                                                         with_summary=(single_pass == "grouping_sets"))
+
+        if single_pass == "grouping_sets":
+            # Summary and cell count are part of the statement
+            ordered = single_pass_query(statement,
+                                        labels,
+                                        order,
+                                        natural_order,
+                                        page,
+                                        page_size)
+            return DrilldownStatements(ordered, None, None, labels, None)
+
+        count_statement = statement.alias().count()
+
+        if keyset_mode:
+            keys = [attr.ref for attr in drilldown.all_attributes]
+            if split:
+                keys.append(SPLIT_DIMENSION_NAME)
+
+            keyset = keyset_order(labels, order, natural_order, keys)
+            ordered = keyset_query(statement, labels, keyset,
+                                   after=(keyset_mode == "next"),
+                                   limit=self._keyset_limit(page_size))
+
+            return DrilldownStatements(ordered, count_statement, statement,
+                                       labels, keyset)
+
+        if single_pass == "window":
+            count = sql.functions.count().over()
+            ordered = statement.column(count.label(CELL_COUNT_LABEL))
+        else:
+            ordered = statement
+
+        ordered = order_query(ordered,
+                              order,
+                              natural_order,
+                              labels=labels)
+        ordered = paginate_query(ordered, page, page_size)
+
+        return DrilldownStatements(ordered, count_statement, statement,
+                                   labels, None)
+
+    def _single_pass_mode(self):
+        """Returns single-pass aggregation mode supported by the database:
+        ``grouping_sets`` when summary, cells and cell count can be
+        retrieved by one statement, ``window`` when cells and cell count can
+        be retrieved by one statement or `None` when separate statements
+        should be used."""
+
+        if not self.single_pass:
+            return None
+
+        dialect = self.connectable.dialect
+
+        if self.include_summary and supports_grouping_sets(dialect):
+            return "grouping_sets"
+        elif self.include_cell_count and supports_window_functions(dialect):
+            return "window"
+        else:
+            return None
+
+    # Report
+    # ======
+
+    def report(self, cell, queries, workers=None, timeout=None):
+        """Bundle multiple requests from `queries` into a single one. See
+        :meth:`AggregationBrowser.report` for more information.
+
+        If `merge_report_queries` is ``True`` then aggregation queries of the
+        same cell are answered together by one statement per cell, the other
+        queries are executed as usual."""
+
+        if not self.merge_report_queries:
+            return super(SQLBrowser, self).report(cell, queries, workers,
+                                                  timeout)
+
+        merged = self._merge_report_queries(cell, queries)
+        remaining = dict((name, query) for name, query in queries.items()
+                         if name not in merged)
+
+        report_result = super(SQLBrowser, self).report(cell, remaining,
+                                                       workers, timeout)
+        report_result.update(merged)
+
+        return report_result
+
+    def _mergeable_report_query(self, cell, query):
+        """Returns a tuple (`cell`, `aggregates`, `drilldown`) of a report
+        `query` that can be merged with other queries or `None` if the query
+        has to be executed separately."""
+
+        if query.get("query") != "aggregate":
+            return None
+
+        if set(query.keys()) - set(MERGEABLE_QUERY_KEYS):
+            return None
+
+        try:
+            rollup = query.get("rollup")
+            query_cell = cell.rollup(rollup) if rollup else cell
+            aggregates = self.prepare_aggregates(query.get("aggregates"))
+            drilldown = Drilldown(query.get("drilldown"), query_cell)
+            if drilldown:
+                self.assert_low_cardinality(query_cell, drilldown)
+        except (CubesError, NotImplementedError):
+            # Let the error be raised (or reported) by the query itself
+            return None
+
+        # Post-calculated aggregates are computed by `aggregate()`
+        if any(agg.function and not self.is_builtin_function(agg.function)
+               for agg in aggregates):
+            return None
+
+        # Queries answered by an aggregate table are cheap already
+        if self.aggregate_table(query_cell, aggregates, drilldown) is not None:
+            return None
+
+        return (query_cell, aggregates, drilldown)
+
+    def _merge_report_queries(self, cell, queries):
+        """Executes aggregation `queries` that can be merged and returns a
+        dictionary with their results. Queries that can not be merged are
+        not included."""
+
+        # List of tuples (`cell`, `entries`) where entries are tuples
+        # (`name`, `aggregates`, `drilldown`)
+        groups = []
+
+        for name, query in queries.items():
+            mergeable = self._mergeable_report_query(cell, query)
+            if mergeable is None:
+                continue
+
+            (query_cell, aggregates, drilldown) = mergeable
+            entry = (name, aggregates, drilldown)
+
+            for (group_cell, entries) in groups:
+                if group_cell == query_cell:
+                    entries.append(entry)
+                    break
+            else:
+                groups.append((query_cell, [entry]))
+
+        merged = {}
+        dialect = self.connectable.dialect
+
+        for (group_cell, entries) in groups:
+            if len(entries) < 2:
+                continue
+
+            if supports_grouping_sets(dialect):
+                grouping_sets = True
+            elif all(agg.function and get_rollup_function(agg.function)
+                     for (_, aggregates, _) in entries
+                     for agg in aggregates):
+                grouping_sets = False
+            else:
+                continue
+
+            try:
+                results = self._merged_aggregate(group_cell, entries,
+                                                 grouping_sets)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                self.logger.warning("merged report aggregation failed, "
+                                    "queries will be executed separately: "
+                                    "%s" % e)
+                continue
+
+            merged.update(results)
+
+        return merged
+
+    def _merged_aggregate(self, cell, entries, grouping_sets):
+        """Aggregates `cell` for all the `entries` – tuples (`name`,
+        `aggregates`, `drilldown`) with one statement and returns a
+        dictionary of `AggregationResult` objects by name."""
+
+        aggregates = []
+        for (_, entry_aggregates, _) in entries:
+            for aggregate in entry_aggregates:
+                if aggregate not in aggregates:
+                    aggregates.append(aggregate)
+
+        drilldowns = [drilldown for (_, _, drilldown) in entries]
+
+        shape = ("report",
+                 grouping_sets,
+                 self.query_shape(cell, aggregates),
+                 tuple(self.query_shape(cell, aggregates, drilldown)[2]
+                       for drilldown in drilldowns))
+
+        (statement, labels) = self.prepare(shape,
+                                           self.merged_aggregation_statement,
+                                           cell, aggregates, drilldowns,
+                                           grouping_sets)
+
+        params = self.query_parameters(cell)
+        cursor = self.execute(statement, "merged report aggregation", params)
+
+        # Records of the grouping sets (or roll-ups) by the set of
+        # attributes references
+        records = {}
+        refs = labels[:-len(aggregates)]
+
+        if grouping_sets:
+            for row in cursor:
+                flags = row[len(labels):]
+                key = frozenset(ref for (ref, flag) in zip(refs, flags)
+                                if not flag)
+                record = dict(zip(labels, row))
+                records.setdefault(key, []).append(record)
+        else:
+            rows = [dict(zip(labels, row)) for row in cursor]
+
+        results = {}
+
+        for (name, entry_aggregates, drilldown) in entries:
+            keys = [attr.ref for attr in drilldown.all_attributes]
+            agg_refs = [agg.ref for agg in entry_aggregates]
+
+            if grouping_sets:
+                summary = records.get(frozenset(), [None])[0]
+                cells = records.get(frozenset(keys), [])
+            else:
+                summary = rollup_rows(rows, [], aggregates)[0]
+                cells = rollup_rows(rows, keys, entry_aggregates)
+
+            result = AggregationResult(cell=cell,
+                                       aggregates=entry_aggregates,
+                                       drilldown=drilldown)
+
+            if self.include_summary or not drilldown:
+                if summary is not None:
+                    summary = dict((ref, summary[ref]) for ref in agg_refs)
+                result.summary = summary
+
+            if drilldown:
+                labels = keys + agg_refs
+                cells = [dict((label, record[label]) for label in labels)
+                         for record in cells]
+
+                # Neither the grouping sets nor the roll-up keep the order
+                # of the separately executed query
+                order = [(attr.ref, direction) for (attr, direction)
+                         in drilldown.natural_order if attr.ref in keys]
+                cells = sort_records(cells, order)
+
+                if self.include_cell_count:
+                    result.total_cell_count = len(cells)
+
+                if self.exclude_null_agregates:
+                    cells = [record for record in cells
+                             if all(record[ref] is not None
+                                    for ref in agg_refs)]
+
+                result.levels = drilldown.result_levels()
+                result.cells = cells
+                result.labels = labels
+
+            results[name] = result
+
+        return results
+
     def _create_context(self, attributes):
         """Create a query context for `attributes`. The `attributes` should
         contain all attributes that will be somehow involved in the query."""
 
-        collected = self.cube.collect_dependencies(attributes)
-        return QueryContext(self.star,
-                            attributes=collected,
-                            hierarchies=self.hierarchies,
-                            parameters=None,
-                            safe_labels=self.safe_labels)
+        key = (None,
+               frozenset(attr.ref for attr in attributes),
+               self.safe_labels)
+
+        context = self._contexts.get(key)
+
+        if context is None:
+            collected = self.cube.collect_dependencies(attributes)
+            context = QueryContext(self.star,
+                                   attributes=collected,
+                                   hierarchies=self.hierarchies,
+                                   parameters=None,
+                                   safe_labels=self.safe_labels)
+            self._contexts[key] = context
+
+        return context
+
+    def _create_aggregate_table_context(self, table, refs):
+        """Create a query context for aggregate table `table` and attribute
+        references `refs`. All the attributes are plain columns of the
+        table."""
+
+        key = (table.key, frozenset(refs), self.safe_labels)
+
+        context = self._contexts.get(key)
+
+        if context is None:
+            attributes = [StoredAttribute(ref, True) for ref in refs]
+            context = QueryContext(self._aggregate_star(table),
+                                   attributes=attributes,
+                                   hierarchies=self.hierarchies,
+                                   parameters=None,
+                                   safe_labels=self.safe_labels)
+            self._contexts[key] = context
+
+        return context
+
+    def clear_cache(self):
+        """Clears cached star joins, query contexts and aggregate table
+        schemas. Should be called when the model or the database schema
+        changes while the browser is still in use."""
+
+        self.star.clear_cache()
+        self._contexts.clear()
+        self._statements.clear()
+        self._compiled.clear()
+        self._aggregate_stars.clear()
 
     def denormalized_statement(self, attributes=None, cell=None,
                                include_fact_key=False):
@@ -507,7 +1449,8 @@ class SQLBrowser(AggregationBrowser):
     # This is the reason of our whole existence.
     #
     def aggregation_statement(self, cell, aggregates, drilldown=None,
-                              split=None, for_summary=False):
+                              split=None, for_summary=False,
+                              aggregate_table=None, with_summary=False):
         """Builds a statement to aggregate the `cell` and reutrns a tuple
         (`statement`, `labels`). `statement` is a SQLAlchemy statement object,
         `labels` is a list of attribute names selected in the statement. The
@@ -521,6 +1464,14 @@ class SQLBrowser(AggregationBrowser):
         * `split` – split cell for split condition
         * `for_summary` – do not perform `GROUP BY` for the drilldown. The
           drilldown is used only for choosing tables to join
+        * `aggregate_table` – an optional `AggregateTable` to be aggregated
+          instead of the star schema. The table should be able to answer the
+          query, see :meth:`aggregate_table`.
+        * `with_summary` – group by the drilldown and by an empty grouping
+          set to get the summary row from the same statement. The statement
+          has an extra column labelled ``__summary__`` with value ``1`` for
+          the summary row. The column is not included in the labels. Requires
+          a database with ``GROUPING SETS`` support.
         """
         # * `across` – cubes that share dimensions
 
@@ -547,7 +1498,17 @@ class SQLBrowser(AggregationBrowser):
         # attributes, for example those that aggregate depends on
         refs = collect_attributes(aggregates, cell, drilldown, split)
         attributes = self.cube.get_attributes(refs, aggregated=True)
-        context = self._create_context(attributes)
+
+        if aggregate_table is None:
+            context = self._create_context(attributes)
+        else:
+            aggregate_refs = set(agg.ref for agg in aggregates)
+            refs = []
+            for attr in attributes:
+                if attr.ref not in aggregate_refs and attr.ref not in refs:
+                    refs.append(attr.ref)
+            context = self._create_aggregate_table_context(aggregate_table,
+                                                           refs)
 
         # Drilldown – Group-by
         # --------------------
@@ -571,7 +1532,12 @@ class SQLBrowser(AggregationBrowser):
 
         # TODO: coalesce if there are outer joins
         # TODO: ignore post-aggregations
-        aggregate_cols = context.get_columns([agg.ref for agg in aggregates])
+        if aggregate_table is None:
+            aggregate_cols = context.get_columns([agg.ref for agg in aggregates])
+        else:
+            star_schema = context.star_schema
+            aggregate_cols = [rollup_expression(agg, star_schema.column(agg.ref))
+                              for agg in aggregates]
 
         if for_summary:
             # Don't include the group-by part (see issue #157 for more
@@ -580,13 +1546,100 @@ class SQLBrowser(AggregationBrowser):
         else:
             selection += aggregate_cols
 
+        if with_summary and group_by:
+            group_by = [sql.expression.func.grouping_sets(
+                            sql.expression.tuple_(*group_by),
+                            sql.expression.tuple_())]
+            summary_flag = sql.expression.func.grouping(selection[0])
+        else:
+            summary_flag = None
+
         statement = sql.expression.select(selection,
                                           from_obj=context.star,
                                           use_labels=True,
                                           whereclause=condition,
                                           group_by=group_by)
 
-        return (statement, context.get_labels(statement.columns))
+        labels = context.get_labels(statement.columns)
+
+        if summary_flag is not None:
+            summary_flag = summary_flag.label(SUMMARY_FLAG_LABEL)
+            statement = statement.column(summary_flag)
+
+        return (statement, labels)
+
+    def merged_aggregation_statement(self, cell, aggregates, drilldowns,
+                                     grouping_sets=False):
+        """Builds one statement to aggregate the `cell` by each of the
+        `drilldowns` and returns a tuple (`statement`, `labels`). The
+        statement selects attributes of all the drilldowns followed by the
+        `aggregates`.
+
+        If `grouping_sets` is ``True`` then the statement is grouped by
+        grouping sets of every drilldown and by an empty grouping set for the
+        summary. Requires a database with ``GROUPING SETS`` support. For
+        every selected attribute there is an extra column labelled
+        ``__grouping_N__`` which is ``1`` if the attribute is not part of
+        the grouping set of the row. The columns are not included in the
+        labels.
+
+        Otherwise the statement is grouped by attributes of all the
+        drilldowns and the coarser aggregations have to be rolled-up from
+        the rows, see :func:`cubes.sql.aggregates.rollup_rows`.
+        """
+
+        if not aggregates:
+            raise ArgumentError("List of aggregates should not be empty")
+
+        refs = []
+        for drilldown in drilldowns:
+            for attr in drilldown.all_attributes:
+                if attr.ref not in refs:
+                    refs.append(attr.ref)
+
+        collected = collect_attributes(aggregates, cell, *drilldowns)
+        attributes = self.cube.get_attributes(collected, aggregated=True)
+        context = self._create_context(attributes)
+
+        group_columns = context.get_columns(refs)
+        condition = context.condition_for_cell(cell)
+
+        selection = group_columns[:]
+        selection += context.get_columns([agg.ref for agg in aggregates])
+
+        if grouping_sets:
+            # Drilldowns with the same attributes share one grouping set
+            sets = []
+            grouped = set([frozenset()])
+            for drilldown in drilldowns:
+                set_refs = [attr.ref for attr in drilldown.all_attributes]
+                if frozenset(set_refs) in grouped:
+                    continue
+                grouped.add(frozenset(set_refs))
+
+                columns = [group_columns[refs.index(ref)] for ref in set_refs]
+                sets.append(sql.expression.tuple_(*columns))
+            sets.append(sql.expression.tuple_())
+
+            group_by = [sql.expression.func.grouping_sets(*sets)]
+        else:
+            group_by = group_columns or None
+
+        statement = sql.expression.select(selection,
+                                          from_obj=context.star,
+                                          use_labels=True,
+                                          whereclause=condition,
+                                          group_by=group_by)
+
+        labels = context.get_labels(statement.columns)
+
+        if grouping_sets:
+            for i, column in enumerate(group_columns):
+                flag = sql.expression.func.grouping(column)
+                statement = statement.column(flag.label(GROUPING_FLAG_LABEL
+                                                        .format(i)))
+
+        return (statement, labels)
 
     def _log_statement(self, statement, label=None):
         label = "SQL(%s):" % label if label else "SQL:"
@@ -595,26 +1648,52 @@ class SQLBrowser(AggregationBrowser):
 
 class ResultIterator(object):
     """
-    Iterator that returns SQLAlchemy ResultProxy rows as dictionaries
+    Iterator that returns SQLAlchemy ResultProxy rows as dictionaries or as
+    :class:`cubes.query.ResultRow` objects if `row_format` is ``row``.
     """
-    def __init__(self, result, labels):
+    def __init__(self, result, labels, batch=None, row_format=None,
+                 exclude_if_null=None, batch_size=None):
+        """Creates an iterator over the `result` rows. `batch` is an optional
+        deque of rows already fetched from the `result`. Rows where any of
+        the `exclude_if_null` labels has ``NULL`` value are skipped. Rows
+        are fetched from the `result` by `batch_size` rows at once."""
+
         self.result = result
-        self.batch = None
+        self.batch = batch
         self.labels = labels
-        self.exclude_if_null = None
+        self.row_format = row_format or "dict"
+        self.exclude_if_null = exclude_if_null
+        self.batch_size = batch_size
+        # Token of the next page of keyset pagination
+        self.continuation = None
 
     def __iter__(self):
+        if self.exclude_if_null:
+            excluded = [self.labels.index(label)
+                        for label in self.exclude_if_null]
+        else:
+            excluded = None
+
+        if self.row_format == "row":
+            index = ResultRow.index_for_labels(self.labels)
+        else:
+            index = None
+
+        labels = self.labels
+
         while True:
             if not self.batch:
-                many = self.result.fetchmany()
+                many = self.result.fetchmany(self.batch_size)
                 if not many:
                     break
                 self.batch = collections.deque(many)
 
             row = self.batch.popleft()
 
-            if self.exclude_if_null \
-                    and any(row[agg] is None for agg in self.exclude_if_null):
+            if excluded and any(row[i] is None for i in excluded):
                 continue
 
-            yield dict(zip(self.labels, row))
+            if index is not None:
+                yield ResultRow(row, index)
+            else:
+                yield dict(zip(labels, row))
@@ -22,6 +22,7 @@ from ..errors import ModelError
 
 __all__ = (
     "get_aggregate_function",
+    "get_rollup_function",
     "available_aggregate_functions"
 )
 
@@ -179,6 +180,19 @@ _functions = (
 
 _function_dict = {}
 
+# Functions that can be computed from already aggregated values, for example
+# from an aggregate table or from a finer drill-down. Keys are aggregate
+# function names, values are names of functions that combine the partial
+# aggregates. Functions not listed here (such as `avg` or `count_distinct`)
+# have to be computed from the facts.
+_rollup_functions = {
+    "sum": "sum",
+    "count": "sum",
+    "count_nonempty": "sum",
+    "min": "min",
+    "max": "max"
+}
+
 
 def _create_function_dict():
     if not _function_dict:
@@ -195,6 +209,14 @@ def get_aggregate_function(name):
     return _function_dict[name]
 
 
+def get_rollup_function(name):
+    """Returns name of a function that combines partial aggregates of the
+    aggregate function `name` into a coarser aggregate. Returns `None` if
+    the function `name` is not additive and can not be rolled-up."""
+
+    return _rollup_functions.get(name)
+
+
 def available_aggregate_functions():
     """Returns a list of available aggregate function names."""
     _create_function_dict()
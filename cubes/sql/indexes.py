@@ -0,0 +1,202 @@
+# -*- encoding=utf -*-
+"""Index planner – composite indexes of denormalized views and aggregate
+tables that follow the order of the hierarchy levels."""
+
+from __future__ import absolute_import
+
+from collections import namedtuple
+
+try:
+    import sqlalchemy as sa
+except ImportError:
+    from ..common import MissingPackage
+    sa = MissingPackage("sqlalchemy", "SQL")
+
+from .aggregates import cuboid_levels
+
+
+__all__ = (
+    "IndexPlanner",
+    "IndexSpec",
+    "IndexIssue",
+    "cube_hierarchy_keys",
+    "cuboid_hierarchy_keys",
+)
+
+
+IndexSpec = namedtuple("IndexSpec", ["name", "columns"])
+
+IndexIssue = namedtuple("IndexIssue", ["name", "columns", "issue",
+                                       "message"])
+
+
+def cube_hierarchy_keys(cube):
+    """Returns a dictionary of level keys of all hierarchies of `cube`. Keys
+    are tuples (`dimension`, `hierarchy`) and values are lists of level key
+    references in the order of the hierarchy levels. See
+    :meth:`cubes.Cube.distilled_hierarchies`."""
+
+    # Default hierarchy is included also under its own name
+    return {(dimension, hierarchy): keys
+            for ((dimension, hierarchy), keys)
+            in cube.distilled_hierarchies.items()
+            if hierarchy is not None}
+
+
+def cuboid_hierarchy_keys(cube, dimensions):
+    """Returns a dictionary of level keys of a cuboid of `cube` aggregated at
+    `dimensions` in the form of :func:`cube_hierarchy_keys`."""
+
+    return {(dimension.name, hierarchy.name): [level.key.ref
+                                               for level in levels]
+            for (dimension, hierarchy, levels)
+            in cuboid_levels(cube, dimensions)}
+
+
+class IndexPlanner(object):
+    """Plans indexes of a `table` – a denormalized view or an aggregate
+    table – with columns named by attribute references.
+
+    The conditions of cuts and ranges built by the query context constrain
+    the level keys of a hierarchy from the top level down, such as year,
+    month and day. One composite index of the level keys in the hierarchy
+    order is planned for every hierarchy in `hierarchies` (see
+    :func:`cube_hierarchy_keys` and :func:`cuboid_hierarchy_keys`) instead
+    of one index per key column. Index of a hierarchy that is a prefix of
+    another hierarchy, such as year and month of year, month and day, is
+    not planned – the longer index serves both.
+
+    * `key` – name of the fact key column to be indexed on its own, ignored
+      if the table has no such column
+    * `covering` – list of columns, such as measures or aggregates, appended
+      to every hierarchy index so the aggregations can be answered from the
+      index only
+
+    .. versionadded:: 1.2
+    """
+
+    def __init__(self, table, hierarchies, key=None, covering=None):
+        self.table = table
+
+        if key is not None and key in table.columns:
+            self.key = key
+        else:
+            self.key = None
+
+        self.covering = [column for column in covering or []
+                         if column in table.columns]
+
+        self.hierarchies = {}
+
+        for (dimension, hierarchy), keys in hierarchies.items():
+            # Levels below a level missing in the table can not be used
+            columns = []
+            for ref in keys:
+                if ref not in table.columns:
+                    break
+                columns.append(ref)
+
+            if columns:
+                self.hierarchies[(dimension, hierarchy)] = columns
+
+    def plan(self):
+        """Returns a list of planned indexes as `IndexSpec` tuples (`name`,
+        `columns`)."""
+
+        indexes = []
+
+        if self.key:
+            name = "idx_%s_%s" % (self.table.name, self.key)
+            indexes.append(IndexSpec(name, [self.key]))
+
+        paths = list(self.hierarchies.values())
+        planned = []
+
+        for (dimension, hierarchy), columns in sorted(self.hierarchies.items()):
+            longer = [other for other in paths
+                      if len(other) > len(columns)
+                      and other[0:len(columns)] == columns]
+
+            if longer or columns in planned:
+                continue
+
+            planned.append(columns)
+
+            columns = columns + [column for column in self.covering
+                                 if column not in columns]
+            name = "idx_%s_%s_%s" % (self.table.name, dimension, hierarchy)
+
+            indexes.append(IndexSpec(name, columns))
+
+        return indexes
+
+    def existing(self, connectable):
+        """Returns a list of indexes of the table in the database as
+        `IndexSpec` tuples."""
+
+        inspector = sa.inspect(connectable)
+        indexes = inspector.get_indexes(self.table.name,
+                                        schema=self.table.schema)
+
+        return [IndexSpec(index["name"], list(index["column_names"]))
+                for index in indexes]
+
+    def create(self, connectable):
+        """Creates the planned indexes that do not exist in the database yet.
+        Returns a list of created `IndexSpec` tuples."""
+
+        existing = [index.columns for index in self.existing(connectable)]
+        created = []
+
+        for index in self.plan():
+            if index.columns in existing:
+                continue
+
+            columns = [self.table.columns[column] for column in index.columns]
+            sa.schema.Index(index.name, *columns).create(connectable)
+            created.append(index)
+
+        return created
+
+    def review(self, indexes):
+        """Reviews existing `indexes` – list of `IndexSpec` tuples, see
+        :meth:`existing`. Returns a list of `IndexIssue` tuples (`name`,
+        `columns`, `issue`, `message`) where `issue` is:
+
+        * ``duplicate`` – the index has the same columns as another index
+        * ``redundant`` – the columns are a prefix of another index, which
+          serves the same conditions
+        * ``unused`` – the first column is neither the fact key nor the top
+          level key of a hierarchy, no cut condition can use the index
+        """
+
+        issues = []
+        leading = set(columns[0] for columns in self.hierarchies.values())
+        if self.key:
+            leading.add(self.key)
+
+        for i, index in enumerate(indexes):
+            columns = index.columns
+            others = indexes[0:i] + indexes[i + 1:]
+
+            same = [other.name for other in indexes[0:i]
+                    if other.columns == columns]
+            longer = [other.name for other in others
+                      if len(other.columns) > len(columns)
+                      and other.columns[0:len(columns)] == columns]
+
+            if same:
+                issues.append(IndexIssue(index.name, columns, "duplicate",
+                                         "same columns as index '%s'"
+                                         % same[0]))
+            elif longer:
+                issues.append(IndexIssue(index.name, columns, "redundant",
+                                         "columns are prefix of index '%s'"
+                                         % longer[0]))
+            elif not columns or columns[0] not in leading:
+                issues.append(IndexIssue(index.name, columns, "unused",
+                                         "no condition starts with column "
+                                         "'%s'" % (columns[0] if columns
+                                                   else None)))
+
+        return issues
@@ -2,12 +2,12 @@
 
 from __future__ import absolute_import
 
-from ...server.logging import RequestLogHandler, REQUEST_LOG_ITEMS
+from ..server.logging import RequestLogHandler, REQUEST_LOG_ITEMS
 from sqlalchemy import create_engine, Table, MetaData, Column
 from sqlalchemy import Integer, Sequence, DateTime, String, Float
 from sqlalchemy.exc import NoSuchTableError
-from ...browser import Drilldown
-from .store import create_sqlalchemy_engine
+from ..query import Drilldown
+from .store import sqlalchemy_options
 
 import logging
 
@@ -15,7 +15,7 @@ class SQLRequestLogHandler(RequestLogHandler):
     def __init__(self, url=None, table=None, dimensions_table=None, **options):
 
         self.url = url
-        self.engine = create_sqlalchemy_engine(url, options)
+        self.engine = create_engine(url, **sqlalchemy_options(options))
 
         metadata = MetaData(bind=self.engine)
 
@@ -143,3 +143,19 @@ class SQLRequestLogHandler(RequestLogHandler):
         trans.commit()
         connection.close()
 
+
+def read_sql_request_log(url, table, schema=None):
+    """Yields records of a request log written by `SQLRequestLogHandler`
+    into `table` of a database at `url` – dictionaries with keys `cube`,
+    `method`, `cell`, `split`, `drilldown` and others, see
+    `REQUEST_LOG_ITEMS`."""
+
+    engine = create_engine(url)
+    metadata = MetaData(bind=engine)
+
+    table = Table(table, metadata, autoload=True, schema=schema)
+
+    result = engine.execute(table.select().order_by(table.c.id))
+
+    for row in result:
+        yield dict(row.items())
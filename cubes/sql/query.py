@@ -18,12 +18,14 @@ Star/snowflake schema query construction structures
 from __future__ import absolute_import
 
 import logging
+import threading
 from collections import namedtuple
 
 import sqlalchemy as sa
 import sqlalchemy.sql as sql
 from sqlalchemy.sql.expression import and_
 
+from ..datastructures import LRUCache
 from ..metadata import object_dict
 from ..errors import InternalError, ModelError, ArgumentError, HierarchyError
 from .. import compat
@@ -36,6 +38,17 @@ from .expressions import compile_attributes
 # Default label for all fact keys
 FACT_KEY_LABEL = '__fact_key__'
 
+# Reflection adds a table to the shared metadata before its columns are
+# reflected, stars created concurrently would see incomplete tables
+_reflection_lock = threading.RLock()
+
+# Default number of cached star joins and query contexts
+DEFAULT_CACHE_SIZE = 128
+
+# Prefixes of names of bound parameters with cut values
+CUT_PARAMETER_PREFIX = "cut"
+SPLIT_PARAMETER_PREFIX = "split"
+
 # Attribute -> Column
 # IF attribute has no 'expression' then mapping is used
 # IF attribute has expression, the expression is used and underlying mappings
@@ -292,6 +305,8 @@ class StarSchema(object):
       the actual metadata. Only table name has to be specified and database
       schema should not be used in this case.
     * `schema` – default database schema containing tables
+    * `cache_size` – maximal number of joined stars kept by
+      :meth:`get_star`, ``None`` for unlimited, ``0`` to disable caching
 
     The columns can be specified as:
 
@@ -332,7 +347,8 @@ class StarSchema(object):
     """
 
     def __init__(self, label, metadata, mappings, fact, fact_key='id',
-                 joins=None, tables=None, schema=None):
+                 joins=None, tables=None, schema=None,
+                 cache_size=DEFAULT_CACHE_SIZE):
 
         # TODO: expectation is, that the snowlfake is already localized, the
         # owner of the snowflake should generate one snowflake per locale.
@@ -356,6 +372,8 @@ class StarSchema(object):
         self._columns = {}
         # Keys are tuples (schema, table)
         self._tables = {}
+        # Joined stars, keys are frozen sets of base attribute references
+        self._stars = LRUCache(cache_size)
 
         self.logger = logging.getLogger("cubes.starschema")
 
@@ -522,10 +540,11 @@ class StarSchema(object):
         coalesced_schema = schema or self.schema
 
         try:
-            table = sa.Table(name,
-                             self.metadata,
-                             autoload=True,
-                             schema=coalesced_schema)
+            with _reflection_lock:
+                table = sa.Table(name,
+                                 self.metadata,
+                                 autoload=True,
+                                 schema=coalesced_schema)
 
         except sa.exc.NoSuchTableError:
             in_schema = (" in schema '{}'"
@@ -693,9 +712,27 @@ class StarSchema(object):
                                                  from_obj=star,
                                                  whereclause=condition)
             result = engine.execute(statement)
+
+        The constructed joins are cached by the set of `attributes`.
         """
 
         attributes = [str(attr) for attr in attributes]
+        key = frozenset(attributes)
+
+        star = self._stars.get(key)
+        if star is None:
+            star = self._create_star(attributes)
+            self._stars[key] = star
+
+        return star
+
+    def clear_cache(self):
+        """Clears cached star joins."""
+        self._stars.clear()
+
+    def _create_star(self, attributes):
+        """Returns joined star for `attributes`. See :meth:`get_star`."""
+
         # Collect all the tables first:
         tables = self.required_tables(attributes)
 
@@ -937,41 +974,46 @@ class QueryContext(object):
 
         return [self._columns[ref] for ref in refs]
 
-    def condition_for_cell(self, cell):
+    def condition_for_cell(self, cell, prefix=CUT_PARAMETER_PREFIX):
         """Returns a condition for cell `cell`. If cell is empty or cell is
-        `None` then returns `None`."""
+        `None` then returns `None`. The cut values are bound as parameters
+        named with `prefix`, see :func:`cell_parameters`."""
 
         if not cell:
             return None
 
-        condition = and_(*self.conditions_for_cuts(cell.cuts))
+        condition = and_(*self.conditions_for_cuts(cell.cuts, prefix))
 
         return condition
 
-    def conditions_for_cuts(self, cuts):
+    def conditions_for_cuts(self, cuts, prefix=CUT_PARAMETER_PREFIX):
         """Constructs conditions for all cuts in the `cell`. Returns a list of
-        SQL conditional expressions.
+        SQL conditional expressions. The cut values are bound as parameters
+        named with `prefix`, see :func:`cell_parameters`.
         """
 
         conditions = []
 
-        for cut in cuts:
+        for i, cut in enumerate(cuts):
             hierarchy = str(cut.hierarchy) if cut.hierarchy else None
+            name = "{}{}".format(prefix, i)
 
             if isinstance(cut, PointCut):
                 path = cut.path
                 condition = self.condition_for_point(str(cut.dimension),
                                                      path,
-                                                     hierarchy, cut.invert)
+                                                     hierarchy, cut.invert,
+                                                     name=name)
 
             elif isinstance(cut, SetCut):
                 set_conds = []
 
-                for path in cut.paths:
+                for j, path in enumerate(cut.paths):
                     condition = self.condition_for_point(str(cut.dimension),
                                                          path,
-                                                         str(cut.hierarchy),
-                                                         invert=False)
+                                                         hierarchy,
+                                                         invert=False,
+                                                         name="{}_{}".format(name, j))
                     set_conds.append(condition)
 
                 condition = sql.expression.or_(*set_conds)
@@ -983,7 +1025,8 @@ class QueryContext(object):
                 condition = self.range_condition(str(cut.dimension),
                                                  hierarchy,
                                                  cut.from_path,
-                                                 cut.to_path, cut.invert)
+                                                 cut.to_path, cut.invert,
+                                                 name=name)
 
             else:
                 raise ArgumentError("Unknown cut type %s" % type(cut))
@@ -992,20 +1035,23 @@ class QueryContext(object):
 
         return conditions
 
-    def condition_for_point(self, dim, path, hierarchy=None, invert=False):
+    def condition_for_point(self, dim, path, hierarchy=None, invert=False,
+                            name=None):
         """Returns a `Condition` tuple (`attributes`, `conditions`,
         `group_by`) dimension `dim` point at `path`. It is a compound
         condition - one equality condition for each path element in form:
-        ``level[i].key = path[i]``"""
+        ``level[i].key = path[i]``. If `name` is specified, then the path
+        values are bound as parameters ``name_i``."""
 
         conditions = []
 
         levels = self.level_keys(dim, hierarchy, path)
 
-        for level_key, value in zip(levels, path):
+        for i, (level_key, value) in enumerate(zip(levels, path)):
 
             # Prepare condition: dimension.level_key = path_value
             column = self.column(level_key)
+            value = _bind_value(column, value, name, i)
             conditions.append(column == value)
 
         condition = sql.expression.and_(*conditions)
@@ -1016,12 +1062,22 @@ class QueryContext(object):
         return condition
 
     def range_condition(self, dim, hierarchy, from_path, to_path,
-                        invert=False):
+                        invert=False, name=None):
         """Return a condition for a hierarchical range (`from_path`,
-        `to_path`). Return value is a `Condition` tuple."""
+        `to_path`). Return value is a `Condition` tuple. If `name` is
+        specified, then the path values are bound as parameters
+        ``name_from_i`` and ``name_to_i``."""
+
+        if name is not None:
+            lower_name = "{}_from".format(name)
+            upper_name = "{}_to".format(name)
+        else:
+            lower_name = upper_name = None
 
-        lower = self._boundary_condition(dim, hierarchy, from_path, 0)
-        upper = self._boundary_condition(dim, hierarchy, to_path, 1)
+        lower = self._boundary_condition(dim, hierarchy, from_path, 0,
+                                         name=lower_name)
+        upper = self._boundary_condition(dim, hierarchy, to_path, 1,
+                                         name=upper_name)
 
         conditions = []
         if lower is not None:
@@ -1036,7 +1092,8 @@ class QueryContext(object):
 
         return condition
 
-    def _boundary_condition(self, dim, hierarchy, path, bound, first=True):
+    def _boundary_condition(self, dim, hierarchy, path, bound, first=True,
+                            name=None):
         """Return a `Condition` tuple for a boundary condition. If `bound` is
         1 then path is considered to be upper bound (operators < and <= are
         used), otherwise path is considered as lower bound (operators > and >=
@@ -1047,14 +1104,15 @@ class QueryContext(object):
             return None
 
         last = self._boundary_condition(dim, hierarchy, path[:-1], bound,
-                                        first=False)
+                                        first=False, name=name)
 
         levels = self.level_keys(dim, hierarchy, path)
 
         conditions = []
 
-        for level_key, value in zip(levels[:-1], path[:-1]):
+        for i, (level_key, value) in enumerate(zip(levels[:-1], path[:-1])):
             column = self.column(level_key)
+            value = _bind_value(column, value, name, i)
             conditions.append(column == value)
 
         # Select required operator according to bound
@@ -1068,7 +1126,8 @@ class QueryContext(object):
             operator = sql.operators.ge if first else sql.operators.gt
 
         column = self.column(levels[-1])
-        conditions.append(operator(column, path[-1]))
+        value = _bind_value(column, path[-1], name, len(path) - 1)
+        conditions.append(operator(column, value))
         condition = sql.expression.and_(*conditions)
 
         if last is not None:
@@ -1102,7 +1161,8 @@ class QueryContext(object):
     def column_for_split(self, split_cell, label=None):
         """Create a column for a cell split from list of `cust`."""
 
-        condition = self.condition_for_cell(split_cell)
+        condition = self.condition_for_cell(split_cell,
+                                            prefix=SPLIT_PARAMETER_PREFIX)
         split_column = sql.expression.case([(condition, True)],
                                            else_=False)
 
@@ -1110,3 +1170,81 @@ class QueryContext(object):
 
         return split_column.label(label)
 
+
+def _bind_value(column, value, name, index):
+    """Returns `value` as a parameter ``name_index`` of the type of `column`.
+    Returns plain `value` if `name` is ``None`` or if the value is ``None``,
+    so it can be compared using ``IS NULL``."""
+
+    if name is None or value is None:
+        return value
+
+    return sql.expression.bindparam("{}_{}".format(name, index),
+                                    value,
+                                    type_=column.type)
+
+
+def _path_shape(path):
+    return tuple(value is None for value in path or [])
+
+
+def cell_shape(cell):
+    """Returns a hashable structure of `cell` – types of the cuts, their
+    dimensions, hierarchies and path lengths, but not the path values. Cells
+    with the same shape produce the same conditions which differ only in
+    values of the bound parameters (see :func:`cell_parameters`)."""
+
+    if not cell:
+        return None
+
+    shape = []
+
+    for cut in cell.cuts:
+        if isinstance(cut, PointCut):
+            paths = (_path_shape(cut.path), )
+        elif isinstance(cut, SetCut):
+            paths = tuple(_path_shape(path) for path in cut.paths)
+        elif isinstance(cut, RangeCut):
+            paths = (_path_shape(cut.from_path), _path_shape(cut.to_path))
+        else:
+            raise ArgumentError("Unknown cut type %s" % type(cut))
+
+        shape.append((cut.__class__.__name__,
+                      str(cut.dimension),
+                      str(cut.hierarchy) if cut.hierarchy else None,
+                      bool(cut.invert),
+                      paths))
+
+    return tuple(shape)
+
+
+def cell_parameters(cell, prefix=CUT_PARAMETER_PREFIX):
+    """Returns a dictionary of values of parameters bound in conditions for
+    `cell` created by :meth:`QueryContext.condition_for_cell` with the same
+    `prefix`."""
+
+    params = {}
+
+    if not cell:
+        return params
+
+    def add(name, path):
+        for i, value in enumerate(path or []):
+            if value is not None:
+                params["{}_{}".format(name, i)] = value
+
+    for i, cut in enumerate(cell.cuts):
+        name = "{}{}".format(prefix, i)
+
+        if isinstance(cut, PointCut):
+            add(name, cut.path)
+        elif isinstance(cut, SetCut):
+            for j, path in enumerate(cut.paths):
+                add("{}_{}".format(name, j), path)
+        elif isinstance(cut, RangeCut):
+            add("{}_from".format(name), cut.from_path)
+            add("{}_to".format(name), cut.to_path)
+        else:
+            raise ArgumentError("Unknown cut type %s" % type(cut))
+
+    return params
@@ -2,26 +2,34 @@
 
 from __future__ import absolute_import
 
+from multiprocessing.pool import ThreadPool
+
 try:
     import sqlalchemy as sa
     import sqlalchemy.sql as sql
     from sqlalchemy.engine import reflection
     from sqlalchemy.orm.query import QueryContext
-    from sqlalchemy.schema import Index
 except ImportError:
     from ..common import MissingPackage
 
     reflection = sa = sql = MissingPackage("sqlalchemy", "SQL")
 
+from .aggregates import AggregateTable, merge_expression
+from .aggregates import cuboid_attributes, cuboid_levels
 from .browser import SQLBrowser
+from .functions import get_rollup_function
+from .indexes import IndexPlanner, cube_hierarchy_keys, cuboid_hierarchy_keys
 from .mapper import distill_naming, Naming
 from ..logging import get_logger
 from ..common import coalesce_options
 from ..stores import Store
 from ..errors import ArgumentError, StoreError, ConfigurationError
-from ..query import Drilldown, Cell
+from ..query import Drilldown, Cell, PointCut
 from .utils import CreateTableAsSelect, CreateOrReplaceView
-from ..metadata import string_to_dimension_level
+from .utils import load_metadata_snapshot, save_metadata_snapshot
+from .utils import supports_concurrency
+from ..metadata import string_to_dimension_level, collect_attributes
+from .. import compat
 
 
 __all__ = [
@@ -53,7 +61,15 @@ OPTION_TYPES = {
     "include_summary": "bool",
     "include_cell_count": "bool",
     "use_denormalization": "bool",
-    "safe_labels": "bool"
+    "safe_labels": "bool",
+    "use_aggregate_tables": "bool",
+    "single_pass": "bool",
+    "query_cache_size": "int",
+    "stream_results": "bool",
+    "fetch_batch_size": "int",
+    "report_workers": "int",
+    "report_timeout": "float",
+    "merge_report_queries": "bool"
 }
 
 
@@ -72,6 +88,21 @@ def sqlalchemy_options(options, prefix="sqlalchemy_"):
     return sa_options
 
 
+def _match_keys(left, right, keys):
+    """Returns condition matching columns `keys` of `left` and `right`
+    (column collections or dictionaries of expressions), where ``NULL``
+    matches ``NULL``."""
+
+    conditions = []
+    for key in keys:
+        conditions.append(sql.expression.or_(
+            left[key] == right[key],
+            sql.expression.and_(left[key].is_(None), right[key].is_(None))
+        ))
+
+    return sql.expression.and_(*conditions)
+
+
 class SQLStore(Store):
     def model_provider_name(self):
         return 'default'
@@ -144,6 +175,14 @@ class SQLStore(Store):
         * `denormalized_schema` - schema wehere denormalized views are
           located (use this if the views are in different schema than fact
           tables, otherwise default schema is going to be used)
+
+        Reflection:
+
+        * `metadata_snapshot` – path to a file with a snapshot of reflected
+          tables written by :meth:`save_metadata_snapshot` (or the ``slicer
+          sql reflect`` command). If the snapshot is valid, the tables are
+          not reflected from the database. Tables missing in the snapshot
+          are reflected on first use.
         """
         super(SQLStore, self).__init__(**options)
 
@@ -172,12 +211,61 @@ class SQLStore(Store):
         # shared open store per process. SQLAlchemy will take care about
         # necessary connections.
 
+        snapshot = self.options.get("metadata_snapshot")
+
+        if not metadata and snapshot:
+            metadata = load_metadata_snapshot(snapshot, self.connectable)
+
+            if metadata is not None and metadata.schema != self.schema:
+                metadata = None
+
+            if metadata is not None:
+                self.logger.debug("loaded %d tables from metadata snapshot "
+                                  "%s" % (len(metadata.tables), snapshot))
+            else:
+                self.logger.info("metadata snapshot %s does not exist or is "
+                                 "outdated, tables will be reflected"
+                                 % snapshot)
+
         if metadata:
             self.metadata = metadata
         else:
             self.metadata = sa.MetaData(bind=self.connectable,
                                         schema=self.schema)
 
+        # Registry of aggregate tables. Keys are cube names, values are lists
+        # of `AggregateTable` objects.
+        self.aggregate_tables = {}
+
+    def save_metadata_snapshot(self, path=None):
+        """Writes tables reflected so far to a metadata snapshot file `path`
+        or to the file from the `metadata_snapshot` option. Other processes
+        using the store with the snapshot option load the tables from the
+        snapshot instead of reflecting them from the database."""
+
+        path = path or self.options.get("metadata_snapshot")
+
+        if not path:
+            raise ArgumentError("No path of metadata snapshot specified")
+
+        save_metadata_snapshot(self.metadata, path, self.connectable)
+
+    def register_aggregate_table(self, cube, table):
+        """Registers aggregate table `table` of `cube`. Browsers of the cube
+        will consider the table for answering aggregation queries. `table`
+        is an `AggregateTable` object or a dictionary. Previously registered
+        table with the same name and schema is replaced."""
+
+        table = AggregateTable.from_metadata(table)
+        name = str(cube) if isinstance(cube, compat.string_type) else cube.name
+
+        tables = [existing for existing
+                  in self.aggregate_tables.get(name, [])
+                  if existing.key != table.key]
+        tables.append(table)
+
+        self.aggregate_tables[name] = tables
+
     # TODO: make a separate SQL utils function
     def _drop_table(self, table, schema, force=False):
         """Drops `table` in `schema`. If table exists, exception is raised
@@ -293,7 +381,8 @@ class SQLStore(Store):
 
     def create_denormalized_view(self, cube, view_name=None, materialize=False,
                                  replace=False, create_index=False,
-                                 keys_only=False, schema=None):
+                                 keys_only=False, schema=None,
+                                 covering_index=False):
         """Creates a denormalized view named `view_name` of a `cube`. If
         `view_name` is ``None`` then view name is constructed by pre-pending
         value of `denormalized_view_prefix` from workspace options to the cube
@@ -307,17 +396,27 @@ class SQLStore(Store):
         * `replace` - if `True` then existing table/view will be replaced,
           otherwise an exception is raised when trying to create view/table
           with already existing name
-        * `create_index` - if `True` then index is created for each key
-          attribute. Can be used only on materialized view, otherwise raises
-          an exception
+        * `create_index` - if `True` then a composite index of level keys is
+          created for each hierarchy, in the order of the hierarchy levels,
+          and an index of the fact key (see
+          :class:`cubes.sql.indexes.IndexPlanner`). Can be used only on
+          materialized view, otherwise raises an exception
+        * `covering_index` - if `True` then the measures are included in the
+          hierarchy indexes
         * `keys_only` - if ``True`` then only key attributes are used in the
           view, all other detail attributes are ignored
         * `schema` - target schema of the denormalized view, if not specified,
           then `denormalized_view_schema` from options is used if specified,
           otherwise default workspace schema is used (same schema as fact
           table schema).
+
+        Materialized view can be updated with changed facts only by
+        :meth:`refresh_denormalized_view`.
         """
 
+        if create_index and not materialize:
+            raise ArgumentError("Non-materialized views can't be indexed")
+
         browser = SQLBrowser(cube, self, schema=schema)
 
         if browser.safe_labels:
@@ -327,8 +426,8 @@ class SQLStore(Store):
         # Note: this does not work with safe labels – since they are "safe"
         # they can not conform to the cubes implicit naming schema dim.attr
 
-        (statement, _) = browser.denormalized_statement(attributes,
-                                                        include_fact_key=True)
+        attributes = self._denormalized_attributes(cube, keys_only)
+        statement = self._denormalized_view_statement(browser, attributes)
 
         schema = schema or self.naming.schema
         view_name = view_name or self.naming.denormalized_table_name(cube.name)
@@ -354,20 +453,288 @@ class SQLStore(Store):
                          % (str(table), materialize))
         # print("SQL statement:\n%s" % statement)
         self.execute(create_view)
+
+        # Replace the table without columns by the created one
+        self.metadata.remove(table)
+
         if create_index:
             table = sa.Table(view_name, self.metadata,
                                      autoload=True, schema=schema)
 
-            insp = reflection.Inspector.from_engine(engine)
-            insp.reflecttable(table, None)
+            if covering_index:
+                covering = [measure.ref for measure in cube.measures]
+            else:
+                covering = None
+
+            planner = IndexPlanner(table, cube_hierarchy_keys(cube),
+                                   key=browser.star.fact_key,
+                                   covering=covering)
+            self._create_indexes(planner)
+
+    def _create_indexes(self, planner):
+        """Creates indexes planned by the `planner` and logs issues of the
+        existing indexes."""
+
+        for index in planner.create(self.connectable):
+            self.logger.info("created index %s (%s)"
+                             % (index.name, ", ".join(index.columns)))
+
+        for issue in planner.review(planner.existing(self.connectable)):
+            self.logger.warning("%s index %s of '%s': %s"
+                             % (issue.issue, issue.name, planner.table.name,
+                                issue.message))
+
+    def review_indexes(self, cube, table_name, dimensions=None,
+                       schema=None):
+        """Reviews existing indexes of a materialized denormalized view or of
+        an aggregate table `table_name` of `cube`. `dimensions` should be
+        specified for an aggregate table and should be the same as when the
+        table was created, see :meth:`create_cube_aggregate`. Returns a
+        tuple (`issues`, `missing`) where `issues` is a list of
+        `IndexIssue` tuples of unused, redundant and duplicate indexes and
+        `missing` is a list of planned `IndexSpec` tuples without an
+        existing index with the same columns. See
+        :class:`cubes.sql.indexes.IndexPlanner`.
+
+        .. versionadded:: 1.2
+        """
+
+        if dimensions is None:
+            schema = schema or self.naming.schema
+        else:
+            schema = schema or self.naming.aggregate_schema \
+                        or self.naming.schema
+
+        try:
+            table = sa.Table(table_name, self.metadata,
+                             autoload=True, schema=schema)
+        except sa.exc.NoSuchTableError:
+            raise StoreError("Table '%s' (schema: %s) does not exist"
+                             % (table_name, schema))
+
+        if dimensions is None:
+            browser = SQLBrowser(cube, self)
+            planner = IndexPlanner(table, cube_hierarchy_keys(cube),
+                                   key=browser.star.fact_key)
+        else:
+            (_, grain) = self._aggregate_drilldown(cube, dimensions)
+            planner = IndexPlanner(table, cuboid_hierarchy_keys(cube, grain))
+
+        existing = planner.existing(self.connectable)
+        columns = [index.columns for index in existing]
+
+        # Covering indexes start with the planned columns
+        missing = [index for index in planner.plan()
+                   if not any(other[0:len(index.columns)] == index.columns
+                              for other in columns)]
+
+        return (planner.review(existing), missing)
+
+    def _denormalized_view_statement(self, browser, attributes, cell=None):
+        """Returns denormalized statement of the `browser` cube for a
+        materialized view. The fact key column is named after the fact key,
+        not by the internal fact key label."""
+
+        (statement, _) = browser.denormalized_statement(attributes,
+                                                        cell=cell,
+                                                        include_fact_key=True)
+
+        columns = list(statement.inner_columns)
+        key = browser.star.fact_key_column.element
+        columns[0] = key.label(browser.star.fact_key)
+
+        return statement.with_only_columns(columns)
+
+    def _denormalized_attributes(self, cube, keys_only=False):
+        """Returns list of attributes of a denormalized view of `cube`."""
+
+        if keys_only:
+            return cube.all_dimension_keys + cube.measures
+        else:
+            return cube.all_fact_attributes
+
+    def refresh_denormalized_view(self, cube, view_name=None,
+                                  partition_by=None, watermark=None,
+                                  since=None, partitions=None,
+                                  keys_only=False, schema=None):
+        """Rebuilds partitions of a materialized denormalized view created by
+        :meth:`create_denormalized_view` that contain changed facts, instead
+        of denormalizing the whole star again. `view_name`, `keys_only` and
+        `schema` should be the same as when the view was created.
+
+        The view is partitioned by ranges of the time dimension:
+        `partition_by` is a level in the form ``dimension@hierarchy:level``
+        and every member of the level is one partition. If the level is not
+        specified then the deepest level of the hierarchy is used. Default is
+        the first level of the first dimension with role ``time``, such as
+        ``year``. The view should be indexed by the hierarchy (see the
+        `create_index` option) to make partition rebuilds and range cuts
+        fast.
+
+        The partitions to be rebuilt are specified either by:
+
+        * `watermark` – name of a fact table column that grows with every
+          inserted or updated fact, such as an update timestamp, and
+          `since` – the watermark value of the previous refresh. All the
+          partitions containing facts with greater watermark are rebuilt,
+          older rows of the facts are removed from other partitions.
+        * `partitions` – list of paths of the partitions, such as
+          ``[[2015, 3], [2015, 4]]`` for `partition_by` ``date:month``. A
+          shorter path, such as ``[2015]``, selects all the partitions in the
+          range. Use this mode when facts are deleted.
+
+        The view is updated in one transaction. Returns the greatest
+        watermark of the refreshed facts to be used as `since` of the next
+        refresh – `since` if there are no new facts, `None` for explicit
+        partitions.
+
+        .. versionadded:: 1.2
+        """
 
-            for attribute in attributes:
-                label = attribute.ref
-                self.logger.info("creating index for %s" % label)
-                column = table.c[label]
-                name = "idx_%s_%s" % (view_name, label)
-                index = sa.schema.Index(name, column)
-                index.create(self.connectable)
+        if (watermark is None) == (partitions is None):
+            raise ArgumentError("Either watermark column or partitions should "
+                                "be specified for denormalized view refresh")
+
+        if watermark is not None and since is None:
+            raise ArgumentError("Watermark value of the previous refresh "
+                                "should be specified")
+
+        browser = SQLBrowser(cube, self, schema=schema)
+
+        if browser.safe_labels:
+            raise ConfigurationError("Denormalization does not work with "
+                                     "safe_labels turned on")
+
+        schema = schema or self.naming.schema
+        view_name = view_name or self.naming.denormalized_table_name(cube.name)
+
+        (dimension, hierarchy, levels) = self._partition_levels(cube,
+                                                                partition_by)
+        keys = [level.key.ref for level in levels]
+
+        try:
+            table = sa.Table(view_name, self.metadata,
+                             autoload=True, schema=schema)
+        except sa.exc.NoSuchTableError:
+            raise StoreError("Denormalized view '%s' (schema: %s) does not "
+                             "exist, it has to be created first"
+                             % (view_name, schema))
+
+        for ref in keys:
+            if ref not in table.columns:
+                raise ArgumentError("Partition key '%s' is not in the "
+                                    "denormalized view '%s'"
+                                    % (ref, view_name))
+
+        connection = self.connectable.connect()
+        trans = connection.begin()
+
+        try:
+            if watermark is not None:
+                (partitions, since) = self._touched_partitions(connection,
+                                                               browser, table,
+                                                               keys, watermark,
+                                                               since)
+            else:
+                since = None
+
+            attributes = self._denormalized_attributes(cube, keys_only)
+
+            for path in partitions:
+                if not path or len(path) > len(keys):
+                    raise ArgumentError("Invalid partition path %s for "
+                                        "partitions by '%s'"
+                                        % (path, levels[-1].name))
+
+                condition = sql.expression.and_(
+                    *[table.columns[key] == value
+                      for (key, value) in zip(keys, path)])
+                connection.execute(table.delete().where(condition))
+
+                cut = PointCut(dimension.name, list(path),
+                               hierarchy=hierarchy.name)
+                statement = self._denormalized_view_statement(
+                    browser,
+                    attributes,
+                    cell=Cell(cube, [cut])
+                )
+
+                insert = table.insert().from_select(statement.columns,
+                                                    statement)
+                connection.execute(insert)
+
+            self.logger.info("rebuilt %d partitions of '%s'"
+                             % (len(partitions), view_name))
+
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            connection.close()
+
+        return since
+
+    def _partition_levels(self, cube, partition_by=None):
+        """Returns a tuple (`dimension`, `hierarchy`, `levels`) of the
+        partitioning level `partition_by` of `cube`."""
+
+        if partition_by is None:
+            time_dimensions = [dim for dim in cube.dimensions
+                               if dim.role == "time"]
+
+            if not time_dimensions:
+                raise ArgumentError("Cube '%s' has no time dimension, "
+                                    "partitioning level should be specified"
+                                    % cube.name)
+
+            hierarchy = time_dimensions[0].hierarchy()
+            return (time_dimensions[0], hierarchy, hierarchy.levels[0:1])
+
+        return cuboid_levels(cube, [partition_by])[0]
+
+    def _touched_partitions(self, connection, browser, table, keys,
+                            watermark, since):
+        """Deletes rows of facts with `watermark` column value greater than
+        `since` from the denormalized view `table` and returns a tuple
+        (`partitions`, `upper`) where `partitions` is a list of paths of
+        partitions containing the facts and `upper` is the new
+        watermark."""
+
+        fact_table = browser.star.fact_table
+        fact_key = browser.star.fact_key_column.element
+
+        try:
+            column = fact_table.columns[watermark]
+        except KeyError:
+            raise ArgumentError("Fact table '%s' has no watermark column '%s'"
+                                % (fact_table.name, watermark))
+
+        # Facts changed while refreshing are left for the next refresh
+        statement = sql.expression.select([sql.functions.max(column)],
+                                          whereclause=column > since)
+        upper = connection.execute(statement).scalar()
+
+        if upper is None:
+            self.logger.info("no changed facts in '%s' since %s"
+                             % (fact_table.name, since))
+            return ([], since)
+
+        changed = sql.expression.and_(column > since, column <= upper)
+
+        # Facts might have been moved from other partitions
+        statement = sql.expression.select([fact_key], whereclause=changed)
+        delete = table.delete().where(table.columns[browser.star.fact_key]
+                                      .in_(statement))
+        connection.execute(delete)
+
+        attributes = browser.cube.get_attributes(keys)
+        (statement, _) = browser.denormalized_statement(attributes)
+        statement = statement.where(changed).distinct()
+
+        partitions = [list(row) for row in connection.execute(statement)]
+
+        return (partitions, upper)
 
     def execute(self, *args, **kwargs):
         return self.connectable.execute(*args, **kwargs)
@@ -548,16 +915,155 @@ class SQLStore(Store):
 
     def create_cube_aggregate(self, cube, table_name=None, dimensions=None,
                                  replace=False, create_index=False,
-                                 schema=None):
+                                 schema=None, source=None,
+                                 covering_index=False):
         """Creates an aggregate table. If dimensions is `None` then all cube's
         dimensions are considered.
 
         Arguments:
 
         * `dimensions`: list of dimensions to use in the aggregated cuboid, if
-          `None` then all cube dimensions are used
+          `None` then all cube dimensions are used. Dimensions might be
+          specified with a level as ``dimension@hierarchy:level``, the
+          deepest level is used if not specified.
+        * `source`: an existing `AggregateTable` of the cube to be aggregated
+          instead of the facts. The table has to contain all the dimension
+          levels and all the stored aggregates have to be additive.
+        * `create_index`: if ``True`` then a composite index of level keys
+          is created for every hierarchy, see
+          :class:`cubes.sql.indexes.IndexPlanner`
+        * `covering_index`: if ``True`` then the aggregates are included in
+          the indexes
+
+        The created table is registered in the store and is used by the
+        cube's browsers to answer queries it can answer. See
+        :meth:`register_aggregate_table`. Use
+        :meth:`refresh_cube_aggregate` to update the table with changed facts
+        only and :meth:`create_cube_aggregates` to create multiple tables at
+        once.
+        """
+
+        (table, statement, aggregate_table) = \
+            self._create_aggregate_table(cube, table_name, dimensions,
+                                         replace, schema, source)
+
+        self._insert_aggregate(cube, table, statement, aggregate_table,
+                               create_index, covering_index)
+
+        self.register_aggregate_table(cube, aggregate_table)
+
+        return aggregate_table
+
+    def create_cube_aggregates(self, cube, tables, replace=False,
+                               create_index=False, schema=None,
+                               workers=None, covering_index=False):
+        """Creates multiple aggregate tables of `cube`. `tables` is a list
+        of tuples (`table_name`, `dimensions`), see
+        :meth:`create_cube_aggregate` for description of the `dimensions`.
+
+        The tables are created from the finest to the coarsest cuboid of
+        the lattice. Every table is aggregated from the smallest already
+        created table containing all its levels, only tables without such
+        a table are aggregated from the facts. If all the stored aggregates
+        are not additive, all the tables are aggregated from the facts.
+
+        If `workers` is greater than 1, tables that do not depend on each
+        other are filled concurrently on at most `workers` threads, each with
+        its own connection. Database that does not support concurrent
+        connections (see :func:`cubes.sql.utils.supports_concurrency`) is
+        used from one thread.
+
+        Returns list of created `AggregateTable` objects in the order of
+        `tables`.
+
+        .. versionadded:: 1.2
         """
 
+        browser = SQLBrowser(cube, self, schema=schema)
+        aggregates = self._stored_aggregates(browser)
+        additive = all(get_rollup_function(agg.function)
+                       for agg in aggregates)
+
+        nodes = []
+        for (table_name, dimensions) in tables:
+            (_, grain) = self._aggregate_drilldown(cube, dimensions)
+            nodes.append((table_name, grain, cuboid_attributes(cube, grain)))
+
+        names = [node[0] for node in nodes]
+        if len(set(names)) != len(names):
+            raise ArgumentError("Aggregate table names should be unique")
+
+        # Finer cuboids first, a cuboid can be aggregated from any of the
+        # preceding cuboids that contain all its attributes
+        nodes.sort(key=lambda node: -len(node[2]))
+
+        parents = {}
+        for i, (table_name, _, attributes) in enumerate(nodes):
+            if additive:
+                parents[table_name] = [other for (other, _, other_attributes)
+                                       in nodes[0:i]
+                                       if attributes <= other_attributes]
+            else:
+                parents[table_name] = []
+
+        workers = workers or 1
+        if workers > 1 and not supports_concurrency(self.connectable):
+            self.logger.info("database does not support concurrent "
+                             "connections, aggregate tables are created "
+                             "sequentially")
+            workers = 1
+
+        created = {}
+        pending = nodes
+
+        while pending:
+            ready = [node for node in pending
+                     if all(parent in created
+                            for parent in parents[node[0]])]
+            pending = [node for node in pending if node not in ready]
+
+            # Tables are created sequentially, only filled concurrently
+            jobs = []
+            for (table_name, grain, _) in ready:
+                sources = [created[parent] for parent in parents[table_name]]
+
+                if sources:
+                    source = min(sources, key=lambda table: table.row_count)
+                else:
+                    source = None
+
+                self.logger.info("aggregating '%s' from %s"
+                                 % (table_name, "'%s'" % source.name
+                                    if source else "facts"))
+
+                job = self._create_aggregate_table(cube, table_name, grain,
+                                                   replace, schema, source)
+                jobs.append((cube, ) + job + (create_index, covering_index))
+
+            if workers > 1 and len(jobs) > 1:
+                pool = ThreadPool(min(workers, len(jobs)))
+                try:
+                    pool.map(lambda job: self._insert_aggregate(*job), jobs)
+                finally:
+                    pool.close()
+            else:
+                for job in jobs:
+                    self._insert_aggregate(*job)
+
+            for (_, _, _, aggregate_table, _, _) in jobs:
+                self.register_aggregate_table(cube, aggregate_table)
+                created[aggregate_table.name] = aggregate_table
+
+        return [created[table_name] for (table_name, _) in tables]
+
+    def _create_aggregate_table(self, cube, table_name, dimensions, replace,
+                                schema, source=None):
+        """Creates an empty aggregate table of `cube`. Returns a tuple
+        (`table`, `statement`, `aggregate_table`) where `table` is the
+        created SQLAlchemy table, `statement` is the aggregation statement
+        to fill the table and `aggregate_table` is the `AggregateTable`
+        description."""
+
         browser = SQLBrowser(cube, self, schema=schema)
 
         if browser.safe_labels:
@@ -568,33 +1074,31 @@ class SQLStore(Store):
                     or self.naming.schema
 
         # TODO: this is very similar to the denormalization prep.
-        table_name = table_name or self.naming.aggregate_table_name(cube.name)
+        table_name = table_name or self.naming.aggregated_table_name(cube.name)
         fact_name = cube.fact or self.naming.fact_table_name(cube.name)
 
-        dimensions = dimensions or [dim.name for dim in cube.dimensions]
-
         if fact_name == table_name and schema == self.naming.schema:
             raise StoreError("Aggregation target is the same as fact")
 
-        drilldown = []
-        keys = []
-        for dimref in dimensions:
-            (dimname, hiername, level) = string_to_dimension_level(dimref)
-            dimension = cube.dimension(dimname)
-            hierarchy = dimension.hierarchy(hiername)
-            levels = hierarchy.levels
-            drilldown.append((dimension, hierarchy, levels[-1]))
-            keys += [l.key for l in levels]
-
         cell = Cell(cube)
-        drilldown = Drilldown(drilldown, cell)
+        (drilldown, grain) = self._aggregate_drilldown(cube, dimensions)
+        aggregates = self._stored_aggregates(browser)
+
+        if source is not None:
+            attributes = drilldown.all_attributes
+            if not source.can_answer(cube, attributes, aggregates,
+                                     browser.locale):
+                raise ArgumentError("Aggregate table '%s' can not be "
+                                    "aggregated from '%s'"
+                                    % (table_name, source.name))
 
         # Create statement of all dimension level keys for
         # getting structure for table creation
         (statement, _) = browser.aggregation_statement(
             cell,
             drilldown=drilldown,
-            aggregates=cube.aggregates
+            aggregates=aggregates,
+            aggregate_table=source
         )
 
         # Create table
@@ -606,27 +1110,334 @@ class SQLStore(Store):
             insert=False
         )
 
-        self.logger.info("Inserting...")
+        aggregate_table = AggregateTable(table_name,
+                                         dimensions=grain,
+                                         aggregates=[a.name for a in aggregates],
+                                         schema=schema,
+                                         locale=browser.locale)
+
+        return (table, statement, aggregate_table)
+
+    def _insert_aggregate(self, cube, table, statement, aggregate_table,
+                          create_index=False, covering_index=False):
+        """Fills aggregate `table` from the `statement`, counts its rows and
+        optionally creates indexes of the level keys."""
+
+        self.logger.info("Inserting into '%s'..." % table.name)
 
         insert = table.insert().from_select(statement.columns, statement)
         self.execute(insert)
 
-        self.logger.info("Done")
+        count = sql.expression.select([sql.functions.count()],
+                                      from_obj=table)
+        aggregate_table.row_count = self.execute(count).scalar()
+
+        self.logger.info("Done, %d rows" % aggregate_table.row_count)
 
         if create_index:
-            self.logger.info("Creating indexes...")
-            aggregated_columns = [a.name for a in cube.aggregates]
-            for column in table.columns:
-                if column.name in aggregated_columns:
-                    continue
+            if covering_index:
+                covering = aggregate_table.aggregates
+            else:
+                covering = None
 
-                name = "%s_%s_idx" % (table_name, column)
-                self.logger.info("creating index: %s" % name)
-                index = Index(name, column)
-                index.create(self.connectable)
+            hierarchies = cuboid_hierarchy_keys(cube,
+                                                aggregate_table.dimensions)
+            planner = IndexPlanner(table, hierarchies, covering=covering)
+            self._create_indexes(planner)
 
         self.logger.info("Done")
 
+    def _aggregate_drilldown(self, cube, dimensions=None):
+        """Returns a tuple (`drilldown`, `grain`) for an aggregate table of
+        `cube` with `dimensions`. `drilldown` is a `Drilldown` object of the
+        aggregated levels, `grain` is a list of the levels in the form
+        ``dimension@hierarchy:level``."""
+
+        dimensions = dimensions or [dim.name for dim in cube.dimensions]
+
+        drilldown = []
+        grain = []
+        for dimref in dimensions:
+            (dimname, hiername, levelname) = string_to_dimension_level(dimref)
+            dimension = cube.dimension(dimname)
+            hierarchy = dimension.hierarchy(hiername)
+
+            if levelname:
+                level = dimension.level(levelname)
+            else:
+                level = hierarchy.levels[-1]
+
+            drilldown.append((dimension, hierarchy, level))
+            grain.append("%s@%s:%s" % (dimension.name, hierarchy.name,
+                                       level.name))
+
+        return (Drilldown(drilldown, Cell(cube)), grain)
+
+    def _stored_aggregates(self, browser):
+        """Returns aggregates of the browsed cube that can be stored in an
+        aggregate table."""
+
+        # Only aggregates computed by the database can be stored
+        return [agg for agg in browser.cube.aggregates
+                if agg.function
+                and browser.is_builtin_function(agg.function)]
+
+    def refresh_cube_aggregate(self, cube, table_name=None, dimensions=None,
+                               schema=None, watermark=None, since=None,
+                               partition=None):
+        """Updates an aggregate table created by
+        :meth:`create_cube_aggregate` with changed facts only, instead of
+        aggregating the whole fact table again. `table_name`, `dimensions`
+        and `schema` should be the same as when the table was created.
+
+        The changed facts are specified either by:
+
+        * `watermark` – name of a fact table column that grows with every
+          inserted fact, such as the fact key or an insertion timestamp, and
+          `since` – the watermark value of the previous refresh (or of the
+          table creation). Facts with greater watermark are aggregated and
+          merged into the table: additive aggregates (``sum``, ``count``,
+          ``min``, ``max``) of existing groups are combined with the new
+          values, other aggregates are computed again for the changed groups
+          only and new groups are inserted. Use this mode for facts that are
+          only appended.
+        * `partition` – a `Cell` or a list of cuts containing all the changed
+          facts, for example a month of the date dimension. Rows of the
+          partition are replaced by a new aggregation of the partition facts.
+          The cuts may contain only levels stored in the table. Use this mode
+          when facts are updated or deleted.
+
+        The table is updated in one transaction. Returns the greatest
+        watermark of the merged facts to be used as `since` of the next
+        refresh – `since` if there are no new facts, `None` for a partition
+        refresh.
+
+        .. versionadded:: 1.2
+        """
+
+        if (watermark is None) == (partition is None):
+            raise ArgumentError("Either watermark column or partition should "
+                                "be specified for aggregate refresh")
+
+        if watermark is not None and since is None:
+            raise ArgumentError("Watermark value of the previous aggregate "
+                                "refresh should be specified")
+
+        browser = SQLBrowser(cube, self, schema=schema)
+
+        if browser.safe_labels:
+            raise ConfigurationError("Aggregation does not work with "
+                                     "safe_labels turned on")
+
+        schema = schema or self.naming.aggregate_schema \
+                    or self.naming.schema
+        table_name = table_name or self.naming.aggregated_table_name(cube.name)
+
+        (drilldown, grain) = self._aggregate_drilldown(cube, dimensions)
+        aggregates = self._stored_aggregates(browser)
+
+        aggregate_table = AggregateTable(table_name,
+                                         dimensions=grain,
+                                         aggregates=[a.name for a in aggregates],
+                                         schema=schema,
+                                         locale=browser.locale)
+
+        try:
+            table = sa.Table(table_name, self.metadata,
+                             autoload=True, schema=schema)
+        except sa.exc.NoSuchTableError:
+            raise StoreError("Aggregate table '%s' (schema: %s) does not "
+                             "exist, it has to be created first"
+                             % (table_name, schema))
+
+        connection = self.connectable.connect()
+        trans = connection.begin()
+
+        try:
+            if partition is not None:
+                self._replace_aggregate_partition(connection, browser, table,
+                                                  aggregate_table, drilldown,
+                                                  aggregates, partition)
+                since = None
+            else:
+                since = self._merge_aggregate_delta(connection, browser, table,
+                                                    drilldown, aggregates,
+                                                    watermark, since)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            connection.close()
+
+        # Replace the registered table – its size has changed
+        self.register_aggregate_table(cube, aggregate_table)
+
+        return since
+
+    def _replace_aggregate_partition(self, connection, browser, table,
+                                     aggregate_table, drilldown, aggregates,
+                                     partition):
+        """Deletes rows of the aggregate `table` in the `partition` cell and
+        aggregates them again from the facts."""
+
+        cube = browser.cube
+
+        if not isinstance(partition, Cell):
+            partition = Cell(cube, partition)
+
+        stored = aggregate_table.attributes(cube)
+        refs = [attr.ref for attr in collect_attributes(None, partition)]
+
+        for ref in refs:
+            if ref not in stored:
+                raise ArgumentError("Partition attribute '%s' is not stored "
+                                    "in the aggregate table '%s'"
+                                    % (ref, table.name))
+
+        context = browser._create_aggregate_table_context(aggregate_table,
+                                                          refs)
+        condition = context.condition_for_cell(partition)
+        delete = context.star_schema.fact_table.delete().where(condition)
+
+        result = connection.execute(delete)
+        self.logger.info("deleted %s rows of partition of '%s'"
+                         % (result.rowcount, table.name))
+
+        (statement, _) = browser.aggregation_statement(partition,
+                                                       drilldown=drilldown,
+                                                       aggregates=aggregates)
+
+        insert = table.insert().from_select(statement.columns, statement)
+        connection.execute(insert)
+
+    def _merge_aggregate_delta(self, connection, browser, table, drilldown,
+                               aggregates, watermark, since):
+        """Aggregates facts with `watermark` column value greater than
+        `since` and merges them into the aggregate `table`. Returns the new
+        watermark. Groups are matched by their keys, ``NULL`` key matches
+        ``NULL``."""
+
+        fact_table = browser.star.fact_table
+
+        try:
+            column = fact_table.columns[watermark]
+        except KeyError:
+            raise ArgumentError("Fact table '%s' has no watermark column '%s'"
+                                % (fact_table.name, watermark))
+
+        # Facts inserted while refreshing are left for the next refresh
+        statement = sql.expression.select([sql.functions.max(column)],
+                                          whereclause=column > since)
+        upper = connection.execute(statement).scalar()
+
+        if upper is None:
+            self.logger.info("no new facts in '%s' since %s"
+                             % (fact_table.name, since))
+            return since
+
+        (statement, labels) = browser.aggregation_statement(
+            Cell(browser.cube),
+            drilldown=drilldown,
+            aggregates=aggregates
+        )
+        statement = statement.where(sql.expression.and_(column > since,
+                                                        column <= upper))
+
+        keys = [attr.ref for attr in drilldown.key_attributes]
+        additive = [agg for agg in aggregates
+                    if get_rollup_function(agg.function)]
+        others = [agg for agg in aggregates
+                  if not get_rollup_function(agg.function)]
+
+        # The delta is aggregated once into a temporary table and merged by
+        # one UPDATE of the existing groups and one INSERT of the new groups
+        delta = self._temporary_table(connection, table, labels, "delta")
+        connection.execute(delta.insert().from_select(labels, statement))
+
+        if others:
+            groups = self._aggregate_groups(connection, browser, table,
+                                            drilldown, others, delta, keys)
+        else:
+            groups = None
+
+        condition = _match_keys(table.columns, delta.columns, keys)
+        existing = sql.expression.exists().where(condition)
+
+        values = {}
+        for agg in additive:
+            value = sql.expression.select([delta.columns[agg.ref]],
+                                          whereclause=condition).as_scalar()
+            values[agg.ref] = merge_expression(agg, table.columns[agg.ref],
+                                               value)
+
+        # Non-additive aggregates of the changed groups are computed again
+        # from all their facts
+        if groups is not None:
+            condition = _match_keys(table.columns, groups.columns, keys)
+            for agg in others:
+                value = sql.expression.select([groups.columns[agg.ref]],
+                                              whereclause=condition)
+                values[agg.ref] = value.as_scalar()
+
+        update = table.update().where(existing).values(values)
+        updated = connection.execute(update).rowcount
+
+        # New groups have no older facts, their aggregates are complete
+        insert = sql.expression.select([delta.columns[label]
+                                        for label in labels],
+                                       whereclause=~existing)
+        insert = table.insert().from_select(labels, insert)
+        inserted = connection.execute(insert).rowcount
+
+        delta.drop(connection)
+        if groups is not None:
+            groups.drop(connection)
+
+        self.logger.info("merged %d groups into '%s' (%d new) up to "
+                         "watermark %s" % (updated + inserted, table.name,
+                                           inserted, upper))
+
+        return upper
+
+    def _temporary_table(self, connection, table, columns, suffix):
+        """Creates a temporary table with `columns` of the aggregate `table`
+        and returns it."""
+
+        name = "tmp_%s_%s" % (table.name, suffix)
+        columns = [sa.Column(column, table.columns[column].type)
+                   for column in columns]
+
+        temporary = sa.Table(name, sa.MetaData(), *columns,
+                             prefixes=["TEMPORARY"])
+        temporary.create(connection)
+
+        return temporary
+
+    def _aggregate_groups(self, connection, browser, table, drilldown,
+                          aggregates, delta, keys):
+        """Aggregates `aggregates` of the groups in the `delta` table from
+        all their facts into a temporary table and returns the table."""
+
+        (statement, labels) = browser.aggregation_statement(
+            Cell(browser.cube),
+            drilldown=drilldown,
+            aggregates=aggregates
+        )
+
+        # Aggregate only facts of the changed groups
+        expressions = dict((label, column.element) for (label, column)
+                           in zip(labels, statement.inner_columns))
+        changed = sql.expression.exists().where(_match_keys(expressions,
+                                                            delta.columns,
+                                                            keys))
+        statement = statement.where(changed)
+
+        groups = self._temporary_table(connection, table, labels, "groups")
+        connection.execute(groups.insert().from_select(labels, statement))
+
+        return groups
+
 
 class SQLSchemaInspector(object):
     """Object that discovers fact and dimension tables in a database according
@@ -1,13 +1,25 @@
 # -*- encoding: utf-8 -*-
 """Cubes SQL backend utilities, mostly to be used by the slicer command."""
 
+import sqlalchemy
 from sqlalchemy.sql.expression import Executable, ClauseElement
 from sqlalchemy.ext.compiler import compiles
 import sqlalchemy.sql as sql
 
 from collections import OrderedDict
-
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import os.path
+import pickle
+import tempfile
+
+from ..errors import ArgumentError
 from ..query import SPLIT_DIMENSION_NAME
+from .. import compat
 
 __all__ = [
     "CreateTableAsSelect",
@@ -15,10 +27,42 @@ __all__ = [
     "CreateOrReplaceView",
     "condition_conjunction",
     "order_column",
+    "order_clauses",
     "order_query",
-    "paginate_query"
+    "paginate_query",
+    "keyset_order",
+    "keyset_query",
+    "keyset_parameters",
+    "encode_continuation",
+    "decode_continuation",
+    "single_pass_query",
+    "supports_grouping_sets",
+    "supports_window_functions",
+    "estimate_row_count",
+    "supports_concurrency",
+    "schema_hash",
+    "save_metadata_snapshot",
+    "load_metadata_snapshot",
 ]
 
+# Version of the metadata snapshot file format
+SNAPSHOT_VERSION = 3
+
+# Dialects with the standard ``information_schema.columns`` catalog view
+INFORMATION_SCHEMA_DIALECTS = ("postgresql", "mysql", "mssql", "redshift")
+
+# Labels of auxiliary columns of the single-pass aggregation statement
+SUMMARY_FLAG_LABEL = "__summary__"
+ROW_NUMBER_LABEL = "__row_number__"
+CELL_COUNT_LABEL = "__cell_count__"
+
+# Label of the GROUPING() flag of n-th attribute of a merged aggregation
+# statement
+GROUPING_FLAG_LABEL = "__grouping_{}__"
+
+# Prefix of names of bound parameters with keyset pagination values
+KEYSET_PARAMETER_PREFIX = "after"
+
 class CreateTableAsSelect(Executable, ClauseElement):
     def __init__(self, table, select):
         self.table = table
@@ -89,6 +133,216 @@ def paginate_query(statement, page, page_size):
     return statement
 
 
+def keyset_order(labels, order=None, natural_order=None, keys=None):
+    """Returns a list of tuples (`label`, `direction`) for keyset
+    pagination of a statement with column `labels`. The list contains the
+    explicit `order`, the `natural_order` and the `keys` that make the
+    order unique, only for the selected labels. Directions are ``asc`` or
+    ``desc``."""
+
+    result = OrderedDict()
+
+    items = list(order or []) + list(natural_order or [])
+    items += [(key, None) for key in keys or []]
+
+    for item in items:
+        if isinstance(item, compat.string_type):
+            (label, direction) = (item, None)
+        else:
+            (label, direction) = item[0:2]
+
+        label = str(label)
+
+        if label not in labels or label in result:
+            continue
+
+        if direction and direction.lower().startswith("desc"):
+            result[label] = "desc"
+        else:
+            result[label] = "asc"
+
+    return list(result.items())
+
+
+def keyset_query(statement, labels, keyset, after=False, limit=None):
+    """Returns a statement selecting rows of `statement` ordered by
+    `keyset` – list of tuples (`label`, `direction`) as returned by
+    :func:`keyset_order`. If `after` is ``True``, then only the rows
+    following a row with the keyset values are selected. The values are
+    bound as parameters ``after_0``, ``after_1``, … (see
+    :func:`keyset_parameters`). Number of returned rows is limited by
+    `limit`.
+
+    ``NULL`` of nullable columns is ordered before all values in ascending
+    order and after all values in descending order, regardless of the
+    database default, so the rows with ``NULL`` keyset values are neither
+    skipped nor repeated. Columns declared as ``NOT NULL`` are compared and
+    ordered plainly, so the database can use their indexes.
+
+    If all the keyset labels are table columns, the conditions and the
+    order are applied to the `statement` directly, otherwise the statement
+    is wrapped in a subquery.
+    """
+
+    expressions = OrderedDict()
+    for (label, column) in zip(labels, statement.inner_columns):
+        expressions[label] = getattr(column, "element", column)
+
+    keyed = [expressions[label] for (label, _) in keyset]
+
+    if all(isinstance(expression, sqlalchemy.Column)
+           for expression in keyed):
+        columns = expressions
+        rows = None
+    else:
+        # Computed values, such as aggregates, can be compared only in a
+        # subquery
+        rows = statement.alias("__keyset__")
+        columns = OrderedDict(zip(labels, rows.c))
+
+    def nullable(label):
+        expression = expressions[label]
+        return not isinstance(expression, sqlalchemy.Column) \
+                or expression.nullable
+
+    ordering = []
+    for (label, direction) in keyset:
+        column = columns[label]
+        if nullable(label):
+            is_value = sql.expression.case([(column.is_(None), 0)], else_=1)
+            ordering.append(order_column(is_value, direction))
+        ordering.append(order_column(column, direction))
+
+    if after:
+        # (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...
+        conditions = []
+        equalities = []
+
+        for i, (label, direction) in enumerate(keyset):
+            column = columns[label]
+            value = sql.expression.bindparam("{}_{}"
+                                             .format(KEYSET_PARAMETER_PREFIX,
+                                                     i),
+                                             type_=column.type)
+            if not nullable(label):
+                if direction == "desc":
+                    following = column < value
+                else:
+                    following = column > value
+                equal = column == value
+            else:
+                if direction == "desc":
+                    # NULL is the last one
+                    following = sql.expression.and_(
+                        value.isnot(None),
+                        sql.expression.or_(column < value, column.is_(None))
+                    )
+                else:
+                    # NULL is the first one
+                    following = sql.expression.or_(
+                        column > value,
+                        sql.expression.and_(value.is_(None),
+                                            column.isnot(None))
+                    )
+
+                equal = sql.expression.or_(
+                    column == value,
+                    sql.expression.and_(column.is_(None), value.is_(None))
+                )
+
+            conditions.append(sql.expression.and_(*(equalities + [following])))
+            equalities.append(equal)
+
+        condition = sql.expression.or_(*conditions)
+    else:
+        condition = None
+
+    if rows is not None:
+        statement = sql.expression.select(list(rows.c), whereclause=condition)
+    elif condition is not None:
+        statement = statement.where(condition)
+
+    statement = statement.order_by(*ordering)
+
+    if limit is not None:
+        statement = statement.limit(limit)
+
+    return statement
+
+
+def keyset_parameters(values):
+    """Returns a dictionary of parameters of a :func:`keyset_query`
+    statement for keyset `values`"""
+
+    return dict(("{}_{}".format(KEYSET_PARAMETER_PREFIX, i), value)
+                for i, value in enumerate(values))
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"datetime": value.isoformat()}
+    elif isinstance(value, datetime.date):
+        return {"date": value.isoformat()}
+    elif isinstance(value, decimal.Decimal):
+        return {"decimal": str(value)}
+    else:
+        return value
+
+
+def _decode_value(value):
+    if not isinstance(value, dict):
+        return value
+    elif "datetime" in value:
+        try:
+            return datetime.datetime.strptime(value["datetime"],
+                                              "%Y-%m-%dT%H:%M:%S.%f")
+        except ValueError:
+            return datetime.datetime.strptime(value["datetime"],
+                                              "%Y-%m-%dT%H:%M:%S")
+    elif "date" in value:
+        return datetime.datetime.strptime(value["date"], "%Y-%m-%d").date()
+    elif "decimal" in value:
+        return decimal.Decimal(value["decimal"])
+    else:
+        raise ValueError("Unknown value type")
+
+
+def encode_continuation(keyset, values):
+    """Returns an opaque continuation token for a keyset pagination from
+    `keyset` (see :func:`keyset_order`) and keyset `values` of the last
+    returned row."""
+
+    content = {
+        "keys": [label for (label, _) in keyset],
+        "values": [_encode_value(value) for value in values]
+    }
+
+    data = json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_continuation(token, keyset):
+    """Returns list of keyset values from a continuation `token` created by
+    :func:`encode_continuation`. Raises `ArgumentError` if the token is not
+    valid or does not match the `keyset`."""
+
+    try:
+        data = base64.urlsafe_b64decode(token.encode("ascii"))
+        content = json.loads(data.decode("utf-8"))
+        keys = content["keys"]
+        values = [_decode_value(value) for value in content["values"]]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ArgumentError("Invalid continuation token")
+
+    if keys != [label for (label, _) in keyset] \
+            or len(values) != len(keyset):
+        raise ArgumentError("Continuation token does not match the query "
+                            "order")
+
+    return values
+
+
 def order_column(column, order):
     """Orders a `column` according to `order` specified as string. Returns a
     `Column` expression"""
@@ -100,7 +354,8 @@ def order_column(column, order):
     elif order.lower().startswith("desc"):
         return column.desc()
     else:
-        raise ArgumentError("Unknown order %s for column %s") % (order, column)
+        raise ArgumentError("Unknown order %s for column %s"
+                            % (order, column))
 
 
 def order_query(statement, order, natural_order=None, labels=None):
@@ -118,6 +373,16 @@ def order_query(statement, order, natural_order=None, labels=None):
       information.
     """
 
+    clauses = order_clauses(statement.columns, order, natural_order, labels)
+
+    return statement.order_by(*clauses)
+
+
+def order_clauses(columns, order, natural_order=None, labels=None):
+    """Returns a list of ordering clauses for `columns` – columns of a
+    statement or of an aliased statement. See :func:`order_query` for
+    description of the other arguments."""
+
     order = order or []
     labels = labels or {}
     natural_order = natural_order or []
@@ -131,7 +396,8 @@ def order_query(statement, order, natural_order=None, labels=None):
     # Get logical attributes from column labels (see logical_labels
     # description for more information why this step is necessary)
 
-    columns = OrderedDict(zip(labels, statement.columns))
+    selected = columns
+    columns = OrderedDict(zip(labels, selected))
 
     # Normalize order
     # ---------------
@@ -139,8 +405,8 @@ def order_query(statement, order, natural_order=None, labels=None):
     # `order`). If element of the `order` list is a string, then it is
     # converted to (`string`, ``None``).
 
-    if SPLIT_DIMENSION_NAME in statement.columns:
-        split_column = sql.expression.column(SPLIT_DIMENSION_NAME)
+    if SPLIT_DIMENSION_NAME in selected:
+        split_column = selected[SPLIT_DIMENSION_NAME]
         final_order[SPLIT_DIMENSION_NAME] = split_column
 
     # Collect the corresponding attribute columns
@@ -154,10 +420,277 @@ def order_query(statement, order, natural_order=None, labels=None):
     # Collect natural order for selected columns that have no explicit
     # ordering
     for (name, column) in columns.items():
-        if name in natural_order and name not in order_by:
+        if name in natural_order and name not in final_order:
             final_order[name] = order_column(column, natural_order[name])
 
-    statement = statement.order_by(*final_order.values())
+    return list(final_order.values())
+
+
+def single_pass_query(statement, labels, order=None, natural_order=None,
+                      page=None, page_size=None):
+    """Returns a statement that provides aggregation summary, paginated
+    drill-down cells and total cell count from one aggregation `statement`
+    in one pass. The `statement` has to be grouped by grouping sets of the
+    drill-down and of the summary (an empty set) and has to contain a
+    column labelled `SUMMARY_FLAG_LABEL` which is ``1`` for the summary row,
+    see :meth:`SQLBrowser.aggregation_statement`.
+
+    Rows of the returned statement have the `statement` columns followed by
+    a row number and total number of rows – number of cells plus one for
+    the summary. The summary row is always the first row, followed by the
+    cells ordered by `order` and `natural_order` and paginated by `page`
+    and `page_size`.
+
+    Requires a database with support for grouping sets and window
+    functions.
+    """
+
+    cells = statement.alias("__cells__")
+    flag = cells.c[SUMMARY_FLAG_LABEL]
+
+    ordering = order_clauses(cells.c, order, natural_order, labels)
+    row_number = sql.func.row_number().over(partition_by=[flag],
+                                            order_by=ordering or None)
+    count = sql.func.count().over()
+
+    selection = list(cells.c)
+    selection += [row_number.label(ROW_NUMBER_LABEL),
+                  count.label(CELL_COUNT_LABEL)]
+
+    numbered = sql.expression.select(selection).alias("__numbered__")
+    flag = numbered.c[SUMMARY_FLAG_LABEL]
+    row_number = numbered.c[ROW_NUMBER_LABEL]
+
+    if page is not None and page_size is not None:
+        condition = sql.expression.and_(row_number > page * page_size,
+                                        row_number <= (page + 1) * page_size)
+        condition = sql.expression.or_(flag == 1, condition)
+    else:
+        condition = None
+
+    statement = sql.expression.select(list(numbered.c),
+                                      whereclause=condition)
+    statement = statement.order_by(flag.desc(), row_number)
 
     return statement
 
+
+# Dialects that support `GROUP BY GROUPING SETS`
+_GROUPING_SETS_DIALECTS = ("postgresql", "mssql", "oracle")
+
+# Dialects that support window functions in all supported versions
+_WINDOW_FUNCTION_DIALECTS = ("postgresql", "mssql", "oracle")
+
+
+def supports_grouping_sets(dialect):
+    """Returns `True` if the SQLAlchemy `dialect` supports ``GROUP BY
+    GROUPING SETS`` and the ``GROUPING()`` function."""
+
+    if dialect.name not in _GROUPING_SETS_DIALECTS:
+        return False
+
+    version = getattr(dialect, "server_version_info", None)
+
+    if dialect.name == "postgresql" and version and version < (9, 5):
+        return False
+
+    return True
+
+
+def supports_window_functions(dialect):
+    """Returns `True` if the SQLAlchemy `dialect` supports window functions
+    such as ``COUNT(*) OVER ()``."""
+
+    if dialect.name in _WINDOW_FUNCTION_DIALECTS:
+        return True
+
+    if dialect.name == "sqlite":
+        dbapi = getattr(dialect, "dbapi", None)
+        version = getattr(dbapi, "sqlite_version_info", None)
+        return bool(version) and version >= (3, 25, 0)
+
+    if dialect.name == "mysql":
+        version = getattr(dialect, "server_version_info", None)
+        is_mariadb = getattr(dialect, "_is_mariadb", False)
+        return bool(version) and not is_mariadb and version >= (8, 0)
+
+    return False
+
+
+def estimate_row_count(connectable, statement, params=None):
+    """Returns number of rows of `statement` estimated by the database query
+    planner or ``None`` if the database does not provide the estimate.
+    `params` are values of the statement parameters. Currently only
+    PostgreSQL is supported."""
+
+    dialect = connectable.dialect
+
+    if dialect.name != "postgresql":
+        return None
+
+    compiled = statement.compile(dialect=dialect)
+    explain = "EXPLAIN (FORMAT JSON) {}".format(compiled.string)
+
+    result = connectable.execute(explain, compiled.construct_params(params))
+    plan = result.scalar()
+
+    # Older drivers might return the plan as a string
+    if isinstance(plan, compat.string_type):
+        plan = json.loads(plan)
+
+    try:
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def supports_concurrency(connectable):
+    """Returns `True` if statements can be executed with `connectable` from
+    multiple threads at once, each thread using its own connection. That is
+    the case of an engine with a connection pool, but not of a single
+    connection, of a pool sharing one connection or of an in-memory SQLite
+    database which exists only for one connection per thread."""
+
+    if not isinstance(connectable, sqlalchemy.engine.Engine):
+        return False
+
+    pool = connectable.pool
+    return not isinstance(pool, (sqlalchemy.pool.SingletonThreadPool,
+                                 sqlalchemy.pool.StaticPool))
+
+
+def schema_hash(connectable, schemas):
+    """Returns a hash of the database schemas `schemas` (list of schema
+    names, ``None`` is the default schema) – of the database URL and the
+    tables, views and their columns in the schemas. The hash changes when a
+    table or a view is created or dropped or when its columns change.
+
+    The catalog is read by one query: ``information_schema.columns`` or the
+    table definitions in ``sqlite_master`` in SQLite. In other databases
+    only names of the tables and views are compared, changes of columns are
+    not detected."""
+
+    url = connectable.engine.url
+    inspector = sqlalchemy.inspect(connectable)
+    dialect = connectable.dialect.name
+
+    # Sort order of the default schema (None) among the other schemas
+    schemas = sorted(schemas, key=lambda schema: schema or "")
+
+    description = [repr(url)]
+
+    if dialect in INFORMATION_SCHEMA_DIALECTS:
+        default = inspector.default_schema_name
+        names = [schema or default for schema in schemas]
+
+        columns = sqlalchemy.table("columns",
+                                   sqlalchemy.column("table_schema"),
+                                   sqlalchemy.column("table_name"),
+                                   sqlalchemy.column("column_name"),
+                                   sqlalchemy.column("data_type"),
+                                   schema="information_schema")
+        statement = sql.expression.select(list(columns.columns),
+                                          columns.c.table_schema.in_(names))
+        statement = statement.order_by(*columns.columns)
+
+        description += [list(row) for row in connectable.execute(statement)]
+
+    elif dialect == "sqlite":
+        selects = []
+        for schema in schemas:
+            master = sqlalchemy.table("sqlite_master",
+                                      sqlalchemy.column("type"),
+                                      sqlalchemy.column("name"),
+                                      sqlalchemy.column("sql"),
+                                      schema=schema)
+            name = sql.expression.literal(schema or "")
+            select = sql.expression.select([name, master.c.name,
+                                            master.c.sql],
+                                           master.c.type.in_(["table",
+                                                              "view"]))
+            selects.append(select)
+
+        statement = sql.expression.union_all(*selects)
+        rows = connectable.execute(statement)
+
+        description += sorted([list(row) for row in rows],
+                              key=lambda row: (row[0], row[1]))
+
+    else:
+        for schema in schemas:
+            description.append([
+                schema,
+                sorted(inspector.get_table_names(schema=schema)),
+                sorted(inspector.get_view_names(schema=schema))
+            ])
+
+    string = json.dumps(description, default=str)
+    return hashlib.sha1(string.encode("utf-8")).hexdigest()
+
+
+def _metadata_schemas(metadata):
+    """Returns a set of schemas of the tables in `metadata`."""
+
+    schemas = set([metadata.schema])
+    schemas.update(table.schema for table in metadata.tables.values())
+
+    return schemas
+
+
+def save_metadata_snapshot(metadata, path, connectable):
+    """Writes reflected tables of SQLAlchemy `metadata` to a file `path`.
+    The snapshot is tagged by the :func:`schema_hash` of the schemas of the
+    tables, the SQLAlchemy version and the snapshot format version. See
+    :func:`load_metadata_snapshot`."""
+
+    schemas = _metadata_schemas(metadata)
+
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "sqlalchemy": sqlalchemy.__version__,
+        "schemas": list(schemas),
+        "schema_hash": schema_hash(connectable, schemas),
+        "metadata": metadata
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+
+    # Write to a temporary file first, so other processes never read a
+    # partially written snapshot
+    (handle, temp_path) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, "wb") as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, path)
+
+
+def load_metadata_snapshot(path, connectable):
+    """Returns SQLAlchemy `MetaData` with tables read from the snapshot file
+    `path` created by :func:`save_metadata_snapshot`, bound to
+    `connectable`. Returns `None` if the file does not exist, can not be
+    read or is outdated – written by another SQLAlchemy version or the
+    database schema hash has changed, such as when a table was created or
+    a column was added or altered. The check costs one catalog query, see
+    :func:`schema_hash`."""
+
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except (IOError, OSError):
+        return None
+    except Exception:
+        # Any error of unpickling a corrupted or incompatible file
+        return None
+
+    if not isinstance(snapshot, dict) \
+            or snapshot.get("version") != SNAPSHOT_VERSION \
+            or snapshot.get("sqlalchemy") != sqlalchemy.__version__:
+        return None
+
+    if snapshot["schema_hash"] != schema_hash(connectable,
+                                              snapshot["schemas"]):
+        return None
+
+    metadata = snapshot["metadata"]
+    metadata.bind = connectable
+
+    return metadata
@@ -2,18 +2,24 @@
 
 from __future__ import absolute_import
 
+import hashlib
+import json
 import os.path
 
 from collections import OrderedDict, defaultdict
+from multiprocessing.pool import ThreadPool
 
 from .metadata import read_model_metadata, find_dimension
+from .metadata import is_compiled_model, read_compiled_model
 from .metadata import LocalizationContext
 from .auth import NotAuthorized
 from .common import read_json_file
 from .config_parser import read_slicer_config
 from .errors import ConfigurationError, ArgumentError, CubesError
 from .logging import get_logger
-from .calendar import Calendar
+from .calendar import Calendar, CalendarMemberConverter
+from .query import Cell, cuts_from_string
+from .datastructures import LRUCache
 from .namespace import Namespace
 from .compat import ConfigParser
 from . import ext
@@ -37,6 +43,13 @@ SLICER_INFO_KEYS = (
     "related"       # List of dicts with related servers
 )
 
+# Maximal number of browsers kept for reuse by the workspace
+DEFAULT_BROWSER_POOL_SIZE = 100
+
+# Number of threads preparing cubes and running queries in `warm_up()`
+DEFAULT_WARMUP_WORKERS = 4
+
+
 def interpret_config_value(value):
     if value is None:
         return value
@@ -73,6 +86,8 @@ class Workspace(object):
         * `calendar` – calendar object providing date and time functions
         * `ns_languages` – dictionary where keys are namespaces and values
           are language to translation path mappings.
+        * `result_cache` – cache of aggregation results shared by the
+          browsers, configured in the ``[cache]`` section
         """
 
         # FIXME: **_options is temporary solution/workaround before we get
@@ -128,8 +143,15 @@ class Workspace(object):
 
         # Cache of created global objects
         self._cubes = {}
+        # Browser features by cube name, see `cube_features()`
+        self._cube_features = {}
         # Note: providers are responsible for their own caching
 
+        # Digest of the imported model metadata and translations and number
+        # of lookup cache flushes, see `model_version`
+        self._model_digest = hashlib.sha1()
+        self._model_generation = 0
+
         # Info
         # ====
 
@@ -202,6 +224,14 @@ class Workspace(object):
         self.calendar = Calendar(timezone=timezone,
                                  first_weekday=first_weekday)
 
+        # Browsers reused by requests, see `browser()`
+        if config.has_option("workspace", "browser_pool_size"):
+            pool_size = config.getint("workspace", "browser_pool_size")
+        else:
+            pool_size = DEFAULT_BROWSER_POOL_SIZE
+
+        self._browsers = LRUCache(pool_size)
+
         # Register Stores
         # ===============
         #
@@ -248,6 +278,7 @@ class Workspace(object):
                     else:
                         (ns, _) = self.namespace.namespace(nsname)
                     ns.add_translation(lang, path)
+                    self._update_model_version(lang, path, nsname)
 
         # Authorizer
         # ==========
@@ -260,6 +291,21 @@ class Workspace(object):
         else:
             self.authorizer = None
 
+        # Result Cache
+        # ============
+
+        if config.has_section("cache"):
+            options = dict(config.items("cache"))
+            cache_type = options.pop("type", "memory")
+
+            path = options.get("path")
+            if path and self.root_dir and not os.path.isabs(path):
+                options["path"] = os.path.join(self.root_dir, path)
+
+            self.result_cache = ext.result_cache(cache_type, **options)
+        else:
+            self.result_cache = None
+
         # Configure and load models
         # =========================
 
@@ -287,9 +333,37 @@ class Workspace(object):
             self.logger.debug("Loading model %s" % model)
             self.import_model(path)
 
+    @property
+    def model_version(self):
+        """Version of the workspace model – a string that changes whenever
+        a model or a translation is imported or the lookup cache is flushed.
+        Workspaces with the same models have the same version, which makes
+        the version usable as an HTTP entity tag across server processes.
+
+        .. versionadded:: 1.2
+        """
+        return "{}-{}".format(self._model_digest.hexdigest(),
+                              self._model_generation)
+
+    def _update_model_version(self, *objects):
+        """Adds `objects` (model metadata or translations) to the model
+        version digest."""
+        string = json.dumps(objects, sort_keys=True, default=str)
+        self._model_digest.update(string.encode("utf-8"))
+
     def flush_lookup_cache(self):
-        """Flushes the cube lookup cache."""
+        """Flushes the cube lookup cache, the result cache and the browser
+        pool."""
         self._cubes.clear()
+        self._cube_features.clear()
+        self._model_generation += 1
+
+        for key in self._browsers.keys():
+            browser = self._browsers.pop(key)
+            if browser is not None and hasattr(browser, "clear_cache"):
+                browser.clear_cache()
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
         # TODO: flush also dimensions
 
     def _get_namespace(self, ref):
@@ -304,6 +378,7 @@ class Workspace(object):
 
         namespace = self._get_namespace(ns)
         namespace.add_translation(locale, trans)
+        self._update_model_version(locale, trans, ns)
 
     def _register_store_dict(self, name, info):
         info = dict(info)
@@ -382,7 +457,8 @@ class Workspace(object):
     def import_model(self, model=None, provider=None, store=None,
                      translations=None, namespace=None):
         """Registers the `model` in the workspace. `model` can be a
-        metadata dictionary, filename, path to a model bundle directory or a
+        metadata dictionary, filename, path to a model bundle directory, path
+        to a compiled model (see :func:`cubes.write_compiled_model`) or a
         URL.
 
         If `namespace` is specified, then the model's objects are stored in
@@ -423,7 +499,14 @@ class Workspace(object):
             path = model
             if self.models_dir and not os.path.isabs(path):
                 path = os.path.join(self.models_dir, path)
-            model = read_model_metadata(path)
+
+            if is_compiled_model(path):
+                # Compiled model is served by its own provider with cubes
+                # already linked and validated
+                provider = provider or read_compiled_model(path)
+                model = provider.metadata
+            else:
+                model = read_model_metadata(path)
         elif isinstance(model, dict):
             self.logger.debug("Importing model from dictionary. "
                               "Provider: %s Store: %s NS: %s"
@@ -435,6 +518,8 @@ class Workspace(object):
                                      "(should be a filename or a dictionary)"
                                      % model)
 
+        self._update_model_version(model, store, namespace)
+
         # 2. Model provider
         # -----------------
         # Create a model provider if name is given. Otherwise assume that the
@@ -521,7 +606,10 @@ class Workspace(object):
 
         # If we have a cached cube, return it
         # See also: flush lookup
-        cube_key = (ref, identity, locale)
+        #
+        # The identity is only authorized, the cube is the same for all the
+        # identities, so they share the cube and its pooled browsers
+        cube_key = (ref, locale)
         if cube_key in self._cubes:
             return self._cubes[cube_key]
 
@@ -579,7 +667,17 @@ class Workspace(object):
         return options
 
     def browser(self, cube, locale=None, identity=None):
-        """Returns a browser for `cube`."""
+        """Returns a browser for `cube`.
+
+        Browsers are reused: the workspace keeps browsers created for a cube
+        object (a localized variant of a cube is another object), locale and
+        store and returns the same browser instance for the same cube object
+        until :meth:`flush_lookup_cache` is called. The
+        browsers keep no state of the queries, therefore they can be used
+        by multiple threads at once. The number of kept browsers is limited
+        by the ``browser_pool_size`` workspace option, ``0`` disables the
+        reuse.
+        """
 
         # TODO: bring back the localization
         # model = self.localized_model(locale)
@@ -601,6 +699,15 @@ class Workspace(object):
             store = self.get_store("default")
             store_info = store.options or {}
 
+        # Localized variants of a cube are different cube objects with the
+        # same name. Cubes are not hashable, the browser's cube is compared
+        # as the object id might be reused after the cube is released.
+        key = (id(cube), locale, store)
+        browser = self._browsers.get(key)
+
+        if browser is not None and browser.cube is cube:
+            return browser
+
         store_type = store.store_type
         if not store_type:
             raise CubesError("Store %s has no store_type set" % store)
@@ -628,15 +735,148 @@ class Workspace(object):
 
         # TODO: remove this once calendar is used in all backends
         browser.calendar = self.calendar
+        browser.result_cache = self.result_cache
+
+        self._browsers[key] = browser
 
         return browser
 
     def cube_features(self, cube, identity=None):
-        """Returns browser features for `cube`"""
-        # TODO: this might be expensive, make it a bit cheaper
-        # recycle the feature-providing browser or something. Maybe use class
-        # method for that
-        return self.browser(cube, identity).features()
+        """Returns browser features for `cube`. Features do not change
+        between requests, therefore they are requested from a browser only
+        once per cube until the lookup cache is flushed."""
+
+        name = cube if isinstance(cube, compat.string_type) else cube.name
+
+        try:
+            features = self._cube_features[name]
+        except KeyError:
+            features = self.browser(cube, identity=identity).features()
+            self._cube_features[name] = features
+
+        return dict(features)
+
+    def translation_locales(self):
+        """Returns a sorted list of locales of the translations registered in
+        all namespaces of the workspace."""
+
+        locales = set()
+        namespaces = [self.namespace]
+
+        while namespaces:
+            namespace = namespaces.pop()
+            locales.update(namespace.translations.keys())
+            namespaces += namespace.namespaces.values()
+
+        return sorted(locales)
+
+    def warm_up(self, cubes=None, locales=None, queries=None, workers=None):
+        """Prepares cubes and their browsers before they are requested, so
+        the first requests do not pay for linking and localization of the
+        cubes, creation of the browsers and reflection of the tables.
+
+        * `cubes` – list of cube names, default is all cubes
+        * `locales` – list of locales the cubes are prepared in, default is
+          no locale and all the locales with translations
+        * `queries` – list of representative queries or a path to a JSON
+          file with the list. A query is a dictionary with keys `cube`,
+          `locale`, `cut` and `split` (cut strings as in the server API),
+          other keys, such as `aggregates`, `drilldown`, `order` or
+          `page_size` are passed to the browser's `aggregate()`
+        * `workers` – number of threads, default is 4
+
+        Cubes are prepared and queries are executed without an identity, the
+        prepared cubes and browsers are shared by all identities.
+        Failures do not stop the warm-up, they are logged and returned as a
+        list of tuples (`task`, `exception`) where `task` is a cube name or
+        a query.
+        """
+
+        if cubes is None:
+            cubes = self.cube_names()
+
+        if locales is None:
+            locales = [None] + self.translation_locales()
+
+        if isinstance(queries, compat.string_type):
+            path = queries
+            if self.root_dir and not os.path.isabs(path):
+                path = os.path.join(self.root_dir, path)
+            queries = read_json_file(path, "Warm-up queries")
+
+        workers = workers or DEFAULT_WARMUP_WORKERS
+
+        tasks = [(self._warm_up_cube, name, (name, locale))
+                 for name in cubes for locale in locales]
+        failures = self._run_warm_up_tasks(tasks, workers)
+
+        tasks = [(self._warm_up_query, query, (query, ))
+                 for query in queries or []]
+        failures += self._run_warm_up_tasks(tasks, workers)
+
+        self.logger.info("Warm-up of %d cubes and %d queries finished, "
+                         "%d failed" % (len(cubes), len(queries or []),
+                                        len(failures)))
+
+        return failures
+
+    def _run_warm_up_tasks(self, tasks, workers):
+        """Runs warm-up `tasks` – tuples (`function`, `task`, `arguments`) on
+        a pool of `workers` threads. Returns list of failures."""
+
+        def run(task):
+            (function, description, args) = task
+            try:
+                function(*args)
+            except Exception as e:
+                self.logger.warning("Warm-up of %s failed: %s"
+                                 % (description, e))
+                return (description, e)
+            return None
+
+        if not tasks:
+            return []
+
+        if workers > 1:
+            pool = ThreadPool(min(workers, len(tasks)))
+            try:
+                results = pool.map(run, tasks)
+            finally:
+                pool.close()
+        else:
+            results = [run(task) for task in tasks]
+
+        return [result for result in results if result is not None]
+
+    def _warm_up_cube(self, name, locale):
+        cube = self.cube(name, locale=locale)
+        self.browser(cube)
+        self.cube_features(cube)
+
+    def _warm_up_query(self, query):
+        options = dict(query)
+
+        cube = self.cube(options.pop("cube"), locale=options.pop("locale",
+                                                                 None))
+        browser = self.browser(cube)
+
+        converters = {
+            "time": CalendarMemberConverter(self.calendar)
+        }
+
+        cuts = cuts_from_string(cube, options.pop("cut", None),
+                                role_member_converters=converters)
+        cell = Cell(cube, cuts)
+
+        cuts = cuts_from_string(cube, options.pop("split", None),
+                                role_member_converters=converters)
+        split = Cell(cube, cuts) if cuts else None
+
+        result = browser.aggregate(cell, split=split, **options)
+
+        # Fetch all the cells, the result might be a lazy iterator
+        for row in result.cells:
+            pass
 
     def get_store(self, name=None):
         """Opens a store `name`. If the store is already open, returns the
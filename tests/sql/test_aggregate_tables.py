@@ -0,0 +1,463 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+
+import sqlalchemy as sa
+
+from cubes.errors import ArgumentError, StoreError
+from cubes.query import Cell, Drilldown, PointCut
+from cubes.query import estimate_distinct_count, select_cuboids
+from cubes.sql import SQLStore, SQLBrowser
+from cubes.sql.advisor import AggregateAdvisor
+from cubes.sql.aggregates import AggregateTable, merge_expression
+
+from .dw.demo import create_demo_dw, TinyDemoModelProvider
+
+
+CONNECTION = "sqlite://"
+
+
+class AggregateTableTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dw = create_demo_dw(CONNECTION, None, False)
+        cls.store = SQLStore(engine=cls.dw.engine,
+                             metadata=cls.dw.md,
+                             fact_prefix="fact_",
+                             dimension_prefix="dim_")
+        cls.cube = TinyDemoModelProvider().cube("sales")
+
+        cls.store.create_cube_aggregate(cls.cube, "agg_sales_month",
+                                        dimensions=["date:month", "item"])
+        cls.store.create_cube_aggregate(cls.cube, "agg_sales_year",
+                                        dimensions=["date:year"])
+
+    def setUp(self):
+        self.browser = SQLBrowser(self.cube, self.store)
+        self.star_browser = SQLBrowser(self.cube, self.store,
+                                       use_aggregate_tables=False)
+        self.aggregates = [self.cube.aggregate("price_sum")]
+
+    def drilldown(self, drilldown, cell=None):
+        return Drilldown(drilldown, cell or Cell(self.cube))
+
+    def assertSameResult(self, cell, drilldown):
+        """Assert that aggregate tables give the same result as the star"""
+        result = self.browser.aggregate(cell, aggregates=["price_sum"],
+                                        drilldown=drilldown)
+        expected = self.star_browser.aggregate(cell,
+                                               aggregates=["price_sum"],
+                                               drilldown=drilldown)
+
+        self.assertEqual(expected.summary, result.summary)
+        self.assertEqual(expected.total_cell_count, result.total_cell_count)
+        self.assertCountEqual(list(expected.cells), list(result.cells))
+
+    def test_registered(self):
+        tables = self.browser.aggregate_tables
+        names = [table.name for table in tables]
+        self.assertCountEqual(["agg_sales_month", "agg_sales_year"], names)
+
+        table = tables[names.index("agg_sales_month")]
+        self.assertEqual(["date@ymd:month", "item@default:item"],
+                         table.dimensions)
+        self.assertEqual(["price_sum"], table.aggregates)
+
+    def test_smallest_table(self):
+        cell = Cell(self.cube)
+
+        table = self.browser.aggregate_table(cell, self.aggregates,
+                                             self.drilldown(["date:year"]))
+        self.assertEqual("agg_sales_year", table.name)
+
+        table = self.browser.aggregate_table(cell, self.aggregates,
+                                             self.drilldown(["date:month"]))
+        self.assertEqual("agg_sales_month", table.name)
+
+        cut = PointCut("item", [1])
+        cell = Cell(self.cube, [cut])
+        table = self.browser.aggregate_table(cell, self.aggregates,
+                                             self.drilldown(["date:year"]))
+        self.assertEqual("agg_sales_month", table.name)
+
+    def test_no_matching_table(self):
+        cell = Cell(self.cube)
+
+        # Level is too deep
+        table = self.browser.aggregate_table(cell, self.aggregates,
+                                             self.drilldown(["date:day"]))
+        self.assertIsNone(table)
+
+        # Dimension not in any table
+        table = self.browser.aggregate_table(cell, self.aggregates,
+                                             self.drilldown(["category"]))
+        self.assertIsNone(table)
+
+        # Non-additive aggregate
+        aggregates = [self.cube.aggregate("price_avg")]
+        table = self.browser.aggregate_table(cell, aggregates,
+                                             self.drilldown(["date:year"]))
+        self.assertIsNone(table)
+
+    def test_disabled(self):
+        table = self.star_browser.aggregate_table(Cell(self.cube),
+                                                  self.aggregates,
+                                                  self.drilldown(["date:year"]))
+        self.assertIsNone(table)
+
+    def test_same_result(self):
+        cell = Cell(self.cube)
+        self.assertSameResult(cell, [])
+        self.assertSameResult(cell, ["date:year"])
+        self.assertSameResult(cell, ["date:month"])
+        self.assertSameResult(cell, ["item", "date:year"])
+
+        cell = Cell(self.cube, [PointCut("date", [2015, 1])])
+        self.assertSameResult(cell, ["item"])
+
+    def test_browser_option(self):
+        tables = [{
+            "name": "agg_sales_year",
+            "dimensions": ["date:year"],
+            "aggregates": ["price_sum"],
+            "row_count": "2"
+        }]
+        store = SQLStore(engine=self.dw.engine,
+                         metadata=self.dw.md,
+                         fact_prefix="fact_",
+                         dimension_prefix="dim_")
+        browser = SQLBrowser(self.cube, store, aggregate_tables=tables)
+
+        table = browser.aggregate_table(Cell(self.cube), self.aggregates,
+                                        self.drilldown(["date:year"]))
+        self.assertIsInstance(table, AggregateTable)
+        self.assertEqual(2, table.row_count)
+
+        result = browser.aggregate(aggregates=["price_sum"],
+                                   drilldown=["date:year"])
+        self.assertEqual([{"date.year": 2015, "price_sum": 99}],
+                         list(result.cells))
+
+
+class AggregateTableRefreshTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dw = create_demo_dw(CONNECTION, None, False)
+        self.store = SQLStore(engine=self.dw.engine,
+                              metadata=self.dw.md,
+                              fact_prefix="fact_",
+                              dimension_prefix="dim_")
+        # Non-additive aggregate stored in the aggregate table
+        provider = TinyDemoModelProvider()
+        provider.metadata["cubes"][0]["aggregates"] += [
+            {"name": "price_mean", "measure": "price", "function": "avg"},
+            {"name": "price_min", "measure": "price", "function": "min"},
+            {"name": "price_max", "measure": "price", "function": "max"}
+        ]
+        self.cube = provider.cube("sales")
+
+        self.store.create_cube_aggregate(self.cube, "agg_sales_month",
+                                         dimensions=["date:month", "item"])
+        self.star_browser = SQLBrowser(self.cube, self.store,
+                                       use_aggregate_tables=False)
+
+    def refresh(self, **options):
+        return self.store.refresh_cube_aggregate(self.cube,
+                                                 "agg_sales_month",
+                                                 dimensions=["date:month",
+                                                             "item"],
+                                                 **options)
+
+    def fact(self, id_, date_key, item_key, price):
+        return {"id": id_, "date_key": date_key, "item_key": item_key,
+                "category_key": 1, "department_key": 1, "quantity": 1,
+                "price": price, "discount": 0}
+
+    def assertRefreshed(self):
+        """Assert that the aggregate table contains the same data as the
+        star"""
+        browser = SQLBrowser(self.cube, self.store)
+        drilldown = ["date:month", "item"]
+
+        table = browser.aggregate_table(Cell(self.cube),
+                                        [self.cube.aggregate("price_sum")],
+                                        Drilldown(drilldown, Cell(self.cube)))
+        self.assertEqual("agg_sales_month", table.name)
+
+        result = browser.aggregate(aggregates=["price_sum"],
+                                   drilldown=drilldown)
+        expected = self.star_browser.aggregate(aggregates=["price_sum"],
+                                               drilldown=drilldown)
+        self.assertCountEqual(list(expected.cells), list(result.cells))
+
+    def test_watermark(self):
+        self.dw.insert("fact_sales", [
+            # Existing group: 2015-01, apricot
+            self.fact(10, 20150110, 1, 100),
+            # New group
+            self.fact(11, 20160501, 2, 200),
+        ])
+
+        watermark = self.refresh(watermark="id", since=9)
+        self.assertEqual(11, watermark)
+        self.assertRefreshed()
+
+        # Nothing new
+        watermark = self.refresh(watermark="id", since=watermark)
+        self.assertEqual(11, watermark)
+        self.assertRefreshed()
+
+    def test_watermark_null_keys(self):
+        # Facts of a date without month are aggregated into a group with
+        # NULL month key
+        date = self.dw.table("dim_date")
+        self.dw.engine.execute(date.update()
+                                   .where(date.c.date_key == 20160601)
+                                   .values(month=None))
+
+        self.dw.insert("fact_sales", [self.fact(10, 20160601, 1, 100)])
+        watermark = self.refresh(watermark="id", since=9)
+        self.assertRefreshed()
+
+        # Merged into the existing group, not inserted again
+        self.dw.insert("fact_sales", [self.fact(11, 20160601, 1, 300)])
+        self.refresh(watermark="id", since=watermark)
+        self.assertRefreshed()
+
+        table = self.dw.table("agg_sales_month")
+        rows = self.dw.engine.execute(table.select()
+                                      .where(table.c["date.month"].is_(None))
+                                      ).fetchall()
+        self.assertEqual(1, len(rows))
+        self.assertEqual(400, rows[0]["price_sum"])
+        self.assertEqual(200, rows[0]["price_mean"])
+
+    def test_watermark_null_values(self):
+        # Group with NULL aggregates only and NULL merged into an existing
+        # group with values
+        self.dw.insert("fact_sales", [self.fact(10, 20160701, 2, None),
+                                      self.fact(11, 20150110, 1, None)])
+        watermark = self.refresh(watermark="id", since=9)
+
+        self.dw.insert("fact_sales", [self.fact(12, 20160701, 2, None),
+                                      self.fact(13, 20150110, 1, None)])
+        self.refresh(watermark="id", since=watermark)
+        self.assertRefreshed()
+
+        # Same values as aggregated from all the facts at once
+        self.store.create_cube_aggregate(self.cube, "agg_sales_full",
+                                         dimensions=["date:month", "item"])
+
+        def rows(name):
+            table = self.dw.table(name)
+            columns = [table.c[ref] for ref in ("date.year", "date.month",
+                                                "item.key", "price_sum",
+                                                "price_mean")]
+            statement = sa.select(columns).order_by(*columns[0:3])
+            return [tuple(row) for row in self.dw.engine.execute(statement)]
+
+        self.assertEqual(rows("agg_sales_full"), rows("agg_sales_month"))
+
+    def test_merge_expression(self):
+        def merge(name, existing, delta):
+            aggregate = self.cube.aggregate(name)
+            values = [sa.literal(value, sa.Integer)
+                      for value in (existing, delta)]
+            expression = merge_expression(aggregate, *values)
+            return self.dw.engine.execute(sa.select([expression])).scalar()
+
+        # NULL-only delta keeps the existing value, NULL stays NULL
+        self.assertIsNone(merge("price_sum", None, None))
+        self.assertEqual(3, merge("price_sum", 3, None))
+        self.assertEqual(5, merge("price_sum", None, 5))
+        self.assertEqual(8, merge("price_sum", 3, 5))
+
+        self.assertIsNone(merge("price_min", None, None))
+        self.assertEqual(3, merge("price_min", 3, None))
+        self.assertEqual(3, merge("price_min", 3, 5))
+        self.assertEqual(5, merge("price_max", 3, 5))
+        self.assertEqual(5, merge("price_max", None, 5))
+
+        with self.assertRaises(ArgumentError):
+            merge("price_mean", 3, 5)
+
+    def test_partition(self):
+        fact = self.dw.table("fact_sales")
+        self.dw.engine.execute(fact.update()
+                                   .where(fact.c.date_key == 20150101)
+                                   .values(price=1000))
+        self.dw.engine.execute(fact.delete().where(fact.c.id == 6))
+
+        self.refresh(partition=[PointCut("date", [2015, 1])])
+
+        with self.assertRaises(AssertionError):
+            # February is not refreshed yet
+            self.assertRefreshed()
+
+        self.refresh(partition=[PointCut("date", [2015, 2])])
+        self.assertRefreshed()
+
+    def test_invalid(self):
+        with self.assertRaises(ArgumentError):
+            self.refresh()
+
+        with self.assertRaises(ArgumentError):
+            self.refresh(watermark="id")
+
+        with self.assertRaises(ArgumentError):
+            self.refresh(watermark="unknown", since=0)
+
+        # Level not stored in the table
+        with self.assertRaises(ArgumentError):
+            self.refresh(partition=[PointCut("date", [2015, 1, 1])])
+
+        with self.assertRaises(StoreError):
+            self.store.refresh_cube_aggregate(self.cube, "agg_unknown",
+                                              watermark="id", since=0)
+
+
+class AggregateLatticeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dw = create_demo_dw(CONNECTION, None, False)
+        self.store = SQLStore(engine=self.dw.engine,
+                              metadata=self.dw.md,
+                              fact_prefix="fact_",
+                              dimension_prefix="dim_")
+        self.cube = TinyDemoModelProvider().cube("sales")
+        self.star_browser = SQLBrowser(self.cube, self.store,
+                                       use_aggregate_tables=False)
+
+    def assertSameResult(self, drilldown):
+        browser = SQLBrowser(self.cube, self.store)
+        result = browser.aggregate(aggregates=["price_sum"],
+                                   drilldown=drilldown)
+        expected = self.star_browser.aggregate(aggregates=["price_sum"],
+                                               drilldown=drilldown)
+        self.assertCountEqual(list(expected.cells), list(result.cells))
+
+    def test_source(self):
+        month = self.store.create_cube_aggregate(self.cube, "agg_sales_month",
+                                                 dimensions=["date:month",
+                                                             "item"])
+        year = self.store.create_cube_aggregate(self.cube, "agg_sales_year",
+                                                dimensions=["date:year"],
+                                                source=month)
+        self.assertEqual(8, month.row_count)
+        self.assertEqual(1, year.row_count)
+        self.assertSameResult(["date:year"])
+
+        with self.assertRaises(ArgumentError):
+            self.store.create_cube_aggregate(self.cube, "agg_sales_day",
+                                             dimensions=["date:day"],
+                                             source=month)
+
+    def test_indexes(self):
+        self.store.create_cube_aggregate(self.cube, "agg_sales_month",
+                                         dimensions=["date:month", "item"],
+                                         create_index=True,
+                                         covering_index=True)
+
+        inspector = sa.inspect(self.dw.engine)
+        indexes = {index["name"]: index["column_names"]
+                   for index in inspector.get_indexes("agg_sales_month")}
+
+        self.assertEqual(["date.year", "date.month", "price_sum"],
+                         indexes["idx_agg_sales_month_date_ymd"])
+
+        (issues, missing) = self.store.review_indexes(
+            self.cube, "agg_sales_month", dimensions=["date:month", "item"])
+        self.assertEqual([], issues)
+        self.assertEqual([], missing)
+
+    def test_batch(self):
+        tables = [("agg_sales_year", ["date:year"]),
+                  ("agg_sales_item", ["item"]),
+                  ("agg_sales_month", ["date:month", "item"])]
+        created = self.store.create_cube_aggregates(self.cube, tables)
+
+        self.assertEqual(["agg_sales_year", "agg_sales_item",
+                          "agg_sales_month"],
+                         [table.name for table in created])
+
+        self.assertSameResult(["date:year"])
+        self.assertSameResult(["item"])
+        self.assertSameResult(["date:month", "item"])
+
+        with self.assertRaises(ArgumentError):
+            self.store.create_cube_aggregates(self.cube,
+                                              [("agg", ["date:year"]),
+                                               ("agg", ["item"])],
+                                              replace=True)
+
+
+class AggregateAdvisorTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dw = create_demo_dw(CONNECTION, None, False)
+        cls.store = SQLStore(engine=cls.dw.engine,
+                             metadata=cls.dw.md,
+                             fact_prefix="fact_",
+                             dimension_prefix="dim_")
+        cls.cube = TinyDemoModelProvider().cube("sales")
+
+    def record(self, cell=None, drilldown=None, method="aggregate"):
+        return {"method": method, "cube": "sales", "cell": cell,
+                "drilldown": drilldown, "split": None}
+
+    def test_select_cuboids(self):
+        sizes = {"year": 2, "month": 20, "day": 500}
+        queries = {"year": 1, "month": 10, "day": 1}
+        order = ["year", "month", "day"]
+
+        def answers(cuboid, query):
+            return order.index(query) <= order.index(cuboid)
+
+        selected = select_cuboids(sizes, queries, 1000, answers)
+        self.assertEqual([("month", 11 * 980), ("year", 18), ("day", 500)],
+                         selected)
+
+        selected = select_cuboids(sizes, queries, 1000, answers, budget=22)
+        self.assertEqual(["month", "year"], [c for (c, _) in selected])
+
+        selected = select_cuboids(sizes, queries, 1000, answers, limit=1)
+        self.assertEqual(["month"], [c for (c, _) in selected])
+
+    def test_estimate_distinct_count(self):
+        self.assertEqual(3, estimate_distinct_count([1, 2, 1], 4))
+        self.assertEqual(0, estimate_distinct_count([], 100))
+        # Two singles scaled by sqrt(100 / 4)
+        self.assertEqual(11, estimate_distinct_count([1, 1, 2], 100))
+
+    def test_log_records(self):
+        advisor = AggregateAdvisor(self.store, self.cube)
+
+        self.assertTrue(advisor.add_log_record(
+            self.record("date:2015", "date:month,item")))
+        self.assertTrue(advisor.add_log_record(
+            self.record("date:2015,1|item:1")))
+        self.assertFalse(advisor.add_log_record(
+            self.record("date:2015", method="facts")))
+        self.assertFalse(advisor.add_log_record(self.record("unknown:1")))
+
+        self.assertEqual({("date@ymd:month", "item@default:item"): 2},
+                         dict(advisor.queries))
+
+    def test_advise(self):
+        advisor = AggregateAdvisor(self.store, self.cube, sample_size=3)
+
+        for i in range(5):
+            advisor.add_log_record(self.record(None, "date:year"))
+        advisor.add_log_record(self.record(None, "date:month,item"))
+
+        candidates = advisor.candidates()
+        self.assertIn(("date:year", ), candidates)
+        self.assertIn(("date:day", "item:item"), candidates)
+
+        advice = advisor.advise(limit=1)
+        self.assertEqual(1, len(advice))
+        self.assertEqual(["date:year"], advice[0].dimensions)
+        self.assertEqual(5, advice[0].queries)
+
+        table = self.store.create_cube_aggregate(self.cube, "agg_advised",
+                                                 dimensions=advice[0].dimensions)
+        self.assertEqual(["date@ymd:year"], table.dimensions)
@@ -1,14 +1,28 @@
 # -*- encoding: utf-8 -*-
 from __future__ import absolute_import
 
-from unittest import TestCase, skip
+import os
+import shutil
+import tempfile
+import time
+
+from unittest import TestCase, skip, skipUnless
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
 
-from cubes.sql import SQLStore
+from cubes.errors import ArgumentError, NoSuchAttributeError
+from cubes.query import Cell, Drilldown, PointCut, SetCut, RangeCut
+from cubes.query import ResultRow, CalculatedResultIterator
+from cubes.query import MemoryResultCache, sort_records
+from cubes.formatters import csv_generator, JSONLinesGenerator
+from cubes.sql import SQLStore, SQLBrowser
 from cubes.sql.query import StarSchema, FACT_KEY_LABEL, to_join
-from cubes.sql.query import QueryContext
+from cubes.sql.query import QueryContext, cell_shape, cell_parameters
 from cubes.sql.mapper import map_base_attributes, StarSchemaMapper
 from cubes.sql.mapper import distill_naming
+from cubes.sql.utils import single_pass_query, supports_window_functions
+from cubes.sql.utils import estimate_row_count
+from cubes.sql.utils import keyset_query, keyset_parameters
 
 from .dw.demo import create_demo_dw, TinyDemoModelProvider
 from .common import SQLTestCase
@@ -174,3 +188,867 @@ class SQLAggregateTestCase(SQLQueryContextTestCase):
         """Test drilldown with explicit hierarchy level"""
 
 
+class SQLSinglePassTestCase(SQLQueryContextTestCase):
+    """Test single-pass drilldown, cell count and summary."""
+    def setUp(self):
+        super(SQLSinglePassTestCase, self).setUp()
+        self.sql_store = SQLStore(engine=self.dw.engine,
+                                  metadata=self.dw.md,
+                                  fact_prefix="fact_",
+                                  dimension_prefix="dim_")
+
+    def browser(self, **options):
+        return SQLBrowser(self.cube, self.sql_store, **options)
+
+    def test_mode(self):
+        self.assertIsNone(self.browser()._single_pass_mode())
+
+        browser = self.browser(single_pass=True, include_cell_count=False)
+        self.assertIsNone(browser._single_pass_mode())
+
+    def test_grouping_sets_statement(self):
+        browser = self.browser()
+        cell = Cell(self.cube)
+        drilldown = Drilldown(["date:month"], cell)
+        aggregates = [self.cube.aggregate("price_sum")]
+
+        (statement, labels) = browser.aggregation_statement(cell,
+                                                            aggregates,
+                                                            drilldown,
+                                                            with_summary=True)
+        self.assertEqual(["date.year", "date.month", "price_sum"], labels)
+
+        statement = single_pass_query(statement, labels,
+                                      order=[("price_sum", "desc")],
+                                      page=2, page_size=10)
+
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertIn("GROUPING SETS", sql)
+        self.assertIn("grouping(", sql)
+        self.assertIn("row_number() OVER (PARTITION BY", sql)
+        self.assertIn("count(*) OVER ()", sql)
+
+    @skipUnless(supports_window_functions(sa.create_engine("sqlite://").dialect),
+                "SQLite without window functions")
+    def test_window_count(self):
+        browser = self.browser(single_pass=True)
+        reference = self.browser()
+
+        self.assertEqual("window", browser._single_pass_mode())
+
+        queries = [
+            {"drilldown": ["date:day"]},
+            {"drilldown": ["date:day"], "page": 1, "page_size": 3,
+             "order": [("date.day", "desc")]},
+            # Page out of range
+            {"drilldown": ["date:day"], "page": 10, "page_size": 3},
+            {"drilldown": ["item"],
+             "split": Cell(self.cube, [PointCut("date", [2015, 1])])},
+        ]
+
+        for query in queries:
+            result = browser.aggregate(aggregates=["price_sum"], **query)
+            expected = reference.aggregate(aggregates=["price_sum"], **query)
+
+            self.assertEqual(expected.summary, result.summary)
+            self.assertEqual(expected.total_cell_count,
+                             result.total_cell_count)
+            self.assertEqual(list(expected.cells), list(result.cells))
+
+
+class SQLQueryCacheTestCase(SQLQueryContextTestCase):
+    def setUp(self):
+        super(SQLQueryCacheTestCase, self).setUp()
+        self.sql_store = SQLStore(engine=self.dw.engine,
+                                  metadata=self.dw.md,
+                                  fact_prefix="fact_",
+                                  dimension_prefix="dim_")
+
+    def test_star_cache(self):
+        star = self.star
+        star.clear_cache()
+
+        first = star.get_star(["date.year", "item.name"])
+        second = star.get_star(["item.name", "date.year"])
+        self.assertIs(first, second)
+
+        star.clear_cache()
+        self.assertIsNot(first, star.get_star(["date.year", "item.name"]))
+
+    def test_context_cache(self):
+        browser = SQLBrowser(self.cube, self.sql_store, query_cache_size=1)
+        attributes = self.cube.get_attributes(["date.year", "item.name"])
+
+        first = browser._create_context(attributes)
+        second = browser._create_context(list(reversed(attributes)))
+        self.assertIs(first, second)
+
+        # Evicted by another attribute set
+        browser._create_context(self.cube.get_attributes(["date.month"]))
+        self.assertIsNot(first, browser._create_context(attributes))
+
+    def test_disabled_cache(self):
+        browser = SQLBrowser(self.cube, self.sql_store, query_cache_size=0)
+        cached = SQLBrowser(self.cube, self.sql_store)
+        attributes = self.cube.get_attributes(["date.year"])
+
+        self.assertIsNot(browser._create_context(attributes),
+                         browser._create_context(attributes))
+
+        for _ in range(2):
+            result = browser.aggregate(aggregates=["price_sum"],
+                                       drilldown=["date:month"])
+            expected = cached.aggregate(aggregates=["price_sum"],
+                                        drilldown=["date:month"])
+            self.assertEqual(list(expected.cells), list(result.cells))
+
+    def test_cell_shape(self):
+        cell = Cell(self.cube, [PointCut("date", [2015, 1]),
+                                RangeCut("item", [1], [3])])
+        other = Cell(self.cube, [PointCut("date", [2016, 2]),
+                                 RangeCut("item", [2], [5])])
+        deeper = Cell(self.cube, [PointCut("date", [2015, 1, 1]),
+                                  RangeCut("item", [1], [3])])
+
+        self.assertEqual(cell_shape(cell), cell_shape(other))
+        self.assertNotEqual(cell_shape(cell), cell_shape(deeper))
+
+        params = cell_parameters(cell)
+        self.assertEqual({"cut0_0": 2015, "cut0_1": 1,
+                          "cut1_from_0": 1, "cut1_to_0": 3}, params)
+
+    def test_prepared_statements(self):
+        browser = SQLBrowser(self.cube, self.sql_store)
+        reference = SQLBrowser(self.cube, self.sql_store, query_cache_size=0)
+
+        cells = [
+            Cell(self.cube, [PointCut("date", [2015, 1])]),
+            Cell(self.cube, [PointCut("date", [2015, 2])]),
+            Cell(self.cube, [SetCut("date", [[2015, 1], [2015, 3]])]),
+            Cell(self.cube, [SetCut("date", [[2015, 2], [2015, 4]])]),
+            Cell(self.cube, [RangeCut("date", [2015, 1, 2], [2015, 2, 1])]),
+            Cell(self.cube, [RangeCut("date", [2015, 1, 4], [2015, 3, 1])]),
+        ]
+
+        for cell in cells:
+            result = browser.aggregate(cell, aggregates=["price_sum"],
+                                       drilldown=["item"])
+            expected = reference.aggregate(cell, aggregates=["price_sum"],
+                                           drilldown=["item"])
+
+            self.assertEqual(expected.summary, result.summary)
+            self.assertEqual(expected.total_cell_count,
+                             result.total_cell_count)
+            self.assertEqual(list(expected.cells), list(result.cells))
+
+        # One summary and one drilldown statement for each cut type
+        self.assertEqual(6, len(browser._statements))
+
+
+class SQLResultRowTestCase(SQLQueryContextTestCase):
+    def setUp(self):
+        super(SQLResultRowTestCase, self).setUp()
+        self.sql_store = SQLStore(engine=self.dw.engine,
+                                  metadata=self.dw.md,
+                                  fact_prefix="fact_",
+                                  dimension_prefix="dim_")
+        self.browser = SQLBrowser(self.cube, self.sql_store)
+
+    def aggregate(self, **options):
+        return self.browser.aggregate(aggregates=["price_sum"],
+                                      drilldown=["item"],
+                                      **options)
+
+    def test_row(self):
+        index = ResultRow.index_for_labels(["a", "b"])
+        row = ResultRow((1, None), index)
+        other = ResultRow((2, 3), index)
+
+        self.assertEqual(1, row["a"])
+        self.assertIsNone(row.get("b"))
+        self.assertEqual("default", row.get("c", "default"))
+        self.assertEqual(["a", "b"], list(row.keys()))
+        self.assertEqual({"a": 1, "b": None}, row.to_dict())
+
+        # New label is shared by all rows of the result
+        row["c"] = 10
+        self.assertEqual(10, row["c"])
+        self.assertIsNone(other.get("c"))
+        self.assertEqual({"a": 2, "b": 3, "c": None}, other.to_dict())
+
+    def test_row_auxiliary_columns(self):
+        # Unlabelled cell count column at the end of the rows
+        index = ResultRow.index_for_labels(["a", "b"])
+        row = ResultRow((1, 2, 100), index)
+        other = ResultRow((3, 4, 100), index)
+
+        self.assertIsNone(row.get("c"))
+
+        row["c"] = 10
+        self.assertEqual(10, row["c"])
+        self.assertIsNone(other.get("c"))
+        self.assertEqual({"a": 3, "b": 4, "c": None}, other.to_dict())
+
+        other["d"] = 20
+        self.assertEqual({"a": 1, "b": 2, "c": 10, "d": None},
+                         row.to_dict())
+        self.assertEqual({"a": 3, "b": 4, "c": None, "d": 20},
+                         other.to_dict())
+
+    def test_same_cells(self):
+        expected = list(self.aggregate().cells)
+        rows = list(self.aggregate(row_format="row").cells)
+
+        self.assertIsInstance(rows[0], ResultRow)
+        self.assertEqual(expected, [row.to_dict() for row in rows])
+
+        browser = SQLBrowser(self.cube, self.sql_store, row_format="row")
+        facts = list(browser.facts())
+        self.assertIsInstance(facts[0], ResultRow)
+
+        with self.assertRaises(ArgumentError):
+            self.aggregate(row_format="columns")
+
+    def test_formatters(self):
+        expected = self.aggregate()
+        result = self.aggregate(row_format="row")
+
+        self.assertEqual(list(csv_generator(expected, expected.labels)),
+                         list(csv_generator(result, result.labels)))
+        self.assertEqual(list(JSONLinesGenerator(expected)),
+                         list(JSONLinesGenerator(result)))
+
+    def test_calculated(self):
+        def calculator(record):
+            record["double"] = record["price_sum"] * 2
+
+        result = self.aggregate(row_format="row")
+        cells = CalculatedResultIterator([calculator], iter(result.cells))
+
+        for row in cells:
+            self.assertEqual(row["price_sum"] * 2, row["double"])
+
+    def test_stream(self):
+        browser = SQLBrowser(self.cube, self.sql_store, fetch_batch_size=2)
+        expected = list(self.browser.facts())
+
+        facts = browser.facts(stream=True)
+        options = facts.result.context.execution_options
+        self.assertTrue(options["stream_results"])
+        self.assertEqual(2, facts.batch_size)
+        self.assertEqual(expected, list(facts))
+
+        browser = SQLBrowser(self.cube, self.sql_store, stream_results=True)
+        expected = self.aggregate().cells
+        result = browser.aggregate(aggregates=["price_sum"],
+                                   drilldown=["item"])
+
+        options = result.cells.result.context.execution_options
+        self.assertTrue(options["stream_results"])
+        self.assertEqual(list(expected), list(result.cells))
+
+
+class SQLKeysetPaginationTestCase(SQLQueryContextTestCase):
+    def setUp(self):
+        super(SQLKeysetPaginationTestCase, self).setUp()
+        self.sql_store = SQLStore(engine=self.dw.engine,
+                                  metadata=self.dw.md,
+                                  fact_prefix="fact_",
+                                  dimension_prefix="dim_")
+        self.browser = SQLBrowser(self.cube, self.sql_store)
+
+    def pages(self, function, page_size, **kwargs):
+        """Returns all pages of `function` result by following the
+        continuation tokens."""
+        pages = []
+        continuation = ""
+
+        while continuation is not None:
+            result = function(page_size=page_size,
+                              continuation=continuation,
+                              **kwargs)
+            pages.append(list(result))
+            self.assertLessEqual(len(pages[-1]), page_size)
+            continuation = result.continuation
+
+        return pages
+
+    def test_facts(self):
+        expected = list(self.browser.facts())
+        pages = self.pages(self.browser.facts, 2)
+
+        self.assertEqual(5, len(pages))
+        self.assertEqual(expected, sum(pages, []))
+
+        pages = self.pages(self.browser.facts, 4,
+                           order=[("price", "desc")])
+        facts = sum(pages, [])
+        self.assertEqual(len(expected), len(facts))
+        prices = [fact["price"] for fact in facts]
+        self.assertEqual(sorted(prices, reverse=True), prices)
+
+    def test_drilldown(self):
+        def aggregate(**kwargs):
+            result = self.browser.aggregate(aggregates=["price_sum"],
+                                            drilldown=["date:day"],
+                                            **kwargs)
+            self.assertEqual(8, result.total_cell_count)
+            return result
+
+        expected = list(aggregate().cells)
+        cells = []
+        continuation = ""
+
+        while continuation is not None:
+            result = aggregate(page_size=4, continuation=continuation)
+            cells += list(result.cells)
+            continuation = result.continuation
+
+        self.assertCountEqual(expected, cells)
+
+        result = aggregate(page_size=4, continuation="",
+                           order=[("price_sum", "desc")])
+        sums = [cell["price_sum"] for cell in result.cells]
+        self.assertEqual(sorted(sums, reverse=True), sums)
+
+    def test_null_keys(self):
+        metadata = sa.MetaData(bind=self.dw.engine)
+        table = sa.Table("keyset_test", metadata,
+                         sa.Column("id", sa.Integer),
+                         sa.Column("label", sa.String))
+        table.create()
+        self.addCleanup(table.drop)
+
+        values = [(1, "b"), (2, None), (3, "a"), (4, None), (5, "c")]
+        self.dw.engine.execute(table.insert(),
+                               [{"id": id_, "label": label}
+                                for (id_, label) in values])
+
+        statement = sa.select([table.c.label, table.c.id])
+        labels = ["label", "id"]
+
+        for direction in ("asc", "desc"):
+            keyset = [("label", direction), ("id", "asc")]
+            first = keyset_query(statement, labels, keyset, limit=1)
+            following = keyset_query(statement, labels, keyset, after=True,
+                                     limit=1)
+
+            rows = list(self.dw.engine.execute(first))
+            page = rows
+            while page:
+                params = keyset_parameters(page[-1])
+                page = list(self.dw.engine.execute(following, params))
+                rows += page
+
+            ids = [row[1] for row in rows]
+            if direction == "asc":
+                self.assertEqual([2, 4, 3, 1, 5], ids)
+            else:
+                self.assertEqual([5, 1, 3, 2, 4], ids)
+
+    def test_not_null_keys(self):
+        metadata = sa.MetaData()
+        table = sa.Table("keyset_test", metadata,
+                         sa.Column("id", sa.Integer, primary_key=True),
+                         sa.Column("label", sa.String))
+
+        statement = sa.select([table.c.label, table.c.id])
+        labels = ["label", "id"]
+
+        # Plain condition and order of the not nullable key, no subquery
+        query = keyset_query(statement, labels, [("id", "asc")], after=True)
+        text = str(query)
+        self.assertNotIn("__keyset__", text)
+        self.assertNotIn("CASE", text)
+        self.assertIn("keyset_test.id > :after_0", text)
+        self.assertIn("ORDER BY keyset_test.id ASC", text)
+
+        # NULL-aware only for the nullable column
+        query = keyset_query(statement, labels,
+                             [("label", "asc"), ("id", "asc")], after=True)
+        text = str(query)
+        self.assertNotIn("__keyset__", text)
+        self.assertEqual(1, text.count("CASE"))
+        self.assertNotIn(":after_1 IS NULL", text)
+
+    def test_invalid_token(self):
+        with self.assertRaises(ArgumentError):
+            self.browser.facts(page_size=2, continuation="invalid")
+
+        result = self.browser.facts(page_size=2, continuation="",
+                                    order=["price"])
+        with self.assertRaises(ArgumentError):
+            self.browser.facts(page_size=2, continuation=result.continuation)
+
+
+class SQLCellCountTestCase(SQLQueryContextTestCase):
+    def setUp(self):
+        super(SQLCellCountTestCase, self).setUp()
+        self.sql_store = SQLStore(engine=self.dw.engine,
+                                  metadata=self.dw.md,
+                                  fact_prefix="fact_",
+                                  dimension_prefix="dim_")
+
+    def aggregate(self, **options):
+        browser = SQLBrowser(self.cube, self.sql_store, **options)
+        return browser.aggregate(aggregates=["price_sum"],
+                                 drilldown=["date:day"],
+                                 page=0, page_size=2)
+
+    def test_modes(self):
+        result = self.aggregate()
+        self.assertEqual(8, result.total_cell_count)
+        self.assertFalse(result.total_cell_count_approximate)
+
+        result = self.aggregate(cell_count_mode="none")
+        self.assertIsNone(result.total_cell_count)
+
+        result = self.aggregate(include_cell_count=False)
+        self.assertIsNone(result.total_cell_count)
+
+        # SQLite has no planner estimate, exact count is used
+        result = self.aggregate(cell_count_mode="estimate")
+        self.assertEqual(8, result.total_cell_count)
+        self.assertFalse(result.total_cell_count_approximate)
+        self.assertNotIn("total_cell_count_approximate", result.to_dict())
+
+        with self.assertRaises(ArgumentError):
+            self.aggregate(cell_count_mode="guess")
+
+    def test_estimate(self):
+        class PlannerConnection(object):
+            """Connection returning a PostgreSQL plan"""
+            dialect = postgresql.dialect()
+
+            def execute(self, statement, params):
+                self.statement = statement
+                self.params = params
+                return self
+
+            def scalar(self):
+                return [{"Plan": {"Plan Rows": 42}}]
+
+        browser = SQLBrowser(self.cube, self.sql_store)
+        cell = Cell(self.cube, [PointCut("date", [2015])])
+        (statement, _) = browser.aggregation_statement(cell,
+                                                       [self.cube.aggregate("price_sum")],
+                                                       Drilldown(["item"], cell))
+        connection = PlannerConnection()
+        count = estimate_row_count(connection, statement, {"cut0_0": 2016})
+
+        self.assertEqual(42, count)
+        self.assertTrue(connection.statement.startswith("EXPLAIN"))
+        self.assertEqual(2016, connection.params["cut0_0"])
+
+        self.assertIsNone(estimate_row_count(self.dw.engine, statement))
+
+
+class SQLReportTestCase(SQLTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Threads need their own connections to the same database, which is
+        # not possible with an in-memory SQLite database
+        cls.directory = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(cls.directory, "report.sqlite")
+        cls.dw = create_demo_dw(url, None, False)
+        cls.store = SQLStore(engine=cls.dw.engine,
+                             metadata=cls.dw.md,
+                             fact_prefix="fact_",
+                             dimension_prefix="dim_")
+        cls.cube = TinyDemoModelProvider().cube("sales")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dw.engine.dispose()
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.queries = {
+            "summary": {"query": "aggregate", "aggregates": ["price_sum"]},
+            "by_year": {"query": "aggregate", "aggregates": ["price_sum"],
+                        "drilldown": ["date:year"]},
+            "by_item": {"query": "aggregate", "aggregates": ["price_sum"],
+                        "drilldown": ["item"]},
+            "facts": {"query": "facts", "fields": ["date.year", "price"]},
+            "members": {"query": "members", "dimension": "item"}
+        }
+
+    def test_concurrent(self):
+        browser = SQLBrowser(self.cube, self.store)
+        concurrent = SQLBrowser(self.cube, self.store, report_workers=4)
+        self.assertEqual(1, browser.report_workers)
+        self.assertEqual(4, concurrent.report_workers)
+
+        cell = Cell(self.cube)
+        expected = browser.report(cell, self.queries)
+        result = concurrent.report(cell, self.queries)
+
+        self.assertCountEqual(expected.keys(), result.keys())
+
+        for name in ("summary", "by_year", "by_item"):
+            self.assertEqual(expected[name].summary, result[name].summary)
+            self.assertEqual(list(expected[name].cells),
+                             list(result[name].cells))
+            self.assertEqual(expected[name].attributes,
+                             result[name].attributes)
+
+        self.assertEqual(list(expected["facts"]), result["facts"])
+        self.assertEqual(list(expected["members"]), result["members"])
+
+    def test_error_isolation(self):
+        browser = SQLBrowser(self.cube, self.store, report_workers=2)
+        self.queries["broken"] = {"query": "aggregate",
+                                  "drilldown": ["unknown"]}
+
+        result = browser.report(Cell(self.cube), self.queries)
+        self.assertEqual("query_error", result["broken"]["error"])
+        self.assertEqual("NoSuchAttributeError", result["broken"]["type"])
+        self.assertEqual(99, result["summary"].summary["price_sum"])
+
+        # Errors are raised when executed sequentially
+        with self.assertRaises(NoSuchAttributeError):
+            browser.report(Cell(self.cube), self.queries, workers=1)
+
+        # Unexpected errors are raised when executed concurrently too
+        class BrokenBrowser(SQLBrowser):
+            def members(self, *args, **kwargs):
+                raise TypeError("broken browser")
+
+        broken = BrokenBrowser(self.cube, self.store, report_workers=2)
+        del self.queries["broken"]
+        with self.assertRaises(TypeError):
+            broken.report(Cell(self.cube), self.queries)
+
+        self.queries["broken"] = {"query": "unknown"}
+        with self.assertRaises(ArgumentError):
+            browser.report(Cell(self.cube), self.queries)
+
+    def test_timeout(self):
+        class SlowBrowser(SQLBrowser):
+            def members(self, *args, **kwargs):
+                time.sleep(1)
+                return super(SlowBrowser, self).members(*args, **kwargs)
+
+        browser = SlowBrowser(self.cube, self.store, report_workers=5,
+                              report_timeout=0.2)
+
+        result = browser.report(Cell(self.cube), self.queries)
+        self.assertEqual("timeout", result["members"]["error"])
+        self.assertEqual(99, result["summary"].summary["price_sum"])
+
+    def test_timeout_per_query(self):
+        class SlowBrowser(SQLBrowser):
+            def aggregate(self, *args, **kwargs):
+                time.sleep(0.3)
+                return super(SlowBrowser, self).aggregate(*args, **kwargs)
+
+        # The whole report takes longer than the timeout, each of the
+        # queries does not
+        browser = SlowBrowser(self.cube, self.store, report_workers=2,
+                              report_timeout=0.6)
+
+        result = browser.report(Cell(self.cube), self.queries)
+        for name in ("summary", "by_year", "by_item"):
+            self.assertNotIsInstance(result[name], dict)
+        self.assertEqual(99, result["summary"].summary["price_sum"])
+
+    def test_sequential_fallback(self):
+        dw = create_demo_dw(CONNECTION, None, False)
+        store = SQLStore(engine=dw.engine,
+                         metadata=dw.md,
+                         fact_prefix="fact_",
+                         dimension_prefix="dim_")
+        browser = SQLBrowser(self.cube, store, report_workers=4)
+
+        self.assertEqual(1, browser.report_workers)
+
+
+class SQLReportMergeTestCase(SQLQueryContextTestCase):
+    def setUp(self):
+        super(SQLReportMergeTestCase, self).setUp()
+        self.sql_store = SQLStore(engine=self.dw.engine,
+                                  metadata=self.dw.md,
+                                  fact_prefix="fact_",
+                                  dimension_prefix="dim_")
+        self.queries = {
+            "summary": {"query": "aggregate", "aggregates": ["price_sum"]},
+            "by_year": {"query": "aggregate", "aggregates": ["price_sum"],
+                        "drilldown": ["date:year"]},
+            "by_month": {"query": "aggregate", "aggregates": ["price_sum"],
+                         "drilldown": ["date:month"]},
+            "by_item": {"query": "aggregate", "aggregates": ["price_sum"],
+                        "drilldown": ["item"]},
+            "paginated": {"query": "aggregate", "aggregates": ["price_sum"],
+                          "drilldown": ["item"], "page": 0, "page_size": 2}
+        }
+
+    def browser(self, **options):
+        browser = SQLBrowser(self.cube, self.sql_store,
+                             use_aggregate_tables=False, **options)
+        labels = []
+
+        def execute(statement, label=None, *args, **kwargs):
+            labels.append(label)
+            return SQLBrowser.execute(browser, statement, label,
+                                      *args, **kwargs)
+
+        browser.execute = execute
+        browser.executed = labels
+        return browser
+
+    def test_same_result(self):
+        cell = Cell(self.cube, [PointCut("date", [2015])])
+        expected = self.browser().report(cell, self.queries)
+
+        browser = self.browser(merge_report_queries=True)
+        result = browser.report(cell, self.queries)
+
+        self.assertEqual(1, browser.executed.count("merged report "
+                                                   "aggregation"))
+        self.assertCountEqual(expected.keys(), result.keys())
+
+        for name in self.queries.keys():
+            self.assertEqual(expected[name].summary, result[name].summary)
+            self.assertEqual(expected[name].total_cell_count,
+                             result[name].total_cell_count)
+            self.assertEqual(list(expected[name].cells),
+                             list(result[name].cells))
+
+        # Paginated query is executed separately
+        self.assertIn("aggregation drilldown", browser.executed)
+
+    def test_sort_records(self):
+        records = [{"year": 2015, "month": 2},
+                   {"year": None, "month": 1},
+                   {"year": 2014, "month": 1},
+                   {"year": 2015, "month": 1}]
+
+        ordered = sort_records(records, [("year", "asc"), ("month", "desc")])
+        self.assertEqual([(None, 1), (2014, 1), (2015, 2), (2015, 1)],
+                         [(r["year"], r["month"]) for r in ordered])
+
+        ordered = sort_records(records, [("year", "desc")])
+        self.assertEqual([2015, 2015, 2014, None],
+                         [r["year"] for r in ordered])
+        self.assertEqual(2, ordered[0]["month"])
+
+    def test_not_mergeable(self):
+        browser = self.browser(merge_report_queries=True)
+        cell = Cell(self.cube, [PointCut("date", [2015])])
+        queries = {
+            "summary": self.queries["summary"],
+            "ordered": {"query": "aggregate", "aggregates": ["price_sum"],
+                        "drilldown": ["item"], "order": ["item.name"]},
+            "facts": {"query": "facts"}
+        }
+
+        result = browser.report(cell, queries)
+        self.assertNotIn("merged report aggregation", browser.executed)
+        self.assertEqual(99, result["summary"].summary["price_sum"])
+
+    def test_grouping_sets_statement(self):
+        browser = self.browser()
+        cell = Cell(self.cube)
+        drilldowns = [Drilldown([], cell),
+                      Drilldown(["date:year"], cell),
+                      Drilldown(["item"], cell),
+                      Drilldown(["date:year"], cell)]
+
+        (statement, labels) = browser.merged_aggregation_statement(
+            cell, [self.cube.aggregate("price_sum")], drilldowns,
+            grouping_sets=True)
+
+        self.assertEqual(["date.year", "item.key", "item.name",
+                          "item.unit_price", "price_sum"], labels)
+
+        text = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertIn("GROUPING SETS", text)
+        self.assertEqual(1, text.count("(dim_date.year), "))
+        self.assertIn("__grouping_3__", text)
+
+
+class SQLResultCacheTestCase(SQLQueryContextTestCase):
+    def setUp(self):
+        super(SQLResultCacheTestCase, self).setUp()
+        self.sql_store = SQLStore(engine=self.dw.engine,
+                                  metadata=self.dw.md,
+                                  fact_prefix="fact_",
+                                  dimension_prefix="dim_")
+        self.browser = SQLBrowser(self.cube, self.sql_store)
+        self.browser.result_cache = MemoryResultCache()
+
+        self.executed = []
+        execute = self.browser.execute
+
+        def counting_execute(*args, **kwargs):
+            self.executed.append(args)
+            return execute(*args, **kwargs)
+
+        self.browser.execute = counting_execute
+
+    def test_cached(self):
+        result = self.browser.aggregate(aggregates=["price_sum"],
+                                        drilldown=["date:year"])
+        cells = list(result.cells)
+        count = len(self.executed)
+        self.assertGreater(count, 0)
+
+        cached = self.browser.aggregate(aggregates=["price_sum"],
+                                        drilldown=["date:year"])
+        self.assertEqual(count, len(self.executed))
+        self.assertEqual(result.summary, cached.summary)
+        self.assertEqual(result.total_cell_count, cached.total_cell_count)
+        self.assertEqual(cells, list(cached.cells))
+        self.assertEqual(result.to_dict()["attributes"],
+                         cached.to_dict()["attributes"])
+
+        # Different query
+        self.browser.aggregate(aggregates=["price_sum"],
+                               drilldown=["item"])
+        self.assertGreater(len(self.executed), count)
+
+    def test_not_cached(self):
+        self.browser.aggregate(aggregates=["price_sum"], stream=True)
+        count = len(self.executed)
+
+        self.browser.aggregate(aggregates=["price_sum"], stream=True)
+        self.assertGreater(len(self.executed), count)
+
+    def test_stale(self):
+        cache = MemoryResultCache(ttl=0.01, stale_grace=60)
+        self.browser.result_cache = cache
+
+        refreshed = []
+        cache.refresh = lambda key, cube, function: refreshed.append(key)
+
+        result = self.browser.aggregate(aggregates=["price_sum"])
+        count = len(self.executed)
+
+        time.sleep(0.02)
+        stale = self.browser.aggregate(aggregates=["price_sum"])
+        self.assertEqual(count, len(self.executed))
+        self.assertEqual(result.summary, stale.summary)
+        self.assertEqual(1, len(refreshed))
+
+    def test_watermark(self):
+        cache = MemoryResultCache(watermark_interval=0)
+        self.browser.result_cache = cache
+        self.browser.cache_watermark = "fact_key"
+        self.assertEqual(9, self.browser.watermark())
+
+        self.browser.aggregate(aggregates=["price_sum"])
+        count = len(self.executed)
+
+        # Cached, watermark probe only
+        self.browser.aggregate(aggregates=["price_sum"])
+        self.assertEqual(count + 1, len(self.executed))
+
+        # Watermark moved
+        probes = iter([9, 10])
+        cache.watermark("sales", lambda: next(probes))
+        cache.watermark("sales", lambda: next(probes))
+        self.assertEqual(0, len(cache.values))
+
+        self.browser.cache_watermark = "max:fact_sales.id"
+        self.assertEqual(9, self.browser.watermark())
+
+        self.browser.cache_watermark = "sql:SELECT count(*) FROM fact_sales " \
+                                       "WHERE :cube = 'sales'"
+        self.assertEqual(9, self.browser.watermark())
+
+        self.browser.cache_watermark = "unknown"
+        with self.assertRaises(ArgumentError):
+            self.browser.watermark()
+
+    def test_watermark_interval(self):
+        cache = MemoryResultCache(watermark_interval=60)
+        probes = iter([1, 2])
+
+        self.assertEqual(1, cache.watermark("sales", lambda: next(probes)))
+        self.assertEqual(1, cache.watermark("sales", lambda: next(probes)))
+
+        cache.set("key", "value", "sales", 1)
+        self.assertEqual("value", cache.get("key", "sales", 1))
+        self.assertIsNone(cache.get("key", "sales", 2))
+
+    def test_rollup(self):
+        # Finer result cached as the roll-up source
+        self.browser.aggregate(aggregates=["price_sum"],
+                               drilldown=["date:month", "item"])
+        count = len(self.executed)
+
+        expected = self.browser_without_cache()
+
+        for drilldown in (["date:year"], ["date:month"], ["item"], []):
+            result = self.browser.aggregate(aggregates=["price_sum"],
+                                            drilldown=drilldown)
+            self.assertEqual(count, len(self.executed))
+
+            direct = expected.aggregate(aggregates=["price_sum"],
+                                        drilldown=drilldown)
+            self.assertEqual(direct.summary, result.summary)
+            self.assertEqual(direct.total_cell_count,
+                             result.total_cell_count)
+            self.assertEqual(list(direct.cells), list(result.cells))
+
+        # Different dimension, paginated or non-additive: from the database
+        self.browser.aggregate(aggregates=["price_sum"],
+                               drilldown=["category"])
+        self.assertEqual(count + 3, len(self.executed))
+
+        self.browser.aggregate(aggregates=["price_sum"],
+                               drilldown=["date:year"], page=0, page_size=1)
+        self.assertGreater(len(self.executed), count + 3)
+
+    def test_no_rollup_for_non_additive(self):
+        cache = self.browser.result_cache
+        cell = Cell(self.cube)
+        month = Drilldown(["date:month"], cell)
+        year = Drilldown(["date:year"], cell)
+        rollup_key = "rollup-test"
+
+        cache.set("month", {"summary": {"price_sum": 30, "price_avg": 10},
+                            "cells": [{"date.year": 2015, "date.month": 1,
+                                       "price_sum": 30, "price_avg": 10}]})
+        cache.add_rollup_source(rollup_key, "month", month,
+                                {"price_sum": "sum"})
+
+        average = [self.cube.aggregate("price_avg")]
+        self.assertIsNone(cache.rollup(rollup_key, year, average))
+
+        aggregates = [self.cube.aggregate("price_sum")]
+        payload = cache.rollup(rollup_key, year, aggregates)
+        self.assertEqual([{"date.year": 2015, "price_sum": 30}],
+                         payload["cells"])
+
+        browser = SQLBrowser(self.cube, self.sql_store)
+        self.assertEqual("sum",
+                         browser.aggregate_rollup_function(aggregates[0]))
+        self.assertIsNone(browser.aggregate_rollup_function(
+                          self.cube.aggregate("price_avg")))
+
+    def test_rollup_order(self):
+        cache = self.browser.result_cache
+        cell = Cell(self.cube)
+        month = Drilldown(["date:month"], cell)
+        year = Drilldown(["date:year"], cell)
+        rollup_key = "rollup-test"
+
+        cache.set("month", {"summary": {"price_sum": 60},
+                            "cells": [{"date.year": 2016, "date.month": 1,
+                                       "price_sum": 10},
+                                      {"date.year": 2015, "date.month": 2,
+                                       "price_sum": 20},
+                                      {"date.year": 2016, "date.month": 2,
+                                       "price_sum": 30}]})
+        cache.add_rollup_source(rollup_key, "month", month,
+                                {"price_sum": "sum"})
+
+        aggregates = [self.cube.aggregate("price_sum")]
+        payload = cache.rollup(rollup_key, year, aggregates)
+        self.assertEqual([{"date.year": 2015, "price_sum": 20},
+                          {"date.year": 2016, "price_sum": 40}],
+                         payload["cells"])
+
+    def browser_without_cache(self):
+        return SQLBrowser(self.cube, self.sql_store)
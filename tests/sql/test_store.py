@@ -0,0 +1,277 @@
+# -*- encoding: utf-8 -*-
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import sqlalchemy as sa
+
+from cubes.errors import ArgumentError
+from cubes.sql import SQLStore, SQLBrowser
+from cubes.sql.utils import load_metadata_snapshot, save_metadata_snapshot
+
+from .dw.demo import create_demo_dw, TinyDemoModelProvider
+
+
+class MetadataSnapshotTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(cls.directory, "dw.sqlite")
+        cls.dw = create_demo_dw(url, None, False)
+        cls.cube = TinyDemoModelProvider().cube("sales")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dw.engine.dispose()
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        self.path = os.path.join(self.directory, "metadata.pickle")
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def create_store(self, **options):
+        return SQLStore(engine=self.dw.engine,
+                        fact_prefix="fact_",
+                        dimension_prefix="dim_",
+                        metadata_snapshot=self.path,
+                        **options)
+
+    def test_snapshot(self):
+        store = self.create_store()
+        self.assertEqual(0, len(store.metadata.tables))
+
+        browser = SQLBrowser(self.cube, store)
+        expected = browser.aggregate(aggregates=["price_sum"],
+                                     drilldown=["date:year"])
+        tables = set(store.metadata.tables)
+        self.assertIn("fact_sales", tables)
+
+        store.save_metadata_snapshot()
+
+        loaded = self.create_store()
+        self.assertEqual(tables, set(loaded.metadata.tables))
+        self.assertIs(self.dw.engine, loaded.metadata.bind)
+
+        browser = SQLBrowser(self.cube, loaded)
+        result = browser.aggregate(aggregates=["price_sum"],
+                                   drilldown=["date:year"])
+        self.assertEqual(expected.summary, result.summary)
+        self.assertEqual(list(expected.cells), list(result.cells))
+
+    def test_outdated(self):
+        store = self.create_store()
+        SQLBrowser(self.cube, store)
+        store.save_metadata_snapshot()
+
+        self.assertIsNotNone(load_metadata_snapshot(self.path,
+                                                    self.dw.engine))
+
+        # Schema changed
+        metadata = sa.MetaData(bind=self.dw.engine)
+        table = sa.Table("snapshot_test", metadata,
+                         sa.Column("id", sa.Integer))
+        table.create()
+        try:
+            self.assertIsNone(load_metadata_snapshot(self.path,
+                                                     self.dw.engine))
+            self.assertEqual(0, len(self.create_store().metadata.tables))
+        finally:
+            table.drop()
+
+        # Columns of a snapshotted table changed
+        table.create()
+        try:
+            metadata = sa.MetaData(bind=self.dw.engine)
+            sa.Table("snapshot_test", metadata, autoload=True)
+            save_metadata_snapshot(metadata, self.path, self.dw.engine)
+            self.assertIsNotNone(load_metadata_snapshot(self.path,
+                                                        self.dw.engine))
+
+            self.dw.engine.execute("ALTER TABLE snapshot_test "
+                                   "ADD COLUMN amount INTEGER")
+            self.assertIsNone(load_metadata_snapshot(self.path,
+                                                     self.dw.engine))
+        finally:
+            table.drop()
+
+        # Different default schema
+        self.assertEqual(0, len(self.create_store(schema="other")
+                                .metadata.tables))
+
+    def test_one_catalog_query(self):
+        store = self.create_store()
+        SQLBrowser(self.cube, store)
+        store.save_metadata_snapshot()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sa.event.listen(self.dw.engine, "before_cursor_execute", count)
+        try:
+            self.assertIsNotNone(load_metadata_snapshot(self.path,
+                                                        self.dw.engine))
+        finally:
+            sa.event.remove(self.dw.engine, "before_cursor_execute", count)
+
+        self.assertEqual(1, len(statements))
+
+    def test_invalid(self):
+        self.assertIsNone(load_metadata_snapshot(self.path, self.dw.engine))
+
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot")
+        self.assertIsNone(load_metadata_snapshot(self.path, self.dw.engine))
+
+        store = SQLStore(engine=self.dw.engine)
+        with self.assertRaises(ArgumentError):
+            store.save_metadata_snapshot()
+
+
+class DenormalizedViewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dw = create_demo_dw("sqlite://", None, False)
+        self.store = SQLStore(engine=self.dw.engine,
+                              metadata=self.dw.md,
+                              fact_prefix="fact_",
+                              dimension_prefix="dim_")
+        self.cube = TinyDemoModelProvider().cube("sales")
+
+        self.store.create_denormalized_view(self.cube, "mft_sales",
+                                            materialize=True,
+                                            create_index=True)
+
+    def fact(self, id_, date_key, item_key, price):
+        return {"id": id_, "date_key": date_key, "item_key": item_key,
+                "category_key": 1, "department_key": 1, "quantity": 1,
+                "price": price, "discount": 0}
+
+    def assertRefreshed(self):
+        """Assert that the view contains the same data as the star"""
+        browser = SQLBrowser(self.cube, self.store)
+        (statement, _) = browser.denormalized_statement(
+            self.cube.all_fact_attributes,
+            include_fact_key=True
+        )
+        expected = [tuple(row) for row in self.dw.engine.execute(statement)]
+
+        table = self.dw.table("mft_sales")
+        rows = [tuple(row) for row in self.dw.engine.execute(table.select())]
+
+        self.assertCountEqual(expected, rows)
+
+    def test_indexes(self):
+        inspector = sa.inspect(self.dw.engine)
+        indexes = {index["name"]: index["column_names"]
+                   for index in inspector.get_indexes("mft_sales")}
+
+        self.assertEqual(["id"], indexes["idx_mft_sales_id"])
+        self.assertEqual(["date.year", "date.month", "date.day"],
+                         indexes["idx_mft_sales_date_ymd"])
+        self.assertEqual(["date.year", "date.quarter", "date.month",
+                          "date.day"],
+                         indexes["idx_mft_sales_date_yqmd"])
+        # Prefix of the ymd hierarchy
+        self.assertNotIn("idx_mft_sales_date_ym", indexes)
+
+        with self.assertRaises(ArgumentError):
+            self.store.create_denormalized_view(self.cube, "mft_other",
+                                                create_index=True)
+
+    def test_covering_indexes(self):
+        self.store.create_denormalized_view(self.cube, "mft_sales",
+                                            materialize=True,
+                                            replace=True,
+                                            create_index=True,
+                                            covering_index=True)
+
+        inspector = sa.inspect(self.dw.engine)
+        indexes = {index["name"]: index["column_names"]
+                   for index in inspector.get_indexes("mft_sales")}
+
+        columns = indexes["idx_mft_sales_date_ymd"]
+        self.assertEqual(["date.year", "date.month", "date.day"],
+                         columns[0:3])
+        self.assertIn("price", columns[3:])
+        self.assertEqual(["id"], indexes["idx_mft_sales_id"])
+
+    def test_review_indexes(self):
+        (issues, missing) = self.store.review_indexes(self.cube, "mft_sales")
+        self.assertEqual([], issues)
+        self.assertEqual([], missing)
+
+        table = self.dw.table("mft_sales")
+        sa.Index("extra_year", table.c["date.year"]).create(self.dw.engine)
+        sa.Index("extra_month", table.c["date.month"]).create(self.dw.engine)
+        sa.Index("extra_ymd", table.c["date.year"], table.c["date.month"],
+                 table.c["date.day"]).create(self.dw.engine)
+        self.dw.engine.execute('DROP INDEX "idx_mft_sales_date_ymd"')
+
+        (issues, missing) = self.store.review_indexes(self.cube, "mft_sales")
+        issues = {issue.name: issue.issue for issue in issues}
+
+        self.assertEqual({"extra_year": "redundant",
+                          "extra_month": "unused"}, issues)
+        self.assertEqual([], missing)
+
+        self.dw.engine.execute('DROP INDEX "extra_ymd"')
+        (_, missing) = self.store.review_indexes(self.cube, "mft_sales")
+        self.assertEqual(["idx_mft_sales_date_ymd"],
+                         [index.name for index in missing])
+
+    def test_watermark(self):
+        self.dw.insert("fact_sales", [
+            self.fact(10, 20150110, 1, 100),
+            self.fact(11, 20160501, 2, 200),
+        ])
+
+        watermark = self.store.refresh_denormalized_view(
+            self.cube, "mft_sales", partition_by="date:month",
+            watermark="id", since=9)
+        self.assertEqual(11, watermark)
+        self.assertRefreshed()
+
+        # Nothing new
+        watermark = self.store.refresh_denormalized_view(
+            self.cube, "mft_sales", partition_by="date:month",
+            watermark="id", since=watermark)
+        self.assertEqual(11, watermark)
+
+    def test_partitions(self):
+        fact = self.dw.table("fact_sales")
+        self.dw.engine.execute(fact.update()
+                                   .where(fact.c.date_key == 20150101)
+                                   .values(price=1000))
+        self.dw.engine.execute(fact.delete().where(fact.c.id == 6))
+
+        self.store.refresh_denormalized_view(self.cube, "mft_sales",
+                                             partition_by="date:month",
+                                             partitions=[[2015, 1]])
+        with self.assertRaises(AssertionError):
+            # February is not rebuilt yet
+            self.assertRefreshed()
+
+        self.store.refresh_denormalized_view(self.cube, "mft_sales",
+                                             partition_by="date:month",
+                                             partitions=[[2015]])
+        self.assertRefreshed()
+
+    def test_invalid(self):
+        with self.assertRaises(ArgumentError):
+            self.store.refresh_denormalized_view(self.cube, "mft_sales",
+                                                 partition_by="date:month")
+
+        # No time dimension in the model
+        with self.assertRaises(ArgumentError):
+            self.store.refresh_denormalized_view(self.cube, "mft_sales",
+                                                 partitions=[[2015]])
+
+        with self.assertRaises(ArgumentError):
+            self.store.refresh_denormalized_view(self.cube, "mft_sales",
+                                                 partition_by="date:month",
+                                                 partitions=[[2015, 1, 1]])
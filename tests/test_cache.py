@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cubes.errors import ArgumentError
+from cubes.query import MemoryResultCache, FilesystemResultCache
+from cubes.query import aggregate_cache_key
+from cubes.query import Cell, PointCut, SetCut, Drilldown
+from cubes.workspace import Workspace
+from cubes.compat import ConfigParser
+
+from .common import CubesTestCaseBase
+
+
+class ResultCacheKeyTestCase(CubesTestCaseBase):
+    def setUp(self):
+        super(ResultCacheKeyTestCase, self).setUp()
+        workspace = Workspace()
+        workspace.import_model(self.model_path("model.json"))
+        self.cube = workspace.cube("contracts")
+
+    def key(self, cuts=None, drilldown=None, **kwargs):
+        cell = Cell(self.cube, cuts or [])
+        drilldown = Drilldown(drilldown or [], cell)
+        aggregates = kwargs.pop("aggregates", ["amount_sum"])
+        return aggregate_cache_key(self.cube, cell, aggregates, drilldown,
+                                   **kwargs)
+
+    def test_canonical(self):
+        date = PointCut("date", [2015, 1])
+        item = SetCut("supplier", [[1], [2]])
+
+        key = self.key([date, item])
+        self.assertEqual(key, self.key([item, date]))
+        self.assertEqual(key, self.key([PointCut("date", ["2015", "1"]),
+                                        item]))
+
+        self.assertNotEqual(key, self.key([date]))
+        self.assertNotEqual(key, self.key([date, item], drilldown=["supplier"]))
+        self.assertNotEqual(key, self.key([date, item],
+                                          aggregates=["amount_min"]))
+        self.assertNotEqual(key, self.key([date, item], page=1, page_size=10))
+        self.assertNotEqual(key, self.key([date, item],
+                                          options={"row_format": "row"}))
+        self.assertEqual(key, self.key([date, item],
+                                       options={"stream": False}))
+
+
+class ResultCacheTestCaseMixin(object):
+    def test_get_set(self):
+        cache = self.create_cache()
+        self.assertIsNone(cache.get("key", "sales"))
+
+        cache.set("key", {"summary": {"amount": 10}}, "sales")
+        value = cache.get("key", "sales")
+        self.assertEqual({"summary": {"amount": 10}}, value)
+
+        # Every hit is a copy
+        value["summary"]["amount"] = 20
+        self.assertEqual(10, cache.get("key", "sales")["summary"]["amount"])
+
+        # Keys are per cube
+        self.assertIsNone(cache.get("key", "orders"))
+
+    def test_invalidate(self):
+        cache = self.create_cache()
+        cache.set("a", 1, "sales")
+        cache.set("b", 2, "sales")
+        cache.set("a", 3, "orders")
+
+        cache.invalidate("sales")
+        self.assertIsNone(cache.get("a", "sales"))
+        self.assertIsNone(cache.get("b", "sales"))
+        self.assertEqual(3, cache.get("a", "orders"))
+
+        cache.invalidate()
+        self.assertIsNone(cache.get("a", "orders"))
+
+    def test_ttl(self):
+        cache = self.create_cache(ttl=10, cube_ttl="orders:0, items:0.01")
+
+        cache.set("a", 1, "sales")
+        cache.set("a", 2, "orders")
+        cache.set("a", 3, "items")
+
+        self.assertEqual(1, cache.get("a", "sales"))
+        # TTL 0 disables caching
+        self.assertIsNone(cache.get("a", "orders"))
+
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a", "items"))
+
+        with self.assertRaises(ArgumentError):
+            self.create_cache(cube_ttl="orders")
+
+
+    def test_stale(self):
+        cache = self.create_cache(ttl=0.01, stale_grace=0.05)
+        cache.set("a", 1, "sales")
+        self.assertEqual((1, False), cache.lookup("a", "sales"))
+
+        time.sleep(0.02)
+        self.assertEqual((1, True), cache.lookup("a", "sales"))
+        self.assertIsNone(cache.get("a", "sales"))
+
+        time.sleep(0.05)
+        self.assertEqual((None, False), cache.lookup("a", "sales"))
+
+    def test_single_flight(self):
+        cache = self.create_cache()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return {"value": 10}
+
+        results = []
+
+        def request():
+            results.append(cache.single_flight("a", "sales", compute))
+
+        leader = threading.Thread(target=request)
+        leader.start()
+        started.wait()
+
+        followers = [threading.Thread(target=request) for i in range(3)]
+        for thread in followers:
+            thread.start()
+
+        # Let the followers join the flight
+        time.sleep(0.05)
+        release.set()
+
+        for thread in [leader] + followers:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([{"value": 10}] * 4, results)
+        # Every caller has its own copy
+        self.assertEqual(4, len(set(id(result) for result in results)))
+
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            cache.single_flight("a", "sales", fail)
+
+    def test_refresh(self):
+        cache = self.create_cache()
+
+        def compute():
+            cache.set("a", 2, "sales")
+            return 2
+
+        thread = cache.refresh("a", "sales", compute)
+        thread.join()
+        self.assertEqual(2, cache.get("a", "sales"))
+
+
+class MemoryResultCacheTestCase(ResultCacheTestCaseMixin, unittest.TestCase):
+    def create_cache(self, **options):
+        return MemoryResultCache(**options)
+
+    def test_size(self):
+        cache = MemoryResultCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_max_size(self):
+        cache = MemoryResultCache(max_size=2500)
+        cache.set("a", "x" * 1000)
+        cache.set("b", "x" * 1000)
+        cache.get("a")
+        cache.set("c", "x" * 1000)
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertLessEqual(cache.total_size, 2500)
+
+        # Larger than the whole cache
+        cache.set("d", "x" * 3000)
+        self.assertIsNone(cache.get("d"))
+        self.assertIsNotNone(cache.get("c"))
+
+        cache.clear()
+        self.assertEqual(0, cache.total_size)
+
+
+class FilesystemResultCacheTestCase(ResultCacheTestCaseMixin,
+                                    unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def create_cache(self, **options):
+        return FilesystemResultCache(self.path, **options)
+
+    def test_max_size(self):
+        cache = FilesystemResultCache(self.path, max_size=2500)
+        cache.set("a", "x" * 1000)
+        cache.set("b", "x" * 1000)
+        cache.set("c", "x" * 1000)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_shared(self):
+        cache = self.create_cache()
+        other = self.create_cache()
+
+        cache.set("a", 1, "sales")
+        self.assertEqual(1, other.get("a", "sales"))
+
+
+class WorkspaceResultCacheTestCase(unittest.TestCase):
+    def test_config(self):
+        config = ConfigParser()
+        config.add_section("cache")
+        config.set("cache", "type", "memory")
+        config.set("cache", "size", "10")
+        config.set("cache", "ttl", "60")
+
+        workspace = Workspace(config=config)
+        cache = workspace.result_cache
+        self.assertIsInstance(cache, MemoryResultCache)
+        self.assertEqual(60, cache.ttl)
+
+        self.assertIsNone(Workspace().result_cache)
@@ -2,8 +2,12 @@
 import unittest
 from cubes import __version__
 import json
+import os
+import shutil
+import tempfile
 from .common import CubesTestCaseBase
-from sqlalchemy import MetaData, Table, Column, Integer, String
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String
+from sqlalchemy import event
 
 from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
@@ -11,6 +15,7 @@ from werkzeug.wrappers import BaseResponse
 from cubes.server import create_server
 from cubes import compat
 from cubes import Workspace
+from cubes.errors import ConfigurationError
 
 import csv
 
@@ -261,3 +266,254 @@ class SlicerAggregateTestCase(SlicerTestCaseBase):
         header = next(reader)
         self.assertSequenceEqual(["2013", "100", "5"],
                                  header)
+
+
+class SlicerConditionalRequestTestCase(SlicerTestCaseBase):
+    sql_engine = "sqlite:///"
+
+    def setUp(self):
+        super(SlicerConditionalRequestTestCase, self).setUp()
+
+        self.facts = Table("facts", self.metadata,
+                           Column("id", Integer),
+                           Column("id_date", Integer),
+                           Column("id_item", Integer),
+                           Column("amount", Integer))
+        dim_date = Table("date", self.metadata,
+                         Column("id", Integer),
+                         Column("year", Integer),
+                         Column("month", Integer),
+                         Column("day", Integer))
+        dim_item = Table("item", self.metadata,
+                         Column("id", Integer),
+                         Column("name", String))
+        self.metadata.create_all()
+
+        self.load_data(self.facts, [(1, 20130901, 1, 20),
+                                    (2, 20130902, 1, 30)])
+        self.load_data(dim_date, [(20130900 + day, 2013, 9, day)
+                                  for day in range(1, 4)])
+        self.load_data(dim_item, [(1, "apple")])
+
+        self.workspace = Workspace()
+        self.workspace.register_default_store("sql", engine=self.engine)
+        self.workspace.import_model(self.model_path("server.json"))
+        self.slicer.cubes_workspace = self.workspace
+
+    def conditional_get(self, path, etag):
+        return self.server.get(path, headers={"If-None-Match": etag})
+
+    def test_metadata(self):
+        for path in ("/cubes", "/info"):
+            response = self.server.get(path)
+            self.assertEqual(200, response.status_code)
+            etag = response.headers["ETag"]
+
+            response = self.conditional_get(path, etag)
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(b"", response.data)
+
+        # Importing a model changes the model version
+        version = self.workspace.model_version
+        self.workspace.import_model(self.model_path("model.json"))
+        self.assertNotEqual(version, self.workspace.model_version)
+
+        response = self.conditional_get("/cubes", etag)
+        self.assertEqual(200, response.status_code)
+
+        # Same models, same version
+        workspace = Workspace()
+        workspace.import_model(self.model_path("server.json"))
+        workspace.import_model(self.model_path("model.json"))
+        self.assertEqual(self.workspace.model_version,
+                         workspace.model_version)
+
+    def test_aggregate_watermark(self):
+        self.workspace.browser_options["cache_watermark"] = "fact_key"
+        path = "/cube/aggregate_test/aggregate?aggregates=amount_sum"
+
+        statements = []
+
+        def count_watermarks(conn, cursor, statement, *args):
+            if "max(" in statement:
+                statements.append(statement)
+
+        event.listen(self.engine, "before_cursor_execute", count_watermarks)
+
+        # Unconditional request without a result cache does not probe the
+        # watermark
+        response = self.server.get(path)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, len(statements))
+
+        # Any conditional request gets the tag of the data version
+        response = self.conditional_get(path, "unknown")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len(statements))
+        etag = response.headers["ETag"]
+
+        response = self.conditional_get(path, etag)
+        self.assertEqual(304, response.status_code)
+
+        response = self.conditional_get(path + "&prettyprint=true", etag)
+        self.assertEqual(200, response.status_code)
+
+        # Data changed
+        self.engine.execute(self.facts.insert().values((3, 20130903, 1, 5)))
+        response = self.conditional_get(path, etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers["ETag"])
+
+    def test_aggregate_content(self):
+        path = "/cube/aggregate_test/aggregate?aggregates=amount_sum"
+
+        response = self.server.get(path)
+        self.assertEqual(200, response.status_code)
+        etag = response.headers["ETag"]
+
+        response = self.conditional_get(path, etag)
+        self.assertEqual(304, response.status_code)
+
+        self.engine.execute(self.facts.insert().values((3, 20130903, 1, 5)))
+        response = self.conditional_get(path, etag)
+        self.assertEqual(200, response.status_code)
+
+    def test_metadata_cache(self):
+        calls = []
+        list_cubes = self.workspace.list_cubes
+
+        def counting_list_cubes(*args, **kwargs):
+            calls.append(args)
+            return list_cubes(*args, **kwargs)
+
+        self.workspace.list_cubes = counting_list_cubes
+
+        (first, status) = self.get("cubes")
+        (second, status) = self.get("cubes")
+        self.assertEqual(1, len(calls))
+        self.assertEqual(first, second)
+
+        # Pretty-printed response is serialized separately
+        response = self.server.get("/cubes?prettyprint=true")
+        self.assertIn(b"\n    ", response.data)
+        self.assertEqual(2, len(calls))
+
+        self.workspace.flush_lookup_cache()
+        self.get("cubes")
+        self.assertEqual(3, len(calls))
+
+    def test_model_cache(self):
+        (model, status) = self.get("cube/aggregate_test/model")
+        self.assertEqual(200, status)
+        self.assertEqual("aggregate_test", model["name"])
+        self.assertIn("aggregate", model["features"]["actions"])
+
+        # Features are requested from a browser only once
+        self.workspace.browser = None
+        (cached, status) = self.get("cube/aggregate_test/model")
+        self.assertEqual(model, cached)
+        features = self.workspace.cube_features("aggregate_test")
+        self.assertEqual(model["features"]["actions"], features["actions"])
+
+    def assertCacheControl(self, directives, response):
+        header = response.headers["Cache-Control"]
+        self.assertCountEqual(directives,
+                              [item.strip() for item in header.split(",")])
+
+    def test_max_age(self):
+        self.assertNotIn("Cache-Control", self.server.get("/cubes").headers)
+
+        self.config.add_section("server")
+        self.config.set("server", "cache_max_age", "60, model:3600, cubes:0")
+        slicer = create_server(self.config)
+        slicer.cubes_workspace = self.workspace
+        server = Client(slicer, BaseResponse)
+
+        response = server.get("/cubes")
+        self.assertCacheControl(["public", "max-age=0"], response)
+        response = server.get("/cube/aggregate_test/model")
+        self.assertCacheControl(["public", "max-age=3600"], response)
+        response = server.get("/info")
+        self.assertCacheControl(["public", "max-age=60"], response)
+
+        self.config.set("server", "cache_max_age", "unknown:10")
+        with self.assertRaises(ConfigurationError):
+            create_server(self.config)
+
+
+class SlicerWarmUpTestCase(CubesTestCaseBase):
+    def setUp(self):
+        super(SlicerWarmUpTestCase, self).setUp()
+
+        self.temp_dir = tempfile.mkdtemp()
+        url = "sqlite:///" + os.path.join(self.temp_dir, "warmup.sqlite")
+        self.engine = create_engine(url)
+        self.metadata = MetaData(bind=self.engine)
+
+        Table("facts", self.metadata,
+              Column("id", Integer, primary_key=True),
+              Column("id_date", Integer),
+              Column("id_item", Integer),
+              Column("amount", Integer))
+        Table("date", self.metadata,
+              Column("id", Integer),
+              Column("year", Integer),
+              Column("month", Integer),
+              Column("day", Integer))
+        Table("item", self.metadata,
+              Column("id", Integer),
+              Column("name", String))
+        self.metadata.create_all()
+
+        queries_path = os.path.join(self.temp_dir, "queries.json")
+        with open(queries_path, "w") as f:
+            json.dump([{"cube": "aggregate_test", "drilldown": ["date"]}], f)
+
+        self.config = compat.ConfigParser()
+        self.config.add_section("store")
+        self.config.set("store", "type", "sql")
+        self.config.set("store", "url", url)
+        self.config.add_section("models")
+        self.config.set("models", "main", self.model_path("server.json"))
+        self.config.add_section("server")
+        self.config.set("server", "warmup_queries", queries_path)
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.temp_dir)
+
+    def test_disabled(self):
+        slicer = create_server(self.config)
+        self.assertEqual({}, slicer.cubes_workspace._cubes)
+
+    def test_warmup(self):
+        self.config.set("server", "warmup", "yes")
+        self.config.set("server", "warmup_locales", "sk")
+
+        slicer = create_server(self.config)
+        workspace = slicer.cubes_workspace
+
+        self.assertIn(("aggregate_test", None), workspace._cubes)
+        self.assertIn(("aggregate_test", "sk"), workspace._cubes)
+
+        # Warmed-up browser is used by the request
+        cube = workspace.cube("aggregate_test")
+        browser = workspace.browser(cube)
+
+        server = Client(slicer, BaseResponse)
+        response = server.get("/cube/aggregate_test/aggregate")
+        self.assertEqual(200, response.status_code)
+        self.assertIs(browser, workspace.browser(cube))
+
+    def test_cube_list(self):
+        self.config.remove_option("server", "warmup_queries")
+        self.config.set("server", "warmup", "unknown")
+
+        slicer = create_server(self.config)
+        self.assertEqual({}, slicer.cubes_workspace._cubes)
+
+        self.config.set("server", "warmup", "aggregate_test")
+
+        slicer = create_server(self.config)
+        self.assertEqual([("aggregate_test", None)],
+                         list(slicer.cubes_workspace._cubes.keys()))
@@ -1,13 +1,19 @@
 import unittest
 import os
 import json
+import pickle
 import re
+import shutil
+import tempfile
 from cubes.errors import ConfigurationError, NoSuchCubeError, NoSuchDimensionError
-from cubes.errors import NoSuchAttributeError
+from cubes.errors import NoSuchAttributeError, ModelError
 from cubes.workspace import Workspace
 from cubes.stores import Store
 from cubes.metadata import *
+from cubes.metadata.compiled import COMPILED_MODEL_MAGIC
 from cubes.server.base import read_slicer_config
+from sqlalchemy import create_engine, MetaData
+from sqlalchemy import Table, Column, Integer, String
 
 from .common import CubesTestCaseBase
 # FIXME: remove this once satisfied
@@ -130,3 +136,240 @@ class WorkspaceModelTestCase(WorkspaceTestCaseBase):
         dim = cube.dimension("date")
         self.assertEqual(["lonely_year"], dim.level_names)
 
+
+
+class WorkspaceBrowserPoolTestCase(CubesTestCaseBase):
+    sql_engine = "sqlite://"
+
+    def setUp(self):
+        super(WorkspaceBrowserPoolTestCase, self).setUp()
+        Table("facts", self.metadata,
+              Column("id", Integer),
+              Column("id_date", Integer),
+              Column("id_item", Integer),
+              Column("amount", Integer))
+        Table("date", self.metadata,
+              Column("id", Integer),
+              Column("year", Integer),
+              Column("month", Integer),
+              Column("day", Integer))
+        Table("item", self.metadata,
+              Column("id", Integer),
+              Column("name", String))
+        self.metadata.create_all()
+
+        self.workspace = self.create_pool_workspace()
+
+    def create_pool_workspace(self, config=None):
+        workspace = Workspace(config=config)
+        workspace.register_default_store("sql", engine=self.engine)
+        workspace.import_model(self.model_path("server.json"))
+        return workspace
+
+    def test_reuse(self):
+        cube = self.workspace.cube("aggregate_test")
+        browser = self.workspace.browser(cube)
+
+        self.assertIs(browser, self.workspace.browser(cube))
+        self.assertIs(browser, self.workspace.browser("aggregate_test"))
+
+        # Different locale
+        self.assertIsNot(browser, self.workspace.browser(cube, locale="sk"))
+
+        # Another cube object with the same name
+        other = self.workspace.cube("aggregate_test", locale="sk")
+        self.assertIsNot(browser, self.workspace.browser(other))
+
+    def test_reuse_localized(self):
+        cubes = [self.workspace.cube("aggregate_test", locale=locale)
+                 for locale in (None, "sk")]
+        browsers = [self.workspace.browser(cube) for cube in cubes]
+        self.assertIsNot(browsers[0], browsers[1])
+
+        # Requests alternating the locales reuse their browsers
+        for i in range(2):
+            for (cube, browser) in zip(cubes, browsers):
+                self.assertIs(browser, self.workspace.browser(cube))
+
+    def test_flush(self):
+        browser = self.workspace.browser("aggregate_test")
+        self.workspace.flush_lookup_cache()
+        self.assertIsNot(browser, self.workspace.browser("aggregate_test"))
+
+    def test_disabled(self):
+        config = read_slicer_config(None)
+        config.add_section("workspace")
+        config.set("workspace", "browser_pool_size", "0")
+
+        workspace = self.create_pool_workspace(config)
+
+        cube = workspace.cube("aggregate_test")
+        self.assertIsNot(workspace.browser(cube), workspace.browser(cube))
+
+
+class WorkspaceCompiledModelTestCase(CubesTestCaseBase):
+    def setUp(self):
+        super(WorkspaceCompiledModelTestCase, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.compiled_path = os.path.join(self.temp_dir, "model.cubesc")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def compile(self, model):
+        metadata = read_model_metadata(self.model_path(model))
+        write_compiled_model(self.compiled_path, metadata)
+
+    def test_compiled_model(self):
+        self.compile("model.json")
+        self.assertTrue(is_compiled_model(self.compiled_path))
+        self.assertFalse(is_compiled_model(self.model_path("model.json")))
+
+        ws = Workspace()
+        ws.import_model(self.compiled_path)
+
+        expected = Workspace()
+        expected.import_model(self.model_path("model.json"))
+
+        self.assertEqual(expected.list_cubes(), ws.list_cubes())
+
+        cube = ws.cube("contracts")
+        self.assertEqual("contracts", cube.name)
+        self.assertEqual(expected.cube("contracts").to_dict(),
+                         cube.to_dict())
+
+        dim = ws.dimension("date")
+        self.assertEqual(expected.dimension("date").to_dict(),
+                         dim.to_dict())
+
+    def test_templates(self):
+        self.compile("templated_dimension.json")
+
+        ws = Workspace()
+        ws.import_model(self.compiled_path)
+
+        dim = ws.dimension("start_date")
+        self.assertEqual("start_date", dim.name)
+        self.assertEqual(3, len(dim.levels))
+
+    def test_invalid_model(self):
+        # Dimension 'date' is provided by another model
+        with self.assertRaises(ModelError):
+            self.compile("other.json")
+
+        self.assertFalse(os.path.exists(self.compiled_path))
+
+    def test_version(self):
+        self.compile("model.json")
+
+        with open(self.compiled_path, "rb") as f:
+            f.read(len(COMPILED_MODEL_MAGIC))
+            compiled = pickle.load(f)
+
+        compiled["cubes_version"] = "0.0"
+
+        with open(self.compiled_path, "wb") as f:
+            f.write(COMPILED_MODEL_MAGIC)
+            pickle.dump(compiled, f)
+
+        ws = Workspace()
+        with self.assertRaises(ModelError):
+            ws.import_model(self.compiled_path)
+
+
+class WorkspaceWarmUpTestCase(CubesTestCaseBase):
+    def setUp(self):
+        super(WorkspaceWarmUpTestCase, self).setUp()
+
+        # Warm-up runs in threads, in-memory database is not shared between
+        # connections of different threads
+        self.temp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.temp_dir, "warmup.sqlite")
+        self.engine = create_engine("sqlite:///" + path)
+        self.metadata = MetaData(bind=self.engine)
+
+        facts = Table("facts", self.metadata,
+                      Column("id", Integer, primary_key=True),
+                      Column("id_date", Integer),
+                      Column("id_item", Integer),
+                      Column("amount", Integer))
+        date = Table("date", self.metadata,
+                     Column("id", Integer),
+                     Column("year", Integer),
+                     Column("month", Integer),
+                     Column("day", Integer))
+        item = Table("item", self.metadata,
+                     Column("id", Integer),
+                     Column("name", String))
+        self.metadata.create_all()
+
+        facts.insert().execute([
+            {"id": 1, "id_date": 1, "id_item": 1, "amount": 10},
+            {"id": 2, "id_date": 2, "id_item": 1, "amount": 20}
+        ])
+        date.insert().execute([
+            {"id": 1, "year": 2015, "month": 1, "day": 1},
+            {"id": 2, "year": 2015, "month": 2, "day": 1}
+        ])
+        item.insert().execute([{"id": 1, "name": "apple"}])
+
+        self.workspace = Workspace()
+        self.workspace.register_default_store("sql", engine=self.engine)
+        self.workspace.import_model(self.model_path("server.json"))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.temp_dir)
+
+    def test_locales(self):
+        self.assertEqual([], self.workspace.translation_locales())
+
+        self.workspace.add_translation("sk", {})
+        self.workspace.add_translation("de", {}, ns="other")
+        self.assertEqual(["de", "sk"], self.workspace.translation_locales())
+
+    def test_cubes(self):
+        failures = self.workspace.warm_up(locales=[None, "sk"])
+        self.assertEqual([], failures)
+
+        for locale in (None, "sk"):
+            self.assertIn(("aggregate_test", locale), self.workspace._cubes)
+
+        # Warmed-up cube and browser are used by the requests, also by the
+        # requests of an identity
+        count = len(self.workspace._browsers)
+        cube = self.workspace.cube("aggregate_test", identity="john")
+        browser = self.workspace.browser(cube, identity="john")
+        self.assertEqual(count, len(self.workspace._browsers))
+        self.assertIs(cube, self.workspace.cube("aggregate_test"))
+        self.assertIs(browser, self.workspace.browser(cube))
+        self.assertIn("aggregate_test", self.workspace._cube_features)
+
+    def test_queries(self):
+        queries = [
+            {"cube": "aggregate_test", "drilldown": ["date"]},
+            {"cube": "aggregate_test", "cut": "date:2015,1",
+             "aggregates": ["amount_sum"], "locale": "sk"},
+        ]
+
+        failures = self.workspace.warm_up(locales=[None], queries=queries)
+        self.assertEqual([], failures)
+
+        path = os.path.join(self.temp_dir, "queries.json")
+        with open(path, "w") as f:
+            json.dump(queries, f)
+
+        failures = self.workspace.warm_up(locales=[None], queries=path,
+                                          workers=1)
+        self.assertEqual([], failures)
+
+    def test_failures(self):
+        queries = [{"cube": "aggregate_test", "drilldown": ["unknown"]}]
+
+        failures = self.workspace.warm_up(cubes=["aggregate_test", "unknown"],
+                                          locales=[None],
+                                          queries=queries)
+
+        tasks = [task for (task, _) in failures]
+        self.assertEqual(["unknown", queries[0]], tasks)
+        self.assertIsInstance(failures[0][1], NoSuchCubeError)